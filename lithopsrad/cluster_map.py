@@ -6,10 +6,11 @@ import shutil
 
 from lithops import FunctionExecutor
 
-from lithopsrad.module import Module
+from lithopsrad.module import Module, packable
 import lithopsrad.sequence as seq
 import lithopsrad.utils as utils
 import lithopsrad.mmseqs_utils as mmseqs_utils
+import lithopsrad.zstd_utils as zstd_utils
 
 class ClusterMap(Module):
     def __init__(self, lithops_config, runtime_config, mode="clust_within"):
@@ -20,7 +21,9 @@ class ClusterMap(Module):
     def setup(self, mode="clust_within"):
         # Remote paths 
         self.run_path = utils.fix_dir_name(self.runtime_config["remote_paths"]["run_path"])
-        self.input_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["fastq_dereps"]))
+        # cluster the sample-level uniques if DerepReduce ran, otherwise the chunk-level ones 
+        derep_dir = "fastq_uniques" if self.runtime_config["derep_reduce"]["enabled"] else "fastq_dereps"
+        self.input_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"][derep_dir]))
         self.output_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["clust"]))
 
         # runtime params for cluster_map 
@@ -48,18 +51,35 @@ class ClusterMap(Module):
         return data
 
     @staticmethod
-    def _cluster_map(obj, config, bucket, remote_path, cov, identity, cov_mode, mask, mask_lower_case, threads, tmpdir=None):
+    @packable
+    def _cluster_map(chunk_obj, config, bucket, remote_path, cov, identity, cov_mode, mask, mask_lower_case, threads, tmpdir=None, compression=None):
         # Set working directory
         tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
         os.chdir(tmpdir)
         
         # Get the filename
-        infile = obj['Key'] if isinstance(obj, dict) else obj.key
+        infile = utils._get_path(chunk_obj)
         tmp_path = os.path.join(tmpdir, os.path.basename(infile))
         
         # Download the file to the temp directory & configure paths 
-        utils._download_file(config, bucket, infile, tmp_path)
-        
+        stats = zstd_utils.CompressionStats()
+        utils._download_file(config, bucket, infile, tmp_path, stats=stats)
+        return ClusterMap._cluster_file(tmp_path, config, bucket, remote_path, cov, identity, cov_mode, 
+                                        mask, mask_lower_case, threads, tmpdir=tmpdir, 
+                                        compression=compression, stats=stats)
+
+
+    @staticmethod
+    def _cluster_file(tmp_path, config, bucket, remote_path, cov, identity, cov_mode, mask, mask_lower_case, threads, tmpdir=None, 
+                      compression=None, stats=None):
+        """
+        Cluster a local FASTA/FASTQ file with mmseqs easy-linclust and upload the 
+        '.temp.hits' (in the binary format, see mmseqs_utils.write_hits_binary) and 
+        '.temp.centroids' outputs under remote_path (zstd compressed at the given level 
+        if compression is set).
+        """
+        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
+        stats = stats or zstd_utils.CompressionStats()
         out_prefix = os.path.basename(os.path.splitext(tmp_path)[0])
 
         # Create a new sub-directory for MMSEQS2 temporary files
@@ -103,13 +123,13 @@ class ClusterMap(Module):
         cout = os.path.join(remote_path, os.path.basename(out_prefix) + ".temp.centroids")
         
         # write files and grab results to report back 
-        mmseqs_utils.write_hits(hits, hits_path)
+        mmseqs_utils.write_hits(hits, hits_path, binary=True)
         seq.write_fasta(centroids, centroids_path)
         centroids_num, cluster_depth = mmseqs_utils.get_cluster_info(centroids_path)
 
         # Upload the results
-        utils._upload_file(config, bucket, hout, hits_path)
-        utils._upload_file(config, bucket, cout, centroids_path)
+        utils._upload_file(config, bucket, hout, hits_path, compression=compression, stats=stats)
+        utils._upload_file(config, bucket, cout, centroids_path, compression=compression, stats=stats)
         
         # Cleanup and return
         os.remove(hits_path)
@@ -119,5 +139,6 @@ class ClusterMap(Module):
         return {
             "chunk": out_prefix,
             "mean_depth_pre": cluster_depth,
-            "clusters": centroids_num
+            "clusters": centroids_num,
+            **stats.as_dict("map")
         }
\ No newline at end of file
@@ -3,19 +3,27 @@ import sys
 import tempfile
 import subprocess as sp 
 import shutil
+import time
 import hashlib
 from collections import defaultdict
 from itertools import chain
+from contextlib import ExitStack
 from lithops import FunctionExecutor
+from lithops.wait import ANY_COMPLETED
 
 from lithopsrad.module import Module
 import lithopsrad.sequence as seq
 import lithopsrad.utils as utils
 import lithopsrad.mmseqs_utils as mmseqs_utils
+import lithopsrad.zstd_utils as zstd_utils
+import lithopsrad.pipe_utils as pipe_utils
 
 class ClusterMerge(Module):
-    def __init__(self, lithops_config, runtime_config, mode="clust_within"):
+    def __init__(self, lithops_config, runtime_config, mode="clust_within", cluster_counts=None):
         super().__init__(lithops_config, runtime_config)
+        # number of clusters of each input (by chunk, or by sample across samples), from the 
+        # previous step, used to plan the merges (see _plan_merges) 
+        self.cluster_counts = cluster_counts or {}
         self.setup(mode)
 
 
@@ -37,8 +45,42 @@ class ClusterMerge(Module):
         self.min_depth = self.runtime_config[mode]["min_depth"]
         self.max_depth = self.runtime_config[mode]["max_depth"]
 
+        # with deferred hits, merge rounds only upload the hits of clustering their centroids 
+        # (an edge list of new centroid -> absorbed centroids), and the leaf hits tables and 
+        # edge lists are only stitched into the final hits tables by _process_clusters 
+        self.deferred_hits = self.runtime_config["clust_merge"]["deferred_hits"]
+
+        # format of the final hits tables; merge rounds always use the binary one
+        self.hits_format = self.runtime_config["global"]["hits_format"]
+        if self.hits_format not in ("text", "binary"):
+            raise ValueError(f"Unknown hits_format '{self.hits_format}'. Expected 'text' or 'binary'.")
+
+        # merge planning: at most max_fan_in inputs and max_group_clusters centroids per merge 
+        self.max_fan_in = self.runtime_config["clust_merge"]["max_fan_in"]
+        self.max_group_clusters = self.runtime_config["clust_merge"]["max_group_clusters"]
+        if self.max_fan_in < 2:
+            raise ValueError(f"clust_merge max_fan_in must be at least 2, got {self.max_fan_in}.")
+
+        # the across-sample catalog (unfiltered centroids and hits, plus a manifest of its samples) 
+        # is saved to catalog_path; if incremental, only the samples not yet in the saved catalog 
+        # are clustered, and merged into it (see _get_catalog_iterdata)
+        catalog_path = self.runtime_config["clust_merge"]["catalog_path"]
+        self.catalog_path = utils.fix_dir_name(catalog_path) if catalog_path else None
+        self.incremental = self.runtime_config["clust_merge"]["incremental"]
+        if self.incremental and not self.catalog_path:
+            raise ValueError("clust_merge incremental requires a catalog_path.")
+
+        # across samples, the centroids can be split into shards by minimizer (see 
+        # seq.minimizer_shards) and each shard reduced on its own; the reduced shards are then 
+        # re-sharded by their second smallest k-mer and reduced again, so that loci split by a 
+        # variant in their smallest k-mer meet, and the catalog is the union of these shards 
+        self.shards = self.runtime_config["clust_merge"]["shards"]
+        self.minimizer_k = self.runtime_config["clust_merge"]["minimizer_k"]
+        if self.shards > 1 and self.incremental:
+            raise ValueError("clust_merge shards can't be combined with incremental catalogs.")
+
         # define function to run 
-        self._func = ClusterMerge._cluster_merge_pair
+        self._func = ClusterMerge._cluster_merge_group
         self._process_func = ClusterMerge._process_clusters
 
         self.mode=mode
@@ -54,7 +96,8 @@ class ClusterMerge(Module):
             "mask_lower_case": self.mask_lower_case,
             "threads": self.threads,
             "mode" : self.mode,
-            "sample_file": True
+            "sample_file": True,
+            "deferred_hits": self.deferred_hits
         })
         chunk = os.path.basename(os.path.splitext(os.path.basename(obj))[0]).replace(".temp", "")
         try:
@@ -65,8 +108,12 @@ class ClusterMerge(Module):
         data.update({
             "chunk": chunk, 
             "chunk_id": chunk_id,
-            "sample": sample
+            "sample": sample,
+            "clusters": self.cluster_counts.get(chunk)
         })
+        if self.deferred_hits:
+            # hits tables to stitch, in merge order (within-sample hits are ignored across samples)
+            data["hits_parts"] = [obj] if self.mode == "clust_within" else []
         return data
     
 
@@ -98,14 +145,122 @@ class ClusterMerge(Module):
                 "sample_file": False,
                 "mean_depth_merged": item['mean_depth_merged'],
                 "clusters_merged": item['clusters_merged'], 
+                "clusters": item['clusters_merged'],
                 "hits_temp_path" : item["hits_temp_path"],
-                "centroid_temp_path" : item["centroid_temp_path"]
+                "centroid_temp_path" : item["centroid_temp_path"],
+                "deferred_hits": self.deferred_hits
             })
+            if "hits_parts" in item:
+                data["hits_parts"] = item["hits_parts"]
             formatted_iterdata.append(data)
         return formatted_iterdata
 
 
-    def _get_process_iterdata(self, data):
+    def _get_shard_iterdata(self, fexec, iterdata, rank=0):
+        """
+        Split the centroids of each input into minimizer shards (see _shard_centroids), and 
+        return the iterdata of the shard parts, each shard as a sample of its own.
+
+        Args:
+        - fexec (FunctionExecutor): Executor to run the splits with.
+        - iterdata (list[dict]): Iterdata of the inputs: the samples (rank 0), or the reduced 
+                                 shards (rank 1).
+        - rank (int, optional): Shard by the smallest (0) or second smallest (1) k-mer. Defaults to 0.
+
+        Returns:
+        - list[dict]: Iterdata of the shard parts, like _results_to_iterdata.
+        """
+        name = "shard" if rank == 0 else "reshard"
+        if self.deferred_hits:
+            hits_mode = None
+        else:
+            hits_mode = "empty" if rank == 0 else "split"
+        shard_iterdata = [{
+            "chunk_obj": it["chunk_obj"],
+            "config": self.lithops_config,
+            "bucket": self.bucket,
+            "remote_path": os.path.join(self.output_path, name + "s/"),
+            "shards": self.shards,
+            "k": self.minimizer_k,
+            "rank": rank,
+            "hits_mode": hits_mode,
+            "tmpdir": self.tmpdir,
+            "compression": self.compression
+        } for it in iterdata]
+        results = fexec.get_result(fs=fexec.map(ClusterMerge._shard_centroids, shard_iterdata))
+
+        parts = []
+        for it, res in zip(iterdata, results):
+            for i, (shard, (hits, clusters)) in enumerate(sorted(res["parts"].items(), key=lambda x: int(x[0]))):
+                data = self._get_iterdata(hits)
+                data.update({
+                    "chunk": f"{res['sample']}.{name}{shard}",
+                    "sample": f"catalog.{name}{shard}",
+                    "sample_file": False,
+                    "clusters": clusters
+                })
+                if self.deferred_hits and i == 0:
+                    # the hits parts of the input go along with one of its parts
+                    data["hits_parts"] = it.get("hits_parts", [])
+                parts.append(data)
+        print(f"Split {len(results)} inputs into {len(parts)} parts over {self.shards} shards")
+        return parts
+
+
+    def _get_catalog_iterdata(self, manifest):
+        """
+        Iterdata of a saved catalog, as a merged input of the across-sample merges.
+
+        The catalog objects are copied next to the other inputs first, since merges consume 
+        (delete) their merged inputs and the saved catalog is only replaced once processed.
+
+        Args:
+        - manifest (dict): The catalog manifest (see run).
+
+        Returns:
+        - dict: Iterdata for the catalog, like _results_to_iterdata.
+        """
+        chunk = "catalog_" + self._generate_filename(",".join(manifest["samples"]))
+        hits = os.path.join(self.output_path, chunk + ".hits")
+        centroids = os.path.join(self.output_path, chunk + ".centroids")
+        utils._copy_file(self.lithops_config, self.bucket, os.path.join(self.catalog_path, "catalog.hits"), hits)
+        utils._copy_file(self.lithops_config, self.bucket, os.path.join(self.catalog_path, "catalog.centroids"), centroids)
+        data = self._results_to_iterdata([{
+            "chunk": chunk,
+            "chunk_id": chunk,
+            "sample": "catalog",
+            "mean_depth_merged": manifest["mean_depth"],
+            "clusters_merged": manifest["clusters"],
+            "hits_temp_path": hits,
+            "centroid_temp_path": centroids
+        }])[0]
+        if self.deferred_hits:
+            data["hits_parts"] = [hits]
+        return data
+
+
+    def _get_process_iterdata(self, data, combine=None):
+        """
+        Iterdata of _process_clusters for each reduced sample, or for the union of the given 
+        (disjoint) reduced inputs as sample 'combine', e.g. the shards of the catalog.
+        """
+        if combine:
+            hits_parts = [part for item in data for part in item.get("hits_parts", [])]
+            return [{
+                "config": self.lithops_config,
+                "bucket": self.bucket,
+                "remote_path": self.output_path,
+                "tmpdir": self.tmpdir,
+                'min_depth': self.min_depth,
+                'max_depth': self.max_depth,
+                'sample' : combine,
+                'compression': self.compression,
+                'hits_format': self.hits_format,
+                'hits_parts': hits_parts if self.deferred_hits else None,
+                'catalog_path': self.catalog_path if self.mode == "clust_across" else None,
+                'hits_temp_path': [self._get_item_paths(item)[0] for item in data],
+                'centroid_temp_path': [self._get_item_paths(item)[1] for item in data]
+            }]
         iterdata = []
         for item in data:
             it = {
@@ -115,24 +270,29 @@ class ClusterMerge(Module):
                 "tmpdir": self.tmpdir,
                 'min_depth': self.min_depth,
                 'max_depth': self.max_depth,
-                'sample' : item["sample"]
+                'sample' : item["sample"],
+                'compression': self.compression,
+                'hits_format': self.hits_format,
+                'hits_parts': item.get("hits_parts"),
+                'catalog_path': self.catalog_path if self.mode == "clust_across" else None
             }
-            if "hits_temp_path" in item:
-                it.update({
-                    'hits_temp_path':  item['hits_temp_path'],
-                    'centroid_temp_path':  item['centroid_temp_path']
-                })
-            else:
-                hits = str(utils._get_path(item["obj"]))
-                centroids = hits.replace('.hits', '.centroids')
-                it.update({
-                    'hits_temp_path': hits,
-                    'centroid_temp_path':  centroids
-                })
+            hits, centroids = self._get_item_paths(item)
+            it.update({
+                'hits_temp_path': hits,
+                'centroid_temp_path':  centroids
+            })
             iterdata.append(it)
         return iterdata
 
 
+    def _get_item_paths(self, item):
+        """Return the hits and centroids paths of a merged (or input) item."""
+        if "hits_temp_path" in item:
+            return item['hits_temp_path'], item['centroid_temp_path']
+        hits = str(utils._get_path(item["chunk_obj"]))
+        return hits, hits.replace('.hits', '.centroids')
+
+
     def run(self):
         # Check if _func is set
         if not self._func:
@@ -145,43 +305,113 @@ class ClusterMerge(Module):
             iterdata = [self._get_iterdata(chunk) for chunk in chunks if "temp" in str(chunk) and "hits" in str(chunk)]
             num_samples = len(set(data['sample'] for data in iterdata))
         else:
-            # create iterdata 
+            # create iterdata (leaving out any catalog written by a previous run)
             iterdata = [self._get_iterdata(chunk) for chunk in chunks if "temp" not in str(chunk) and "hits" in str(chunk)]
+            iterdata = [it for it in iterdata if it["chunk"] != "catalog" and not it["chunk"].startswith("catalog_")]
+            samples = [it["chunk"] for it in iterdata]
             for it in iterdata:
                 it["sample"] = "catalog"
             num_samples = 1
 
-        # Limit the iterdata to pairs for binary reduction and keep track of remaining pairs to be processed
-        queue, pairs = self._binary_reducer_iterdata(iterdata)
-
-        # run the function until all chunks reduced
+            # add the new samples to the saved catalog, if any
+            manifest = None
+            if self.incremental and utils._remote_file_exists(self.lithops_config, self.bucket, self._catalog_manifest_path()):
+                manifest = utils._read_json(self.lithops_config, self.bucket, self._catalog_manifest_path())
+                iterdata = [it for it, sample in zip(iterdata, samples) if sample not in manifest["samples"]]
+                new_samples = [sample for sample in samples if sample not in manifest["samples"]]
+                print(f"Adding {len(new_samples)} new samples to the catalog of {len(manifest['samples'])} samples "
+                      f"in {self.catalog_path}")
+                iterdata.append(self._get_catalog_iterdata(manifest))
+                samples = new_samples
+        start = time.time()
+        sharded = self.mode == "clust_across" and self.shards > 1
+
+        # run the merges as an event loop: whenever any merge finishes, its result is queued 
+        # and the next merges of its sample planned, so each sample's reduction tree progresses 
+        # independently; a sample reduced to a single input is processed straight away 
+        processing = []
+        reduced_shards = []
         with FunctionExecutor(config=self.lithops_config) as fexec:
-            while pairs:
-                # generate unique id for filenames 
-                for pair in pairs:
-                    pair['pair_id'] = self._generate_filename(str(pair['left_obj']['chunk']) + str(pair['right_obj']['chunk']))
+            running = {}
+            queue = self._get_shard_iterdata(fexec, iterdata) if sharded else iterdata
+            while True:
+                # 1. Submit the merges that are ready 
+                queue, groups = self._plan_merges(queue)
+                for group in groups:
+                    # generate unique id for filenames 
+                    group['group_id'] = self._generate_filename("".join(str(obj['chunk']) for obj in group['objs']))
+                if groups:
+                    futures = fexec.map(self._func, groups)
+                    running.update((future, group['objs'][0]['sample']) for future, group in zip(futures, groups))
+
+                # 2. Process the samples that are fully reduced 
+                busy = set(running.values())
+                counts = defaultdict(int)
+                for item in queue:
+                    counts[item['sample']] += 1
+                reduced = [item for item in queue if item['sample'] not in busy and counts[item['sample']] == 1]
+                if reduced:
+                    if sharded:
+                        reduced_shards.extend(reduced)
+                    else:
+                        processing.extend(fexec.map(self._process_func, self._get_process_iterdata(reduced)))
+                    queue = [item for item in queue if item['sample'] in busy or counts[item['sample']] > 1]
+
+                # 3. Once all shards are reduced, re-shard them by their second smallest k-mer; 
+                # once these are reduced too, process their union as the catalog 
+                if reduced_shards and not running and not queue:
+                    if reduced_shards[0]['sample'].startswith("catalog.shard"):
+                        queue = self._get_shard_iterdata(fexec, reduced_shards, rank=1)
+                    else:
+                        processing.extend(fexec.map(self._process_func, self._get_process_iterdata(reduced_shards, combine="catalog")))
+                    reduced_shards = []
+                    continue
+                if not running:
+                    break
+
+                # 4. Wait for any merge to finish, and queue its result 
+                done, _ = fexec.wait(fs=list(running), return_when=ANY_COMPLETED, show_progressbar=False)
+                results = [future.result() for future in done]
+                for future in done:
+                    del running[future]
+                self._report_compression(results)
+                queue.extend(self._results_to_iterdata(results))
+        
+            # Check the number of result items
+            if len(processing) != num_samples or queue:
+                raise Exception(f"Expected number of result items to be {num_samples}, but got {len(processing)}")
+            self._results = fexec.get_result(fs=processing)
+
+        # save the catalog manifest, reporting the time saved by reusing a saved catalog 
+        if self.mode == "clust_across" and self.catalog_path:
+            build_time = time.time() - start
+            result = self._results[0]
+            if manifest:
+                result.update({
+                    "catalog_reused_samples": len(manifest["samples"]),
+                    "catalog_new_samples": len(samples),
+                    "catalog_saved_time": manifest["build_time"]
+                })
+                samples = manifest["samples"] + samples
+                build_time += manifest["build_time"]
+            utils._upload_json(self.lithops_config, self.bucket, self._catalog_manifest_path(), {
+                "samples": samples,
+                "clusters": result["catalog_clusters"],
+                "mean_depth": result["catalog_mean_depth"],
+                "build_time": build_time
+            })
 
-                fexec.map(self._func, pairs)
-                results = fexec.get_result()
 
-                # Add returned results to queue
-                new_iterdata = self._results_to_iterdata(results)
-                queue.extend(new_iterdata)
+    def _catalog_manifest_path(self):
+        return os.path.join(self.catalog_path, "catalog" + utils.MANIFEST_EXT)
 
-                # update queue 
-                queue, pairs = self._binary_reducer_iterdata(queue)
 
-                # if no pairs, exit loop
-        
-        # Check the number of result items
-        if len(queue) != num_samples:
-            raise Exception(f"Expected number of result items to be {num_samples}, but got {len(results)}")
-
-        # Map process_cluster step 
-        with FunctionExecutor(config=self.lithops_config) as fexec:
-            process_iterdata = self._get_process_iterdata(queue)
-            fexec.map(self._process_func, process_iterdata)
-            self._results = fexec.get_result()
+    def _report_compression(self, results):
+        """Print the mean compression ratio and time of a batch of finished merges, if compressing."""
+        ratios = [res["merge_zratio"] for res in results if "merge_zratio" in res]
+        if ratios:
+            ztime = sum(res["merge_ztime"] for res in results if "merge_ztime" in res)
+            print(f"Merge compression: mean ratio {sum(ratios) / len(ratios):.2f}, {ztime:.1f}s (de)compressing")
 
 
     def _generate_filename(self, input, length=15):
@@ -189,76 +419,122 @@ class ClusterMerge(Module):
         hashed_name = hashlib.sha1(str(input).encode()).hexdigest()[:length]
         return f"{hashed_name}"
 
-    # TODO: Would make better use of lambdas if we calculate sizes of each chunk 
-    # and group reduce steps to contain as many chunks as possible, rather than binary reduce
-    def _binary_reducer_iterdata(self, queue):
-        print("BINARY_REDUCER")
-        iterdata = []
-        kept = []
-        samples = {}
+    def _plan_merges(self, queue):
+        """
+        Plan the next merges: group the queued inputs of each sample into k-way merges.
+
+        Inputs are sorted by their number of clusters ('clusters'; unknown sizes are taken as the 
+        mean of the known ones), so similarly sized inputs are merged together, and packed into 
+        groups of up to max_fan_in inputs and max_group_clusters clusters. A sample whose inputs 
+        all fit in one group is merged in a single (final) k-way merge. Inputs that fit no group 
+        wait for the next merges; if nothing could be grouped, the two smallest inputs are merged 
+        anyway so that every sample makes progress.
+
+        Args:
+        - queue (list[dict]): Iterdata of the inputs (see _get_iterdata and _results_to_iterdata).
+
+        Returns:
+        - tuple(list[dict], list[dict]): Inputs left for later merges, and the merges to run, 
+                                         as {'objs': [...]} iterdata for _cluster_merge_group.
+        """
+        known = [item["clusters"] for item in queue if item.get("clusters") is not None]
+        default = sum(known) / len(known) if known else 1
+        size = lambda item: item["clusters"] if item.get("clusters") is not None else default
+
+        samples = defaultdict(list)
         for item in queue:
-            if item["sample"] not in samples:
-                samples[item["sample"]] = []
             samples[item["sample"]].append(item)
-        print("Queue:")
-        for key in samples.keys():
-            print(key,":", len(samples[key]))
-        for sample in samples:
-            while len(samples[sample]) > 1:
-                iterdata.append({
-                    "left_obj": samples[sample].pop(0),
-                    "right_obj": samples[sample].pop(0)
-                })
-            if len(samples[sample]) > 0:
-                kept.append(samples[sample].pop())
-        print("Pairs in work queue:", len(iterdata))
-        print("Chunks remaining:", len(kept))
-        print()
-        return kept, iterdata
+
+        groups = []
+        kept = []
+        for sample, items in samples.items():
+            if len(items) < 2:
+                kept.extend(items)
+                continue
+            items = sorted(items, key=size)
+
+            # 1. Pack consecutive (similarly sized) inputs into groups within the budgets
+            planned = []
+            group, group_size = [], 0
+            for item in items:
+                if group and (len(group) == self.max_fan_in or group_size + size(item) > self.max_group_clusters):
+                    planned.append(group)
+                    group, group_size = [], 0
+                group.append(item)
+                group_size += size(item)
+            planned.append(group)
+
+            # 2. Merge groups of two or more, keep single inputs for the next round
+            merges = [g for g in planned if len(g) > 1]
+            if not merges:
+                merges = [items[:2]]
+                planned = [items[:2]] + [[item] for item in items[2:]]
+            groups.extend({"objs": g} for g in merges)
+            kept.extend(g[0] for g in planned if len(g) == 1)
+
+        if groups:
+            print(f"Merge plan: {len(groups)} merges of {sum(len(g['objs']) for g in groups)} inputs, "
+                  f"{len(kept)} inputs waiting, over {len(samples)} samples")
+        return kept, groups
+
 
     @staticmethod 
     def _cluster_merge_pair(left_obj, right_obj, pair_id):
+        """Merge two inputs (see _cluster_merge_group)."""
+        return ClusterMerge._cluster_merge_group([left_obj, right_obj], pair_id)
 
-        # Extract main parameters from left_obj
-        config = left_obj["config"]
-        bucket = left_obj["bucket"]
-        cov = left_obj["cov"]
-        mode = left_obj["mode"]
-        identity = left_obj["identity"]  # Ensure this key is consistent
-        cov_mode = left_obj["cov_mode"]
-        mask = left_obj["mask"]
-        mask_lower_case = left_obj["mask_lower_case"]
-        threads = left_obj["threads"]
-        sample = left_obj["sample"]  
-        remote_path = left_obj["remote_path"]
-        tmpdir = left_obj["tmpdir"] or None
+
+    @staticmethod 
+    def _cluster_merge_group(objs, group_id):
+        """
+        Merge the clusters of k inputs of a sample (or of the catalog): cluster their joined 
+        centroids with mmseqs easy-linclust and merge their hits tables through the result 
+        (or, with deferred hits, only upload the resulting edge list).
+
+        Args:
+        - objs (list[dict]): Iterdata of the inputs; parameters are read from the first one.
+        - group_id (str): Unique name for the merged outputs.
+
+        Returns:
+        - dict: The merged chunk, with the paths of its centroids and hits and its cluster stats.
+        """
+        # Extract main parameters from the first input
+        first = objs[0]
+        config = first["config"]
+        bucket = first["bucket"]
+        cov = first["cov"]
+        mode = first["mode"]
+        identity = first["identity"]  # Ensure this key is consistent
+        cov_mode = first["cov_mode"]
+        mask = first["mask"]
+        mask_lower_case = first["mask_lower_case"]
+        threads = first["threads"]
+        sample = first["sample"]  
+        remote_path = first["remote_path"]
+        tmpdir = first["tmpdir"] or None
+        compression = first.get("compression")
+        deferred = first.get("deferred_hits", False)
+        stats = zstd_utils.CompressionStats()
 
         # Set working directory
         tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
         os.chdir(tmpdir)
 
-        # Download files and set up local environment
-        left_hits = str(utils._get_path(left_obj["obj"]))
-        left_centroids = left_hits.replace('.hits', '.centroids')
-        right_hits = str(utils._get_path(right_obj["obj"]))
-        right_centroids = right_hits.replace('.hits', '.centroids')
-        utils._download_file(config, bucket, left_centroids, os.path.join(tmpdir, str(pair_id)+"left.centroids"))
-        utils._download_file(config, bucket, right_centroids, os.path.join(tmpdir, str(pair_id)+"right.centroids"))
+        # Inputs
+        input_hits = [str(utils._get_path(obj["chunk_obj"])) for obj in objs]
+        input_centroids = [hits.replace('.hits', '.centroids') for hits in input_hits]
 
         # Create a new sub-directory for MMSEQS2 temporary files
-        out_prefix = os.path.join(tmpdir, str(pair_id))
+        out_prefix = os.path.join(tmpdir, str(group_id))
         mmseqs_tmp_dir = os.path.join(tmpdir, out_prefix)
         if os.path.exists(mmseqs_tmp_dir):
             shutil.rmtree(mmseqs_tmp_dir) 
         os.makedirs(mmseqs_tmp_dir)
 
-        # write concatenated centroids
+        # download the centroids straight into one file, which mmseqs needs on disk 
         # TODO: Should we sort centroids before clustering?
-        fasta_files = [os.path.join(tmpdir, str(pair_id)+"left.centroids"), os.path.join(tmpdir, str(pair_id)+"right.centroids")]
         joined_centroids = out_prefix+".joined.fasta"
-        utils.concat_files(fasta_files, joined_centroids)
-        os.remove(os.path.join(tmpdir, str(pair_id)+"left.centroids"))
-        os.remove(os.path.join(tmpdir, str(pair_id)+"right.centroids"))
+        utils._download_files(config, bucket, input_centroids, joined_centroids, stats=stats)
 
         # run clustering on joined centroids 
         cmd = [
@@ -296,118 +572,217 @@ class ClusterMerge(Module):
         os.remove(out_prefix + "_rep_seq.fasta")
         os.remove(out_prefix + "_all_seqs.fasta")
 
-        # Upload hits results 
-        int_hits_path = os.path.join(out_prefix + ".int.h")
-        mmseqs_utils.write_hits(hits, int_hits_path)
-        if mode == "clust_within":
-            utils._download_file(config, bucket, left_hits, os.path.join(tmpdir, str(pair_id)+"left.hits"))
-            utils._download_file(config, bucket, right_hits, os.path.join(tmpdir, str(pair_id)+"right.hits"))
+        # Deferred: only upload the edge list, and leave the input hits in place 
+        hits_remote_path = os.path.join(remote_path, str(group_id)+ ".hits")
+        if deferred:
+            edges_remote_path = os.path.join(remote_path, str(group_id) + ".edges")
+            edges_temp_path = os.path.join(tmpdir, str(group_id) + ".edges")
+            mmseqs_utils.write_hits(hits, edges_temp_path, binary=True)
+            utils._upload_file(config, bucket, edges_remote_path, edges_temp_path, compression=compression, stats=stats)
+            os.remove(edges_temp_path)
+
+        # Merge the hits of the centroids with the input hits tables 
         else:
-            # if clustering across, ignore within-sample hits by creating empty hits files 
-            if left_obj["sample_file"]:
-                utils.touch_file(str(pair_id)+"left.hits")
-            else:
-                utils._download_file(config, bucket, left_hits, os.path.join(tmpdir, str(pair_id)+"left.hits"))
-            if right_obj["sample_file"]:
-                utils.touch_file(str(pair_id)+"right.hits")
-            else:
-                utils._download_file(config, bucket, right_hits, os.path.join(tmpdir, str(pair_id)+"right.hits"))
-        joined_hits = mmseqs_utils.make_merged_hits_table(os.path.join(tmpdir, str(pair_id)+"left.hits"),
-                                                          os.path.join(tmpdir, str(pair_id)+"right.hits"),
-                                                          int_hits_path)
-        os.remove(int_hits_path)
-        os.remove(os.path.join(tmpdir, str(pair_id)+"left.hits"))
-        os.remove(os.path.join(tmpdir, str(pair_id)+"right.hits"))
-        hits_remote_path = os.path.join(remote_path, str(pair_id)+ ".hits")
-        hits_temp_path = os.path.join(tmpdir, str(pair_id)+"joined.hits")
-        mmseqs_utils.write_hits(joined_hits, hits_temp_path)
-        utils._upload_file(config, 
-                            bucket, 
-                            hits_remote_path, 
-                            os.path.join(tmpdir, str(pair_id)+"joined.hits"))
-        os.remove(hits_temp_path)
+            local_hits = []
+            for i, (obj, hits_path) in enumerate(zip(objs, input_hits)):
+                local_hits.append(os.path.join(tmpdir, f"{group_id}_{i}.hits"))
+                if mode == "clust_across" and obj["sample_file"]:
+                    # if clustering across, ignore within-sample hits by creating empty hits files 
+                    utils.touch_file(local_hits[-1])
+                else:
+                    utils._download_file(config, bucket, hits_path, local_hits[-1], stats=stats)
+            joined_hits = mmseqs_utils.merge_hits_tables(local_hits, hits)
+            for path in local_hits:
+                os.remove(path)
+            hits_temp_path = os.path.join(tmpdir, str(group_id)+"joined.hits")
+            mmseqs_utils.write_hits(joined_hits, hits_temp_path, binary=True)
+            utils._upload_file(config, 
+                                bucket, 
+                                hits_remote_path, 
+                                hits_temp_path,
+                                compression=compression,
+                                stats=stats)
+            os.remove(hits_temp_path)
         
         # upload centroids 
-        centroids_temp_path = os.path.join(tmpdir, str(pair_id)+"joined.centroids")
-        centroids_remote_path = os.path.join(remote_path, str(pair_id)+".centroids")
+        centroids_temp_path = os.path.join(tmpdir, str(group_id)+"joined.centroids")
+        centroids_remote_path = os.path.join(remote_path, str(group_id)+".centroids")
         seq.write_fasta(centroids, centroids_temp_path)
         utils._upload_file(config, 
                             bucket, 
                             centroids_remote_path, 
-                            centroids_temp_path)
+                            centroids_temp_path,
+                            compression=compression,
+                            stats=stats)
         centroids_num, cluster_depth = mmseqs_utils.get_cluster_info(centroids_temp_path)
         os.remove(centroids_temp_path)
         shutil.rmtree(mmseqs_tmp_dir) 
 
-        # delete left and right files from buckets 
-        if mode == "clust_within":
-            for f in [left_hits, left_centroids, right_hits, right_centroids]:
-                utils._delete_file(config, bucket, f)
-        else:
-            if not left_obj["sample_file"]:
-                for f in [left_hits, left_centroids]:
-                    utils._delete_file(config, bucket, f)
-            if not right_obj["sample_file"]:
-                for f in [right_hits, right_centroids]:
-                    utils._delete_file(config, bucket, f)
+        # delete the inputs from buckets (sample files are kept when clustering across, 
+        # and deferred hits parts are deleted once stitched)
+        consumed = []
+        for obj, hits_path, centroids_path in zip(objs, input_hits, input_centroids):
+            if mode == "clust_across" and obj["sample_file"]:
+                continue
+            consumed.extend([centroids_path] + ([] if deferred else [hits_path]))
+        utils._delete_files(config, bucket, consumed)
             
-        return {
-            "chunk": pair_id,
-            "chunk_id": pair_id,
+        result = {
+            "chunk": group_id,
+            "chunk_id": group_id,
             "sample": sample, 
             "centroid_temp_path": centroids_remote_path,
             "hits_temp_path": hits_remote_path,
             "mean_depth_merged": cluster_depth,
-            "clusters_merged": centroids_num
+            "clusters_merged": centroids_num,
+            "fan_in": len(objs),
+            **stats.as_dict("merge")
         }
+        if deferred:
+            # hits_temp_path is never written; it only names the merged centroids 
+            result["hits_parts"] = [part for obj in objs for part in obj["hits_parts"]] + [edges_remote_path]
+        return result
     
-    def _process_clusters(config, bucket, remote_path, tmpdir, min_depth, max_depth, sample, hits_temp_path, centroid_temp_path):
-        # Set working directory
-        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
-        os.chdir(tmpdir)
+    @staticmethod 
+    def _shard_centroids(chunk_obj, config, bucket, remote_path, shards, k, rank=0, hits_mode=None, tmpdir=None, compression=None):
+        """
+        Split the centroids of an input into shards by their smallest (or second smallest) 
+        canonical k-mer (see seq.minimizer_shards), as '<remote_path><shard>/<name>.centroids'.
 
-        # Dictionary to store valid FASTA records
-        valid_records = {}
-        current_header = None
-        
-        for line in utils._stream_file(config, bucket, centroid_temp_path):
-            # If line is a header
+        Args:
+        - chunk_obj (CloudObject): The input's hits (its centroids are next to them).
+        - shards (int): Number of shards.
+        - k (int): K-mer length.
+        - rank (int, optional): Index of the k-mer to shard by. Defaults to 0.
+        - hits_mode (str, optional): 'empty' to write an empty '.hits' object for each part, 
+                                     'split' to split the input's hits by centroid with them, 
+                                     or None to write none (deferred hits). Defaults to None.
+
+        Returns:
+        - dict: The input's name and its parts, as {shard: [hits path, number of centroids]}.
+        """
+        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
+        hits = str(utils._get_path(chunk_obj))
+        name = os.path.basename(os.path.splitext(hits)[0])
+
+        # 1. Assign each centroid to the shard of its k-mer
+        records = defaultdict(list)
+        shard_of = {}
+        header = None
+        for line in utils._stream_file(config, bucket, hits.replace('.hits', '.centroids')):
             if line.startswith('>'):
-                line = line.replace(">","")
-                size = mmseqs_utils.get_size_from_key(line)
-                
-                # If size is within range
-                if min_depth <= size <= max_depth:
-                    current_header = line
-                    valid_records[current_header] = ""
-                else:
-                    current_header = None
-            elif current_header:  # If the line is part of a valid record
-                valid_records[current_header] += line + '\n'
+                header = line
+            elif header:
+                shard = seq.minimizer_shards(line, k, shards, n=rank + 1)[-1]
+                records[shard].append(f"{header}\n{line}\n")
+                shard_of[header[1:].split(";")[0]] = shard
+                header = None
+
+        # 2. Split the hits with their centroids (resolved first, so each row is a centroid's)
+        split_hits = defaultdict(dict)
+        if hits_mode == "split":
+            local_hits = os.path.join(tmpdir, name + ".shard.hits")
+            utils._download_file(config, bucket, hits, local_hits)
+            for centroid, members in mmseqs_utils.resolve_hits(mmseqs_utils.load_hits(local_hits, mmap=False)).items():
+                split_hits[shard_of[centroid]][centroid] = members
+            os.remove(local_hits)
+
+        # 3. Upload the parts
+        parts = {}
+        for shard, shard_records in records.items():
+            part = os.path.join(remote_path, str(shard), name + ".hits")
+            utils._upload_file_from_stream(config, bucket, part.replace('.hits', '.centroids'), "".join(shard_records), 
+                                           compression=compression)
+            if hits_mode == "empty":
+                utils._upload_file_from_stream(config, bucket, part, "", compression=compression)
+            elif hits_mode == "split":
+                local_part = os.path.join(tmpdir, f"{name}.{shard}.shard.hits")
+                mmseqs_utils.write_hits(split_hits[shard], local_part, binary=True)
+                utils._upload_file(config, bucket, part, local_part, compression=compression)
+                os.remove(local_part)
+            parts[shard] = [part, len(shard_records)]
+        if rank > 0:
+            # re-sharded inputs are merged ones, which are consumed
+            utils._delete_files(config, bucket, [hits.replace('.hits', '.centroids')] + ([hits] if hits_mode == "split" else []))
+        return {
+            "sample": name,
+            "parts": parts
+        }
 
-        # Writing valid FASTA records to a local file
-        new_temp_file = os.path.join(tmpdir, f"{sample}_temp_centroids.fasta")
-        seq.write_fasta(valid_records, new_temp_file)
 
-        # Parse cluster number and sizes from the new file
-        centroids_num, cluster_depth = mmseqs_utils.get_cluster_info(new_temp_file)
+    def _process_clusters(config, bucket, remote_path, tmpdir, min_depth, max_depth, sample, hits_temp_path, centroid_temp_path, 
+                          compression=None, hits_format="text", hits_parts=None, catalog_path=None):
+        # Set working directory
+        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
+        os.chdir(tmpdir)
 
-        # Upload new centroids file 
-        centroids_new_path = os.path.join(remote_path, f"{sample}.centroids")
-        utils._delete_file(config, bucket, centroid_temp_path)
-        utils._upload_file(config, bucket, centroids_new_path, new_temp_file)
-        os.remove(new_temp_file)
+        # the union of several (disjoint) inputs can be processed at once 
+        centroid_paths = centroid_temp_path if isinstance(centroid_temp_path, list) else [centroid_temp_path]
+        hits_paths = hits_temp_path if isinstance(hits_temp_path, list) else [hits_temp_path]
 
-        # Rename the old hits file
+        # Stream the centroids through the depth filter into the upload (and, if saving the 
+        # catalog, all of them into the catalog), counting clusters and depths on the way 
+        centroids_new_path = os.path.join(remote_path, f"{sample}.centroids")
+        stats = zstd_utils.CompressionStats()
+        centroids_num = total_depth = catalog_clusters = catalog_total_depth = 0
+        with ExitStack() as stack:
+            out = stack.enter_context(pipe_utils.StreamingUpload(config, bucket, centroids_new_path, 
+                                                                 compression=compression, stats=stats))
+            catalog_out = None
+            if catalog_path:
+                catalog_out = stack.enter_context(pipe_utils.StreamingUpload(config, bucket, os.path.join(catalog_path, "catalog.centroids"), 
+                                                                             compression=compression))
+            valid = False
+            for line in chain.from_iterable(utils._stream_file(config, bucket, path) for path in centroid_paths):
+                record = (line + "\n").encode("utf-8")
+                if line.startswith('>'):
+                    size = mmseqs_utils.get_size_from_key(line[1:])
+                    valid = min_depth <= size <= max_depth
+                    if valid:
+                        centroids_num += 1
+                        total_depth += size
+                    if catalog_out is not None:
+                        catalog_clusters += 1
+                        catalog_total_depth += size
+                if valid:
+                    out.write(record)
+                if catalog_out is not None:
+                    catalog_out.write(record)
+        cluster_depth = total_depth / centroids_num if centroids_num else 0
+        catalog_depth = catalog_total_depth / catalog_clusters if catalog_clusters else 0
+        utils._delete_files(config, bucket, [path for path in centroid_paths if path != centroids_new_path])
+
+        # Resolve the merged links (or stitch the deferred hits parts) into the final hits table 
+        # (see mmseqs_utils.resolve_hits) 
         hits_new_path = os.path.join(remote_path, f"{sample}.hits")
-        utils._rename_file(config, bucket, hits_temp_path, hits_new_path)
+        parts = hits_parts if hits_parts is not None else hits_paths
+        local_parts = []
+        for i, part in enumerate(parts):
+            local_parts.append(os.path.join(tmpdir, f"{sample}_{i}_temp.hits"))
+            utils._download_file(config, bucket, part, local_parts[-1], stats=stats)
+        hits = mmseqs_utils.resolve_hits(*[mmseqs_utils.load_hits(p, mmap=False) for p in local_parts])
+        hits_local = os.path.join(tmpdir, f"{sample}_temp.hits")
+        mmseqs_utils.write_hits(hits, hits_local, binary=(hits_format == "binary"))
+        utils._upload_file(config, bucket, hits_new_path, hits_local, compression=compression, stats=stats)
+        if catalog_path:
+            utils._upload_file(config, bucket, os.path.join(catalog_path, "catalog.hits"), hits_local, compression=compression)
+        utils._delete_files(config, bucket, [part for part in parts if part != hits_new_path])
+        for local_part in local_parts:
+            os.remove(local_part)
+        os.remove(hits_local)
 
         # Format the results
         formatted_results = {
             "sample": sample,
             "mean_depth_merged": cluster_depth,
-            "clusters_merged": centroids_num
+            "clusters_merged": centroids_num,
+            **stats.as_dict("process")
         }
+        if catalog_path:
+            formatted_results.update({
+                "catalog_clusters": catalog_clusters,
+                "catalog_mean_depth": catalog_depth
+            })
         
         return formatted_results
 
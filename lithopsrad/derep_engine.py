@@ -0,0 +1,239 @@
+import os
+import sys
+import time
+import heapq
+import hashlib
+import tempfile
+import subprocess as sp
+
+import lithopsrad.sequence as seq
+
+# 2-bit codes for packing ACGT-only sequences into an int
+PACK_TABLE = bytes.maketrans(b"ACGT", b"0123")
+COMP_TABLE = bytes.maketrans(b"ACGTNRYSWKMBDHVacgtnryswkmbdhv", b"TGCANYRSWMKVHDBtgcanyrswmkvhdb")
+ACGT = frozenset(b"ACGT")
+
+
+def pack_key(sequence):
+    """
+    Dereplication key of an (uppercase) sequence.
+
+    ACGT-only sequences are packed 2 bits per base into an int, with a leading sentinel
+    digit so that sequences of different lengths differ; anything else (e.g. with Ns)
+    falls back to a 128-bit blake2b digest.
+    """
+    if ACGT.issuperset(sequence):
+        return int(b"1" + sequence.translate(PACK_TABLE), 4)
+    return hashlib.blake2b(sequence, digest_size=16).digest()
+
+
+def revcomp_bytes(sequence):
+    """Reverse complement a sequence (bytes), preserving case."""
+    return sequence.translate(COMP_TABLE)[::-1]
+
+
+class Dereplicator:
+    """
+    In-process equivalent of vsearch -fastx_uniques.
+
+    Reads are keyed by their 2-bit packed sequence (see pack_key), case-insensitively and,
+    with strand 'both', by the smaller key of the read and its reverse complement. Each
+    unique keeps the first sequence and quality seen for it, its abundance, and the order
+    in which it was first seen (the tie-break when sorting by abundance, as in vsearch).
+
+    Memory is bounded by max_uniques: beyond it, the uniques are spilled to a local file
+    as a run sorted by key, and the runs are merged with a heap when writing the output.
+    """
+    def __init__(self, strand="plus", max_uniques=1000000, tmpdir=None):
+        self.strand = strand
+        self.max_uniques = max_uniques
+        self.tmpdir = tmpdir or tempfile.gettempdir()
+        self.reads = 0
+        self._uniques = {}
+        self._runs = []
+        self._order = 0
+
+
+    def _key(self, sequence):
+        key = pack_key(sequence.upper())
+        if self.strand == "both":
+            # a read and its reverse complement are either both ACGT-only or both not
+            key = min(key, pack_key(revcomp_bytes(sequence).upper()))
+        return key
+
+
+    def add(self, sequence, quality, size=1):
+        """
+        Add a read.
+
+        Args:
+        - sequence (bytes): The read sequence.
+        - quality (bytes): The read quality string (b"" for FASTA).
+        - size (int, optional): Abundance of the read. Defaults to 1.
+        """
+        self.reads += size
+        key = self._key(sequence)
+        unique = self._uniques.get(key)
+        if unique is None:
+            self._uniques[key] = [size, self._order, sequence, quality]
+            self._order += 1
+            if len(self._uniques) >= self.max_uniques:
+                self._spill()
+        else:
+            unique[0] += size
+
+
+    def add_fastq(self, stream):
+        """Add all reads from a FASTQ byte stream (see seq.iter_fastq_records)."""
+        for record in seq.iter_fastq_records(stream):
+            if not record.strip():
+                continue
+            _, sequence, _, quality = record.split(b"\n", 4)[:4]
+            self.add(sequence, quality)
+
+
+    def _spill(self):
+        """Write the uniques held in memory to a local run file, sorted by key."""
+        # runs are sorted (and merged) by the hex-encoded key
+        encoded = sorted((self._encode_key(key), unique) for key, unique in self._uniques.items())
+        fd, path = tempfile.mkstemp(suffix=".run", dir=self.tmpdir)
+        with os.fdopen(fd, "wb") as fh:
+            for key, (size, order, sequence, quality) in encoded:
+                fh.write(b"%s\t%d\t%d\t%s\t%s\n" % (key, size, order, sequence, quality))
+        self._runs.append(path)
+        self._uniques = {}
+
+
+    @staticmethod
+    def _encode_key(key):
+        return b"%x" % key if isinstance(key, int) else b"h" + key.hex().encode()
+
+
+    def _iter_run(self, path):
+        with open(path, "rb") as fh:
+            for line in fh:
+                key, size, order, sequence, quality = line.rstrip(b"\n").split(b"\t")
+                yield key, int(size), int(order), sequence, quality
+
+
+    def _iter_merged(self):
+        """Merge the spilled runs (and what's left in memory), summing the counts of equal keys."""
+        self._spill()
+        current = None
+        for key, size, order, sequence, quality in heapq.merge(*(self._iter_run(p) for p in self._runs)):
+            if current is not None and current[0] == key:
+                current[1] += size
+                if order < current[2]:
+                    current[2:] = [order, sequence, quality]
+                continue
+            if current is not None:
+                yield current[1:]
+            current = [key, size, order, sequence, quality]
+        if current is not None:
+            yield current[1:]
+        for path in self._runs:
+            os.remove(path)
+        self._runs = []
+
+
+    def iter_uniques(self, minuniquesize=1, maxuniquesize=None):
+        """
+        Iterate over the uniques within the size limits, most abundant first.
+
+        Yields:
+        - tuple(bytes, bytes, int): Sequence, quality and abundance of the next unique.
+        """
+        maxuniquesize = maxuniquesize or sys.maxsize
+        if not self._runs:
+            uniques = sorted((u for u in self._uniques.values() if minuniquesize <= u[0] <= maxuniquesize),
+                             key=lambda u: (-u[0], u[1]))
+            self._uniques = {}
+            for size, _, sequence, quality in uniques:
+                yield sequence, quality, size
+            return
+
+        # spilled: merge the runs into a local file, then sort only (size, order, offset) in memory
+        fd, path = tempfile.mkstemp(suffix=".merged", dir=self.tmpdir)
+        index = []
+        with os.fdopen(fd, "wb") as fh:
+            for size, order, sequence, quality in self._iter_merged():
+                if minuniquesize <= size <= maxuniquesize:
+                    index.append((-size, order, fh.tell()))
+                    fh.write(sequence + b"\t" + quality + b"\n")
+        index.sort()
+        with open(path, "rb") as fh:
+            for neg_size, _, offset in index:
+                fh.seek(offset)
+                sequence, quality = fh.readline().rstrip(b"\n").split(b"\t")
+                yield sequence, quality, -neg_size
+        os.remove(path)
+
+
+    def write(self, out, label, minuniquesize=1, maxuniquesize=None):
+        """
+        Write the uniques as FASTQ (or FASTA, for uniques without quality) relabelled
+        '<label><n>;size=<abundance>', like vsearch -relabel <label> -sizeout. Each unique
+        has the quality of the first read seen for it.
+
+        Args:
+        - out: Binary stream to write to.
+        - label (str): Label prefix.
+
+        Returns:
+        - int: Number of uniques written.
+        """
+        label = label.encode("utf-8")
+        n = 0
+        for n, (sequence, quality, size) in enumerate(self.iter_uniques(minuniquesize, maxuniquesize), 1):
+            if quality:
+                out.write(b"@%s%d;size=%d\n%s\n+\n%s\n" % (label, n, size, sequence, quality))
+            else:
+                out.write(b">%s%d;size=%d\n%s\n" % (label, n, size, sequence))
+        return n
+
+
+def _synthetic_rad_reads(path, loci=20000, mean_depth=10, length=150, error_rate=0.002, seed=1):
+    """Write synthetic single-end RAD reads (shared cut site, Poisson-ish depth, substitution errors) as FASTQ."""
+    import random
+    rng = random.Random(seed)
+    reads = 0
+    with open(path, "wb") as fh:
+        for locus in range(loci):
+            template = b"TGCAG" + bytes(rng.choice(b"ACGT") for _ in range(length - 5))
+            for _ in range(max(1, int(rng.expovariate(1 / mean_depth)))):
+                read = bytearray(template)
+                for i in range(5, length):
+                    if rng.random() < error_rate:
+                        read[i] = rng.choice(b"ACGT")
+                fh.write(b"@r%d\n%s\n+\n%s\n" % (reads, bytes(read), b"I" * length))
+                reads += 1
+    return reads
+
+
+if __name__ == "__main__":
+    # Benchmark against vsearch -fastx_uniques on synthetic RAD reads:
+    #   python -m lithopsrad.derep_engine [loci] [max_uniques]
+    loci = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    max_uniques = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    tmpdir = tempfile.mkdtemp()
+    reads_path = os.path.join(tmpdir, "reads.fastq")
+    nreads = _synthetic_rad_reads(reads_path, loci=loci)
+    print(f"{nreads} reads from {loci} loci")
+
+    start = time.time()
+    derep = Dereplicator(strand="plus", max_uniques=max_uniques, tmpdir=tmpdir)
+    with open(reads_path, "rb") as fh:
+        derep.add_fastq(fh)
+    with open(os.path.join(tmpdir, "python.derep"), "wb") as out:
+        uniques = derep.write(out, "d")
+    print(f"python: {uniques} uniques in {time.time() - start:.2f}s ({len(derep._runs)} runs left)")
+
+    try:
+        start = time.time()
+        sp.run(["vsearch", "-fastx_uniques", reads_path, "-fastqout", os.path.join(tmpdir, "vsearch.derep"),
+                "-strand", "plus", "-relabel", "d", "-sizeout", "-threads", "1"],
+               check=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        uniques = seq.count_fastq_records(file_path=os.path.join(tmpdir, "vsearch.derep"))
+        print(f"vsearch: {uniques} uniques in {time.time() - start:.2f}s (incl. re-count)")
+    except (FileNotFoundError, sp.CalledProcessError) as e:
+        print(f"vsearch: not run ({e})")
@@ -0,0 +1,193 @@
+import os
+import sys
+import zlib
+from collections import defaultdict
+from contextlib import ExitStack
+
+from lithops import FunctionExecutor
+
+from lithopsrad.module import Module, time_it
+import lithopsrad.sequence as seq
+import lithopsrad.utils as utils
+import lithopsrad.pipe_utils as pipe_utils
+
+
+class DerepReduce(Module):
+    """
+    Dereplicates each sample across its chunks, after FASTQDerep has dereplicated the
+    chunks one by one, so that a read seen in many chunks is only clustered once.
+
+    Mappers hash-partition the uniques of a chunk by sequence into per-sample shards;
+    reducers sum the ';size=' counts of each shard and write it as '<shard>_<sample>.derep'
+    (named like a chunk, so ClusterMap and ClusterMerge handle it as one).
+    """
+    def __init__(self, lithops_config, runtime_config):
+        super().__init__(lithops_config, runtime_config)
+        self.setup()
+
+
+    def setup(self):
+        # Remote paths
+        self.run_path = utils.fix_dir_name(self.runtime_config["remote_paths"]["run_path"])
+        self.input_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["fastq_dereps"]))
+        self.output_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["fastq_uniques"]))
+        self.parts_path = os.path.join(self.run_path, "derep_parts/")
+        self.cleanup_paths = [self.output_path, self.parts_path]
+
+        # number of hash shards per sample, more keeps reducers smaller for deep samples
+        self.shards = self.runtime_config["derep_reduce"]["shards"]
+
+        # size limits apply to the sample-level counts (see FASTQDerep.setup)
+        self.maxuniquesize = self.runtime_config["derep"]["maxuniquesize"]
+        self.minuniquesize = self.runtime_config["derep"]["minuniquesize"]
+        self.strand = self.runtime_config["derep"]["strand"]
+
+        # define map and reduce functions
+        self._func = DerepReduce._partition_uniques
+        self._reduce_func = DerepReduce._reduce_uniques
+
+
+    def _get_iterdata(self, obj):
+        data = super()._get_iterdata(obj)
+        data.update({
+            "parts_path": self.parts_path,
+            "shards": self.shards,
+            "strand": self.strand
+        })
+        return data
+
+
+    def _get_reduce_iterdata(self, sample, shard, parts):
+        return {
+            "parts": parts,
+            "sample": sample,
+            "shard": shard,
+            "config": self.lithops_config,
+            "bucket": self.bucket,
+            "remote_path": self.output_path,
+            "maxuniquesize": self.maxuniquesize,
+            "minuniquesize": self.minuniquesize,
+            "compression": self.compression
+        }
+
+
+    @time_it
+    def run(self):
+        chunks = self.list_input_chunks(self.input_path)
+        iterdata = [self._get_iterdata(chunk) for chunk in chunks]
+
+        with FunctionExecutor(config=self.lithops_config) as fexec:
+            # 1. Partition each chunk's uniques into shards
+            fexec.map(self._func, iterdata)
+            partitions = fexec.get_result()
+
+            # 2. Sum the counts of each (sample, shard)
+            parts = defaultdict(list)
+            for res in partitions:
+                for shard, part in res["parts"].items():
+                    parts[(res["sample"], int(shard))].append(part)
+            reduce_iterdata = [self._get_reduce_iterdata(sample, shard, paths) for (sample, shard), paths in sorted(parts.items())]
+            fexec.map(self._reduce_func, reduce_iterdata)
+            reduced = fexec.get_result()
+
+        # Report per sample
+        chunk_uniques = defaultdict(int)
+        for res in partitions:
+            chunk_uniques[res["sample"]] += res["uniques"]
+        sample_uniques = defaultdict(int)
+        for res in reduced:
+            sample_uniques[res["sample"]] += res["uniques"]
+        self._results = [{
+            "sample": sample,
+            "reduced_size": sample_uniques[sample],
+            "derep_redundancy": chunk_uniques[sample] / sample_uniques[sample] if sample_uniques[sample] else None
+        } for sample in sorted(chunk_uniques)]
+
+
+    @staticmethod
+    def _get_key(sequence, strand):
+        """Return the dereplication key of a sequence: case-insensitive, canonical over both strands if strand is 'both'."""
+        key = sequence.upper()
+        if strand == "both":
+            key = min(key, seq.revcomp(key))
+        return key
+
+
+    @staticmethod
+    def _partition_uniques(chunk_obj, config, bucket, remote_path, parts_path, shards, strand, tmpdir=None, compression=None):
+        """
+        Split the uniques of a dereplicated chunk into hash shards.
+
+        Each shard is written as a '<parts_path><sample>/<shard>/<chunk>.part' object of
+        'key\\tsize\\tsequence\\tquality' lines, keeping the sequence and quality of the
+        unique as written by vsearch (with an empty quality for FASTA dereps).
+        """
+        derep = utils._get_path(chunk_obj)
+        chunk_id = os.path.basename(os.path.splitext(derep)[0])
+        sample = chunk_id.split("_", 1)[1] if "_" in chunk_id else chunk_id
+
+        # 1. Stream the uniques into shards, by a stable hash of their key, each shard
+        # uploaded as it is written (opened on its first unique)
+        uploads = {}
+        parts = {}
+        uniques = 0
+        with ExitStack() as stack:
+            for header, sequence, quality in seq.iter_fastx_records(utils._open_fastq_stream(config, bucket, derep)):
+                header, sequence, quality = header.decode("utf-8"), sequence.decode("utf-8"), quality.decode("utf-8")
+                key = DerepReduce._get_key(sequence, strand)
+                shard = zlib.crc32(key.encode("utf-8")) % shards
+                if shard not in uploads:
+                    parts[shard] = os.path.join(parts_path, sample, str(shard), chunk_id + ".part")
+                    uploads[shard] = stack.enter_context(
+                        pipe_utils.StreamingUpload(config, bucket, parts[shard], compression=compression))
+                uploads[shard].write(f"{key}\t{seq.extract_size(header)}\t{sequence}\t{quality}\n".encode("utf-8"))
+                uniques += 1
+
+        return {
+            "chunk": chunk_id,
+            "sample": sample,
+            "uniques": uniques,
+            "parts": parts
+        }
+
+
+    @staticmethod
+    def _reduce_uniques(parts, sample, shard, config, bucket, remote_path, maxuniquesize, minuniquesize, compression=None):
+        """
+        Sum the counts of the uniques of one (sample, shard) and write them, most abundant
+        first and relabelled '<shard>_<sample>_d<n>;size=<count>', as FASTQ like vsearch
+        -fastx_uniques (or FASTA, if the dereps were FASTA). The part objects are deleted once reduced.
+        """
+        # 1. Sum counts, keeping the first sequence/quality seen for each key
+        sizes = defaultdict(int)
+        records = {}
+        for part in parts:
+            for line in utils._stream_file(config, bucket, part):
+                # (lines are stripped, so FASTA parts have no quality field left)
+                key, size, sequence, quality = (line.split("\t") + [""])[:4]
+                sizes[key] += int(size)
+                if key not in records:
+                    records[key] = (sequence, quality)
+
+        # 2. Write uniques within the size limits, streamed into the upload
+        chunk_id = f"{shard}_{sample}"
+        derep_path = os.path.join(remote_path, chunk_id + ".derep")
+        uniques = 0
+        with pipe_utils.StreamingUpload(config, bucket, derep_path, compression=compression) as out:
+            for key, size in sorted(sizes.items(), key=lambda x: (-x[1], x[0])):
+                sequence, quality = records.pop(key)
+                if not minuniquesize <= size <= maxuniquesize:
+                    continue
+                uniques += 1
+                if quality:
+                    out.write(f"@{chunk_id}_d{uniques};size={size}\n{sequence}\n+\n{quality}\n".encode("utf-8"))
+                else:
+                    out.write(f">{chunk_id}_d{uniques};size={size}\n{sequence}\n".encode("utf-8"))
+
+        # 3. Clean up
+        utils._delete_files(config, bucket, parts)
+        return {
+            "chunk": chunk_id,
+            "sample": sample,
+            "uniques": uniques
+        }
@@ -1,5 +1,7 @@
 import os 
 import sys 
+import math
+import hashlib
 
 import pandas as pd 
 from lithops import FunctionExecutor
@@ -7,6 +9,13 @@ from lithops import FunctionExecutor
 from lithopsrad.module import Module, time_it
 import lithopsrad.sequence as seq
 import lithopsrad.utils as utils
+import lithopsrad.gzip_utils as gzip_utils
+
+# rough compression ratio of gzipped FASTQ, used to estimate the uncompressed size of an input
+GZIP_RATIO = 4
+
+# fraction of the worker memory a chunk may take up, leaving room for vsearch/mmseqs
+MEMORY_FRACTION = 0.25
 
 class FASTQChunker(Module):
     def __init__(self, lithops_config, runtime_config):
@@ -27,9 +36,26 @@ class FASTQChunker(Module):
         self.overwrite_fastq = self.runtime_config["input"]["overwrite_fastq"]
         self.overwrite_chunks = self.runtime_config["input"]["overwrite_chunks"]
 
+        # 'copy' re-uploads each chunk as its own object, 'virtual' only writes a 
+        # byte-range manifest per FASTQ that downstream modules read with ranged GETs
+        self.chunk_mode = self.runtime_config["input"]["chunk_mode"]
+        if self.chunk_mode not in ("copy", "virtual"):
+            raise ValueError(f"Unknown chunk_mode '{self.chunk_mode}'. Expected 'copy' or 'virtual'.")
+
+        # adaptive planning: size chunks per sample so each worker runs for about 
+        # target_runtime seconds within its memory, and pack small samples together 
+        self.adaptive_chunks = self.runtime_config["input"]["adaptive_chunks"]
+        self.target_runtime = self.runtime_config["input"]["target_runtime"]
+        self.worker_throughput = self.runtime_config["input"]["worker_throughput"]
+        self.worker_memory = self.runtime_config["input"]["worker_memory"] or self._get_runtime_memory()
+        self.max_sample_chunks = self.runtime_config["input"]["max_sample_chunks"]
+        self.pack_samples = self.runtime_config["input"]["pack_samples"]
+
          # define map function 
         self._func = FASTQChunker._chunk_fastq
         self._reduce_func = FASTQChunker._chunk_fastq_reducer
+        self._index_func = FASTQChunker._index_fastq
+        self._split_func = FASTQChunker._split_fastq
 
 
     # overload Module validate 
@@ -38,51 +64,209 @@ class FASTQChunker(Module):
         utils.check_file(self.input_fastq_dir)
 
         # get list of files, make sure isn't empty 
-        local_files = [os.path.join(self.input_fastq_dir, file) for file in os.listdir(self.input_fastq_dir) if "R2" not in file]
+        local_files = self._list_local_files()
         if not local_files:
             raise ValueError(f"No valid files found in the directory {self.input_fastq_dir}. Ensure that the files don't contain 'R2' in their names.")
 
-        for file in local_files:
-            # check if file exists/ is readable 
-            utils.check_file(file)
+        for r1, r2 in local_files:
+            for file in filter(None, (r1, r2)):
+                # check if file exists/ is readable 
+                utils.check_file(file)
 
-            # check if it is possible fastq
-            seq.check_fastq(file)
-
-            # check if file is gzip 
-            if utils.is_gzip(file):
-                raise ValueError(f"File {file} appears to be a gzip compressed file, which is not supported.")
+                # check if it is possible fastq (gzip and BGZF input are read transparently); 
+                # only the head is checked here, the full check is done during the upload 
+                seq.check_fastq(file, max_bytes=1 << 20)
             
 
+    def _get_runtime_memory(self):
+        """Return the worker memory (MB) set in the lithops config for the compute backend."""
+        backend = self.lithops_config.get("lithops", {}).get("backend")
+        return self.lithops_config.get(backend, {}).get("runtime_memory", 1024)
+
+
+    def _get_max_chunk_size(self):
+        """Return the largest chunk (uncompressed bytes) a worker should be given."""
+        return int(min(self.worker_throughput * self.target_runtime,
+                       self.worker_memory * 1024 * 1024 * MEMORY_FRACTION))
+
+
+    def _plan_chunk_size(self, local_file):
+        """
+        Pick the chunk size for a sample.
+
+        Without adaptive_chunks this is the global fastq_chunk_size. Otherwise the sample 
+        is cut into the fewest equally sized chunks that fit the per-worker budget (see 
+        _get_max_chunk_size), but into no more than max_sample_chunks, so that small samples 
+        get a single chunk and large ones don't produce very deep ClusterMerge trees.
+
+        Args:
+        - local_file (str): Path to the local (R1) FASTQ file.
+
+        Returns:
+        - int: Chunk size in uncompressed bytes.
+        """
+        if not self.adaptive_chunks:
+            return self.fastq_chunk_size
+        size = os.path.getsize(local_file)
+        if utils.is_gzip(local_file):
+            size *= GZIP_RATIO
+        nchunks = min(max(math.ceil(size / self._get_max_chunk_size()), 1), self.max_sample_chunks)
+        return max(math.ceil(size / nchunks), 1)
+
+
+    def _plan_packs(self, results):
+        """
+        Pack the chunks of small samples into shared invocations.
+
+        Chunks smaller than half the per-worker budget are packed first-fit decreasing 
+        into packs of up to that budget. Packed chunks keep their own names and outputs; 
+        the filter, derep and within-sample cluster stages only run them in the same 
+        invocation (see Module.list_input_chunks).
+
+        Args:
+        - results (list[dict]): Chunking results, with 'chunks' and 'chunk_bytes' per sample.
+
+        Returns:
+        - list[list[str]]: Chunk names per pack, only packs with more than one chunk.
+        """
+        capacity = self._get_max_chunk_size()
+        small = [(nbytes, chunk) for res in results 
+                 for chunk, nbytes in zip(res["chunks"], res["chunk_bytes"])
+                 if nbytes is not None and nbytes < capacity / 2]
+        packs, sizes = [], []
+        for nbytes, chunk in sorted(small, reverse=True):
+            for i, size in enumerate(sizes):
+                if size + nbytes <= capacity:
+                    packs[i].append(chunk)
+                    sizes[i] += nbytes
+                    break
+            else:
+                packs.append([chunk])
+                sizes.append(nbytes)
+        return [pack for pack in packs if len(pack) > 1]
+
+
+    def _list_local_files(self):
+        """
+        List the local input FASTQ files as (R1, R2) tuples.
+
+        R2 is None unless running in paired mode (ignore_R2 is False), in which case 
+        every R1 file needs an R2 mate with the same name, e.g. sample1_R1.fastq and 
+        sample1_R2.fastq.
+
+        Raises:
+        - ValueError: If a mate is missing in paired mode.
+        """
+        files = sorted(os.listdir(self.input_fastq_dir))
+        local_files = []
+        for file in files:
+            if "R2" in file:
+                continue
+            r1 = os.path.join(self.input_fastq_dir, file)
+            r2 = None
+            if not self.ignore_R2:
+                mate = "R2".join(file.rsplit("R1", 1))
+                if mate == file or mate not in files:
+                    raise ValueError(f"No R2 mate found for {file}. Set ignore_R2 to process single-end reads.")
+                r2 = os.path.join(self.input_fastq_dir, mate)
+            local_files.append((r1, r2))
+        return local_files
+
+
     # overload Module run 
     @time_it
     def run(self):
         # Upload local fastq files to bucket
-        local_files = [os.path.join(self.input_fastq_dir, file) for file in os.listdir(self.input_fastq_dir) if "R2" not in file]
-        cloud_paths = []
-        for local_file in local_files:
-            remote_path = os.path.join(self.fastq_path, os.path.basename(local_file))
-            cloud_obj = self.upload_file(remote_path, local_file, overwrite=self.overwrite_fastq)
-            cloud_paths.append(self._get_iterdata(obj=cloud_obj))
-
-        # Chunk files w map_reduce              <-- (Currently ignores R2 reads)
+        local_files = self._list_local_files()
+        uploads = [f for pair in local_files for f in pair if f]
+        validators = {f: seq.FASTQValidator(f) for f in uploads}
+        hashers = {f: hashlib.md5() for f in uploads}
+        def scan(path, data):
+            validators[path].update(data)
+            hashers[path].update(data)
+        cloud_objs = self.upload_files([(self._get_fastq_path(f), f) for f in uploads], 
+                                       overwrite=self.overwrite_fastq,
+                                       callback=scan)
+        cloud_objs = dict(zip(uploads, cloud_objs))
+
+        # finish validating/counting/checksumming from the upload pass; files that were 
+        # skipped because they already exist remotely are scanned locally instead
+        self._record_counts = {}
+        self._checksums = {}
+        for f in uploads:
+            if not validators[f].nbytes:
+                with open(f, 'rb') as fh:
+                    for block in iter(lambda: fh.read(self.upload_part_size), b""):
+                        scan(f, block)
+            self._record_counts[f] = validators[f].finish()
+            self._checksums[f] = hashers[f].hexdigest()
+        for r1, r2 in local_files:
+            if r2 and self._record_counts[r1] != self._record_counts[r2]:
+                raise ValueError(f"{r1} and {r2} have different numbers of records: {self._record_counts[r1]} vs {self._record_counts[r2]}.")
+
+        copy_data, index_data, split_data = {}, [], []
+        for r1, r2 in local_files:
+            # compressed files are uploaded as-is 
+            data = self._get_iterdata(obj=cloud_objs[r1])
+            if r2:
+                data["obj_r2"] = cloud_objs[r2]
+            chunk_size = self._plan_chunk_size(r1)
+            if self.adaptive_chunks:
+                print(f"{utils._get_sample_name(r1)}: chunk size {chunk_size} bytes")
+
+            # BGZF is indexed by block, plain gzip has to be split in a single streaming pass, 
+            # as do pairs in copy mode since map_reduce can't cut R1 and R2 at the same records
+            files = list(filter(None, (r1, r2)))
+            bgzf = [utils.is_bgzf(f) for f in files]
+            gzipped = [utils.is_gzip(f) for f in files]
+            if any(g and not b for g, b in zip(gzipped, bgzf)):
+                data["chunk_size"] = chunk_size
+                split_data.append(data)
+            elif any(bgzf) or self.chunk_mode == "virtual":
+                data["chunk_size"] = chunk_size
+                index_data.append(data)
+            elif r2:
+                data["chunk_size"] = chunk_size
+                split_data.append(data)
+            else:
+                # map_reduce takes a single chunk size per call
+                copy_data.setdefault(chunk_size, []).append(data)
+
+        # Chunk files w map_reduce
         with FunctionExecutor(config=self.lithops_config) as fexec:
-            fexec.map_reduce(self._func, 
-                             cloud_paths, 
-                             self._reduce_func,
-                             chunksize=1,
-                             obj_reduce_by_key=True,
-                             obj_chunk_size=self.fastq_chunk_size, 
-                             obj_newline="\n@")
-            results = fexec.get_result()
-
-            # check that record counts match after chunking 
+            futures = []
+            for chunk_size, data in copy_data.items():
+                futures.extend(fexec.map_reduce(self._func, 
+                                                data, 
+                                                self._reduce_func,
+                                                chunksize=1,
+                                                obj_reduce_by_key=True,
+                                                obj_chunk_size=chunk_size, 
+                                                obj_newline="\n@"))
+            if index_data:
+                # one metadata pass per file, no chunk objects written 
+                futures.extend(fexec.map(self._index_func, index_data))
+            if split_data:
+                futures.extend(fexec.map(self._split_func, split_data))
+            results = fexec.get_result(fs=futures)
+
+            # check that record counts (and checksums) match after chunking 
             self._validate_chunks(results, local_files)
+            self._write_manifests([res for res in results if "manifest" not in res])
+            self._write_packs(results)
             self._results = results
 
 
+    def _get_fastq_path(self, local_file):
+        return os.path.join(self.fastq_path, os.path.basename(local_file))
+
+
     def _get_iterdata(self, obj):
         data = super()._get_iterdata(obj)
+        # chunking workers read the object itself through lithops' partitioner, and 
+        # write chunks uncompressed so they can be read by byte range 
+        del data["chunk_obj"]
+        del data["compression"]
         data.update({
             "obj": obj,
         })
@@ -90,12 +274,12 @@ class FASTQChunker(Module):
 
 
     def _validate_chunks(self, results, local_files):
-        for local_file in local_files:
+        for local_file, mate_file in local_files:
             # Obtain the base name of the local file
-            base_name = os.path.basename(os.path.splitext(local_file)[0])
+            base_name = utils._get_sample_name(local_file)
 
-            # Count the FASTQ records in the local file
-            local_records_count = seq.count_fastq_records(file_path=local_file)
+            # FASTQ records in the local file, as counted during the upload
+            local_records_count = self._record_counts[local_file]
 
             # Find the corresponding sample in the results
             matching_sample = next((res for res in results if res["sample"] == base_name), None)
@@ -103,23 +287,62 @@ class FASTQChunker(Module):
             if matching_sample:
                 if matching_sample["total_records"] != local_records_count:
                     raise ValueError(f"{base_name} has a mismatch in record counts. Local: {local_records_count}, Chunks: {matching_sample['total_records']}.")
+                # workers that stream the whole object also checksum it
+                remote_checksum = matching_sample.get("md5")
+                if remote_checksum and remote_checksum != self._checksums[local_file]:
+                    raise ValueError(f"{base_name} has a mismatch in checksums. Local: {self._checksums[local_file]}, Remote: {remote_checksum}.")
+                remote_checksum = matching_sample.get("md5_r2")
+                if mate_file and remote_checksum and remote_checksum != self._checksums[mate_file]:
+                    raise ValueError(f"{base_name} R2 has a mismatch in checksums. Local: {self._checksums[mate_file]}, Remote: {remote_checksum}.")
             else:
                 raise ValueError(f"{base_name} not found in results.")
 
 
+    def _write_packs(self, results):
+        """
+        Write the chunk packing plan next to the manifests. It is always written (empty 
+        unless packing) so that a plan left by a previous run doesn't apply.
+        """
+        packs = self._plan_packs(results) if self.adaptive_chunks and self.pack_samples else []
+        if packs:
+            print(f"Packed {sum(len(p) for p in packs)} chunks into {len(packs)} invocations")
+        utils._upload_json(self.lithops_config, self.bucket, self._get_packs_path(), {"packs": packs})
+
+
+    def _write_manifests(self, results):
+        """
+        Write chunk manifests for chunks copied by map_reduce, which has no single 
+        worker per file to do so, so that their checksums are available downstream.
+        """
+        for res in results:
+            manifest = {
+                "sample": res["sample"],
+                "key": self._get_fastq_path(res["original_key"]),
+                "chunks": [{"chunk": chunk, "key": path, "records": size, "bytes": nbytes, "md5": md5} 
+                           for chunk, path, size, nbytes, md5 in zip(res["chunks"], res["chunk_paths"], 
+                                                                     res["chunk_sizes"], res["chunk_bytes"], 
+                                                                     res["chunk_md5s"])]
+            }
+            manifest_path = os.path.join(self.output_path, res["sample"] + utils.MANIFEST_EXT)
+            utils._upload_json(self.lithops_config, self.bucket, manifest_path, manifest)
+
+
     @staticmethod
     def _chunk_fastq_reducer(results):
         # assumed map_reduce was called with obj_reduce_by_key=True
-        sample_id = os.path.basename(os.path.splitext(results[0]['original_key'])[0])
+        sample_id = utils._get_sample_name(results[0]['original_key'])
         chunk_paths = [item["chunk_path"] for item in results]
         chunks = [item["chunk"] for item in results]
         total_records = sum(res["record_count"] for res in results)
         sizes = [res["record_count"] for res in results]
         return {
             "sample": sample_id,
+            "original_key": results[0]["original_key"],
             "chunks": chunks,
             "chunk_paths": chunk_paths,
             "chunk_sizes" : sizes,
+            "chunk_bytes": [res["bytes"] for res in results],
+            "chunk_md5s": [res["md5"] for res in results],
             "total_records": total_records
         }
 
@@ -128,7 +351,8 @@ class FASTQChunker(Module):
     def _chunk_fastq(obj, config, bucket, remote_path, tmpdir=None):
 
         # Reading and counting the records
-        data = obj.data_stream.read().decode('utf-8')
+        raw = obj.data_stream.read()
+        data = raw.decode('utf-8')
         record_count = seq.count_fastq_records(data)
 
         # Save chunk to remote storage 
@@ -141,8 +365,172 @@ class FASTQChunker(Module):
             "original_key": os.path.basename(obj.key),
             "chunk_path": new_remote_path,
             "chunk": chunk_id,
-            "record_count": record_count
+            "record_count": record_count,
+            "bytes": len(raw),
+            "md5": utils._checksum(raw)
+        }
+
+
+    @staticmethod
+    def _iter_records(config, bucket, obj, obj_r2=None, hashers=(None, None)):
+        """
+        Open an uploaded FASTQ (and its R2 mate in paired mode) and iterate over its records.
+
+        Args:
+        - hashers (tuple, optional): hashlib hashers updated with the raw R1 and R2 bytes.
+
+        Returns:
+        - tuple: The R1 and R2 streams (R2 None if single-end), and an iterator of 
+                 (R1 record, R2 record) tuples; in paired mode this checks that the 
+                 mates are in sync as it goes (see seq.iter_fastq_pairs).
+        """
+        stream = utils._open_fastq_stream(config, bucket, utils._get_path(obj), hasher=hashers[0])
+        if obj_r2 is None:
+            return stream, None, ((record, None) for record in seq.iter_fastq_records(stream))
+        stream_r2 = utils._open_fastq_stream(config, bucket, utils._get_path(obj_r2), hasher=hashers[1])
+        return stream, stream_r2, seq.iter_fastq_pairs(stream, stream_r2)
+
+
+    @staticmethod
+    def _manifest_result(manifest, manifest_path, hashers):
+        """Format a manifest written by a worker in the same format as _chunk_fastq_reducer."""
+        return {
+            "sample": manifest["sample"],
+            "manifest": manifest_path,
+            "chunks": [c["chunk"] for c in manifest["chunks"]],
+            "chunk_paths": [c.get("key", manifest_path) for c in manifest["chunks"]],
+            "chunk_sizes": [c["records"] for c in manifest["chunks"]],
+            "chunk_bytes": [c.get("bytes") for c in manifest["chunks"]],
+            "chunk_md5s": [c["md5"] for c in manifest["chunks"]],
+            "total_records": sum(c["records"] for c in manifest["chunks"]),
+            "md5": hashers[0].hexdigest(),
+            "md5_r2": hashers[1].hexdigest() if manifest.get("key_r2") else None
+        }
+
+
+    @staticmethod
+    def _index_fastq(obj, config, bucket, remote_path, chunk_size, obj_r2=None, tmpdir=None):
+        """
+        Build a record-aligned byte-offset index ('virtual chunks') of an uploaded FASTQ.
+
+        The object is streamed once and cut into ranges of roughly chunk_size bytes, 
+        always ending on a record boundary. The ranges are written to a small 
+        '<sample>.manifest.json' object under remote_path, which Module.list_input_chunks 
+        expands so downstream workers can fetch their slice with a ranged GET.
+
+        For BGZF input the ranges are translated to whole compressed blocks plus the
+        offset/length of the chunk within them, so each worker only fetches and 
+        decompresses its own blocks. In paired mode R2 is cut at the same records as R1.
+        Each chunk records the checksum of its (uncompressed) bytes.
+        """
+        key = utils._get_path(obj)
+        sample_id = utils._get_sample_name(key)
+        hashers = (hashlib.md5(), hashlib.md5())
+        stream, stream_r2, records = FASTQChunker._iter_records(config, bucket, obj, obj_r2, hashers)
+
+        # 1. Walk the records, cutting a new chunk every chunk_size bytes
+        chunks = []
+        start = offset = start_r2 = offset_r2 = record_count = 0
+        chunk_hash, chunk_hash_r2 = hashlib.md5(), hashlib.md5()
+        def cut():
+            chunks.append({"start": start, "end": offset, "records": record_count, "bytes": offset - start,
+                           "md5": chunk_hash.hexdigest(),
+                           "mate": {"start": start_r2, "end": offset_r2, "md5": chunk_hash_r2.hexdigest()}})
+
+        for record, record_r2 in records:
+            offset += len(record)
+            offset_r2 += len(record_r2 or b"")
+            chunk_hash.update(record)
+            chunk_hash_r2.update(record_r2 or b"")
+            if not record.strip():
+                continue
+            record_count += 1
+            if offset - start >= chunk_size:
+                cut()
+                start, start_r2 = offset, offset_r2
+                chunk_hash, chunk_hash_r2 = hashlib.md5(), hashlib.md5()
+                record_count = 0
+        if record_count:
+            cut()
+
+        # 2. Write the manifest
+        for i, chunk in enumerate(chunks):
+            chunk["chunk"] = f"{i}_{sample_id}"
+            chunk["mate"]["chunk"] = chunk["chunk"] + utils.MATE_EXT
+            if isinstance(stream, gzip_utils.BGZFReader):
+                chunk.update(stream.block_range(chunk["start"], chunk["end"]))
+            if isinstance(stream_r2, gzip_utils.BGZFReader):
+                chunk["mate"].update(stream_r2.block_range(chunk["mate"]["start"], chunk["mate"]["end"]))
+            if obj_r2 is None:
+                del chunk["mate"]
+        manifest = {
+            "sample": sample_id,
+            "key": key,
+            "key_r2": utils._get_path(obj_r2) if obj_r2 is not None else None,
+            "size": offset,
+            "chunks": chunks
+        }
+        manifest_path = os.path.join(remote_path, sample_id + utils.MANIFEST_EXT)
+        utils._upload_json(config, bucket, manifest_path, manifest)
+
+        # 3. Return in the same format as _chunk_fastq_reducer
+        return FASTQChunker._manifest_result(manifest, manifest_path, hashers)
+
+
+    @staticmethod
+    def _split_fastq(obj, config, bucket, remote_path, chunk_size, obj_r2=None, tmpdir=None):
+        """
+        Split an uploaded FASTQ into uncompressed chunk objects in a single streaming pass.
+
+        Used for plain gzip, which can't be read from an arbitrary offset and so can't be 
+        indexed like BGZF, and for pairs in 'copy' mode. Chunks are named as in _chunk_fastq, 
+        with R2 chunks tagged by utils.MATE_EXT and cut at the same records as R1, and are 
+        listed with their checksums in a '<sample>.manifest.json' object.
+        """
+        key = utils._get_path(obj)
+        sample_id = utils._get_sample_name(key)
+        hashers = (hashlib.md5(), hashlib.md5())
+        _, _, records = FASTQChunker._iter_records(config, bucket, obj, obj_r2, hashers)
+
+        chunks = []
+        def upload_chunk(chunk_records):
+            chunk_id = f"{len(chunks)}_{sample_id}"
+            chunk_path = os.path.join(remote_path, chunk_id + ".fastq")
+            data = b"".join(r for r, _ in chunk_records)
+            utils._upload_file_from_stream(config, bucket, chunk_path, data)
+            chunk = {"chunk": chunk_id, "key": chunk_path, "records": len(chunk_records), "bytes": len(data),
+                     "md5": utils._checksum(data)}
+            if obj_r2 is not None:
+                data = b"".join(r2 for _, r2 in chunk_records)
+                mate_path = utils._get_mate_path(chunk_path)
+                utils._upload_file_from_stream(config, bucket, mate_path, data)
+                chunk["mate"] = {"chunk": chunk_id + utils.MATE_EXT, "key": mate_path, "md5": utils._checksum(data)}
+            chunks.append(chunk)
+
+        # Walk the records, uploading a chunk every chunk_size bytes
+        chunk_records = []
+        nbytes = 0
+        for record, record_r2 in records:
+            if not record.strip():
+                continue
+            chunk_records.append((record, record_r2))
+            nbytes += len(record)
+            if nbytes >= chunk_size:
+                upload_chunk(chunk_records)
+                chunk_records = []
+                nbytes = 0
+        if chunk_records:
+            upload_chunk(chunk_records)
+
+        manifest = {
+            "sample": sample_id,
+            "key": key,
+            "key_r2": utils._get_path(obj_r2) if obj_r2 is not None else None,
+            "chunks": chunks
         }
+        manifest_path = os.path.join(remote_path, sample_id + utils.MANIFEST_EXT)
+        utils._upload_json(config, bucket, manifest_path, manifest)
+        return FASTQChunker._manifest_result(manifest, manifest_path, hashers)
 
 
     def _get_result_as_df(self):
@@ -2,11 +2,15 @@ import os
 import sys 
 import tempfile
 import subprocess as sp 
+from contextlib import contextmanager, nullcontext
 from lithops import FunctionExecutor
 
-from lithopsrad.module import Module
+from lithopsrad.module import Module, packable
 import lithopsrad.sequence as seq
 import lithopsrad.utils as utils
+import lithopsrad.zstd_utils as zstd_utils
+import lithopsrad.pipe_utils as pipe_utils
+from lithopsrad.derep_engine import Dereplicator
 
 class FASTQDerep(Module):
     def __init__(self, lithops_config, runtime_config):
@@ -19,6 +23,7 @@ class FASTQDerep(Module):
         self.run_path = utils.fix_dir_name(self.runtime_config["remote_paths"]["run_path"])
         self.input_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["fastq_edits"]))
         self.output_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["fastq_dereps"]))
+        self.cleanup_paths = [self.output_path]
 
         # runtime params for derep step 
         self.maxuniquesize = self.runtime_config["derep"]["maxuniquesize"]
@@ -26,6 +31,34 @@ class FASTQDerep(Module):
         self.strand = self.runtime_config["derep"]["strand"]
         self.qmask = self.runtime_config["derep"]["qmask"]
 
+        # with the cross-chunk reduce, size limits apply to the sample-level counts instead 
+        # (see DerepReduce), so chunks keep all their uniques. The reduce does not run when
+        # clustering is fused into the chunk workers, so the limits stay on the chunks then
+        if self.runtime_config["derep_reduce"]["enabled"] and self.runtime_config["fused"]["stages"] != "cluster":
+            self.minuniquesize = 1
+            self.maxuniquesize = 2 ** 31 - 1
+
+        # how R1/R2 edits are combined in paired mode: 'join' (pad and concatenate) or 'merge' (overlap)
+        self.pair_mode = self.runtime_config["derep"]["pair_mode"]
+        if self.pair_mode not in ("join", "merge"):
+            raise ValueError(f"Unknown pair_mode '{self.pair_mode}'. Expected 'join' or 'merge'.")
+
+        # 'vsearch' (-fastx_uniques) or 'python' (in-process, see derep_engine.Dereplicator), 
+        # which holds at most max_uniques uniques in memory before spilling to tmpdir 
+        self.engine = self.runtime_config["derep"]["engine"]
+        if self.engine not in ("vsearch", "python"):
+            raise ValueError(f"Unknown derep engine '{self.engine}'. Expected 'vsearch' or 'python'.")
+        self.max_uniques = self.runtime_config["derep"]["max_uniques"]
+
+        # 'fastq' or 'fasta'; FASTA dereps drop the quality strings, which only the derep itself 
+        # uses, optionally keeping a summary of each under derep_quals (see pipe_utils.FastaWriter) 
+        self.output_format = self.runtime_config["derep"]["output_format"]
+        if self.output_format not in ("fastq", "fasta"):
+            raise ValueError(f"Unknown derep output_format '{self.output_format}'. Expected 'fastq' or 'fasta'.")
+        self.qual_path = None
+        if self.output_format == "fasta" and self.runtime_config["derep"]["qual_summary"]:
+            self.qual_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["derep_quals"]))
+
         # define function to run 
         self._func = FASTQDerep._derep_fastq
 
@@ -36,31 +69,34 @@ class FASTQDerep(Module):
             "maxuniquesize": self.maxuniquesize,
             "minuniquesize": self.minuniquesize,
             "strand": self.strand,
-            "qmask": self.qmask
+            "qmask": self.qmask,
+            "pair_mode": self.pair_mode,
+            "engine": self.engine,
+            "max_uniques": self.max_uniques,
+            "output_format": self.output_format,
+            "qual_path": self.qual_path
         })
         return data
 
 
     @staticmethod
-    def _derep_fastq(obj, config, bucket, remote_path, maxuniquesize, minuniquesize, strand, qmask, tmpdir=None):
-        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
-        os.chdir(tmpdir)
-
-        fastq = obj['Key'] if isinstance(obj, dict) else obj.key
-        tmp_path = os.path.join(tmpdir, os.path.basename(fastq))
-        
-        # 1. Download the file to the temp directory & configure paths 
-        utils._download_file(config, bucket, fastq, tmp_path)
+    def _pair_cmd(fin, fin_r2, fout, pair_mode="join"):
+        """Build the vsearch command combining R1 and R2 into single reads (fout may be '-' for stdout)."""
+        return [
+            "vsearch",
+            "-fastq_join" if pair_mode == "join" else "-fastq_mergepairs", fin,
+            "-reverse", fin_r2,
+            "-fastqout", fout,
+            "-threads", "1"
+        ]
 
-        prefix = os.path.splitext(tmp_path)[0]
-        base = os.path.basename(prefix)
-        fout = base + ".derep"
-        label = base.split(".")[0] + "_d"
 
-        # 2. Dereplicate using vsearch
-        cmd = [
+    @staticmethod
+    def _uniques_cmd(fin, fout, label, maxuniquesize, minuniquesize, strand):
+        """Build the vsearch -fastx_uniques command (fin/fout may be '-' for stdin/stdout)."""
+        return [
             "vsearch",
-            "-fastx_uniques", tmp_path,
+            "-fastx_uniques", fin,
             "-fastqout", fout,
             "-strand", strand,
             "-relabel", label,
@@ -69,39 +105,148 @@ class FASTQDerep(Module):
             "-minuniquesize", str(minuniquesize),
             "-threads", "1"  # TODO: Change this if vthreads is available.
         ]
-        proc = sp.Popen(cmd, stderr=sp.STDOUT, stdout=sp.PIPE, close_fds=True)
-        res = proc.communicate()[0].decode("utf-8")
-        print(res)
 
-        # 3. Handle mask option and upload
+
+    @staticmethod
+    def _mask_cmd(fin, fout):
+        """Build the vsearch -fastx_mask command (fin/fout may be '-' for stdin/stdout)."""
+        return [
+            "vsearch",
+            "-fastx_mask", fin,
+            "-fastqout", fout,
+            "-threads", "1"  # TODO: Change this if vthreads is available.
+        ]
+
+
+    @staticmethod
+    @contextmanager
+    def _open_output(config, bucket, derep_path, output_format="fastq", qual_path=None, compression=None, stats=None):
+        """
+        Open the upload of a chunk's uniques, to be written as FASTQ.
+
+        With output_format 'fasta' the FASTQ is converted on the fly by a pipe_utils.FastaWriter, 
+        and if qual_path is set the quality summaries are uploaded there as '<chunk>.qual'.
+        """
+        with pipe_utils.StreamingUpload(config, bucket, derep_path, compression=compression, stats=stats) as upload:
+            if output_format == "fastq":
+                yield upload
+                return
+            qual_name = os.path.splitext(os.path.basename(derep_path))[0] + ".qual"
+            quals = pipe_utils.StreamingUpload(config, bucket, os.path.join(qual_path, qual_name), compression=compression, 
+                                               stats=stats) if qual_path else nullcontext()
+            with quals:
+                writer = pipe_utils.FastaWriter(upload, quals if qual_path else None)
+                yield writer
+                writer.close()
+
+
+    @staticmethod
+    @packable
+    def _derep_fastq(chunk_obj, config, bucket, remote_path, maxuniquesize, minuniquesize, strand, qmask, pair_mode="join", 
+                     tmpdir=None, compression=None, engine="vsearch", max_uniques=1000000, output_format="fastq", qual_path=None):
+        if engine == "python":
+            return FASTQDerep._derep_fastq_python(chunk_obj, config, bucket, remote_path, maxuniquesize, minuniquesize, 
+                                                  strand, qmask, pair_mode, tmpdir, compression, max_uniques, 
+                                                  output_format, qual_path)
+        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
+        os.chdir(tmpdir)
+
+        fastq = utils._get_path(chunk_obj)
+        tmp_path = os.path.join(tmpdir, os.path.basename(fastq))
+        stats = zstd_utils.CompressionStats()
+
+        # 1. Configure paths 
+        prefix = os.path.splitext(tmp_path)[0]
+        base = os.path.basename(prefix)
+        fout = base + ".derep"
+        label = base.split(".")[0] + "_d"
         derep_path = os.path.join(remote_path, os.path.basename(fout))
-        if qmask:
-            mout = prefix + ".mask"
-            cmd = [
-                "vsearch",
-                "-fastx_mask", fout,
-                "-fastqout", mout,
-                "-threads", "1"  # TODO: Change this if vthreads is available.
-            ]
-            proc = sp.Popen(cmd, stderr=sp.STDOUT, stdout=sp.PIPE, close_fds=True)
-            res = proc.communicate()[0].decode("utf-8")
-            print(res)
-
-            # Upload masked file as .derep
-            utils._upload_file(config, bucket, derep_path, mout)
-            derep_size = seq.count_fastq_records(file_path=mout)
-            os.remove(mout)  # remove the mask file after upload
+
+        # 2. Build the pipeline: (pair ->) uniques (-> mask), streamed straight into the upload. 
+        # Single-end edits are also streamed (and decompressed) into vsearch's stdin; in paired 
+        # mode R1 and R2 are combined into single reads first, which needs them as local files 
+        mate = chunk_obj.get("mate") if isinstance(chunk_obj, dict) else None
+        cmds = []
+        stdin = None
+        if mate:
+            tmp_path_r2 = utils._get_mate_path(tmp_path)
+            utils._download_file(config, bucket, fastq, tmp_path, stats=stats)
+            utils._download_file(config, bucket, utils._get_path(mate), tmp_path_r2, stats=stats)
+            cmds.append(FASTQDerep._pair_cmd(tmp_path, tmp_path_r2, "-", pair_mode))
         else:
-            # Upload the dereplicated file
-            utils._upload_file(config, bucket, derep_path, fout)
-            derep_size = seq.count_fastq_records(file_path=fout)
+            stdin = utils._open_fastq_stream(config, bucket, fastq)
+        cmds.append(FASTQDerep._uniques_cmd("-", "-", label, maxuniquesize, minuniquesize, strand))
+        if qmask:
+            cmds.append(FASTQDerep._mask_cmd("-", "-"))
+
+        # 3. Dereplicate (and mask) using vsearch, counting records as they are uploaded
+        with FASTQDerep._open_output(config, bucket, derep_path, output_format, qual_path, compression, stats) as upload:
+            derep_size = pipe_utils.run_piped(cmds, stdin=stdin, stdout=upload) // 4
 
         # 4. Clean up
-        os.remove(fout)
-        os.remove(tmp_path)
+        if mate:
+            os.remove(tmp_path)
+            os.remove(tmp_path_r2)
 
         # 5. Return the results
         return {
             "chunk": base,  
-            "derep_size": derep_size
+            "derep_size": derep_size,
+            **stats.as_dict("derep")
+        }
+
+
+    @staticmethod
+    def _derep_fastq_python(chunk_obj, config, bucket, remote_path, maxuniquesize, minuniquesize, strand, qmask, pair_mode="join", 
+                            tmpdir=None, compression=None, max_uniques=1000000, output_format="fastq", qual_path=None):
+        """
+        Dereplicate a chunk in-process with derep_engine.Dereplicator instead of vsearch -fastx_uniques.
+
+        The edits are streamed into the dereplicator (through vsearch -fastq_join/-fastq_mergepairs 
+        in paired mode) and the uniques are written straight into the upload, or through 
+        vsearch -fastx_mask if qmask is set. Output labels and sizes match the vsearch engine.
+        """
+        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
+        os.chdir(tmpdir)
+
+        fastq = utils._get_path(chunk_obj)
+        tmp_path = os.path.join(tmpdir, os.path.basename(fastq))
+        stats = zstd_utils.CompressionStats()
+
+        # 1. Configure paths 
+        base = os.path.basename(os.path.splitext(tmp_path)[0])
+        label = base.split(".")[0] + "_d"
+        derep_path = os.path.join(remote_path, base + ".derep")
+
+        # 2. Count the uniques of the (paired) reads
+        derep = Dereplicator(strand=strand, max_uniques=max_uniques, tmpdir=tmpdir)
+        mate = chunk_obj.get("mate") if isinstance(chunk_obj, dict) else None
+        if mate:
+            tmp_path_r2 = utils._get_mate_path(tmp_path)
+            utils._download_file(config, bucket, fastq, tmp_path, stats=stats)
+            utils._download_file(config, bucket, utils._get_path(mate), tmp_path_r2, stats=stats)
+            proc = sp.Popen(FASTQDerep._pair_cmd(tmp_path, tmp_path_r2, "-", pair_mode), stdout=sp.PIPE, close_fds=True)
+            derep.add_fastq(proc.stdout)
+            proc.stdout.close()
+            if proc.wait():
+                raise RuntimeError(f"vsearch {proc.args[1]} failed on {base} with exit code {proc.returncode}.")
+            os.remove(tmp_path)
+            os.remove(tmp_path_r2)
+        else:
+            derep.add_fastq(utils._open_fastq_stream(config, bucket, fastq))
+
+        # 3. Write the uniques (masked by vsearch if needed), streamed into the upload
+        with FASTQDerep._open_output(config, bucket, derep_path, output_format, qual_path, compression, stats) as upload:
+            if qmask:
+                sizes = []
+                pipe_utils.run_piped([FASTQDerep._mask_cmd("-", "-")], stdout=upload,
+                                     stdin=lambda pipe: sizes.append(derep.write(pipe, label, minuniquesize, maxuniquesize)))
+                derep_size = sizes[0]
+            else:
+                derep_size = derep.write(upload, label, minuniquesize, maxuniquesize)
+
+        return {
+            "chunk": base,
+            "derep_size": derep_size,
+            **stats.as_dict("derep")
         }
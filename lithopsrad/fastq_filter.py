@@ -2,11 +2,15 @@ import os
 import sys 
 import tempfile
 import subprocess as sp 
+from contextlib import nullcontext
 from lithops import FunctionExecutor
 
-from lithopsrad.module import Module
+from lithopsrad.module import Module, packable
 import lithopsrad.sequence as seq
 import lithopsrad.utils as utils
+import lithopsrad.zstd_utils as zstd_utils
+import lithopsrad.qual_filter as qual_filter
+import lithopsrad.pipe_utils as pipe_utils
 
 class FASTQFilter(Module):
     def __init__(self, lithops_config, runtime_config):
@@ -19,6 +23,7 @@ class FASTQFilter(Module):
         self.run_path = utils.fix_dir_name(self.runtime_config["remote_paths"]["run_path"])
         self.input_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["fastq_chunks"]))
         self.output_path = os.path.join(self.run_path, utils.fix_dir_name(self.runtime_config["remote_paths"]["fastq_edits"]))
+        self.cleanup_paths = [self.output_path]
 
         # runtime params for edit step 
         self.minlen = self.runtime_config["edit"]["minlen"]
@@ -27,6 +32,12 @@ class FASTQFilter(Module):
         self.maxee = self.runtime_config["edit"]["maxee"]
         self.maxee_rate = self.runtime_config["edit"]["maxee_rate"]
 
+        # 'vsearch' runs vsearch -fastx_filter on a local copy of the chunk, 'numpy' filters 
+        # in-process while streaming the chunk (see qual_filter)
+        self.engine = self.runtime_config["edit"]["engine"]
+        if self.engine not in ("vsearch", "numpy"):
+            raise ValueError(f"Unknown edit engine '{self.engine}'. Expected 'vsearch' or 'numpy'.")
+
         # define map function 
         self._func = FASTQFilter._filter_fastq
 
@@ -38,30 +49,66 @@ class FASTQFilter(Module):
             "truncqual": self.truncqual,
             "maxns": self.maxns,
             "maxee": self.maxee,
-            "maxee_rate": self.maxee_rate
+            "maxee_rate": self.maxee_rate,
+            "engine": self.engine
         })
         return data
 
 
     @staticmethod
-    def _filter_fastq(obj, config, bucket, remote_path, minlen, truncqual, maxns, maxee, maxee_rate, tmpdir=None):
-        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
-        os.chdir(tmpdir)
+    def _filter_fastq_piped(chunk_obj, config, bucket, remote_path, minlen, truncqual, maxns, maxee, maxee_rate, compression=None):
+        """
+        Filter a single-end chunk with vsearch without local files: the chunk is streamed 
+        into vsearch's stdin and its stdout into the upload, counting records on the way.
+        """
+        chunk_id = utils._get_chunk_name(chunk_obj)
+        stats = zstd_utils.CompressionStats()
+        filter_path = os.path.join(remote_path, chunk_id + ".edit")
+        cmd = FASTQFilter._filter_cmd("-", "-", minlen, truncqual, maxns, maxee, maxee_rate)
+        with pipe_utils.StreamingUpload(config, bucket, filter_path, compression=compression, stats=stats) as upload:
+            lines = pipe_utils.run_piped([cmd], stdin=utils._open_chunk_stream(config, bucket, chunk_obj), stdout=upload)
+        return {
+            "chunk": chunk_id,
+            "filtered_size": lines // 4,
+            **stats.as_dict("edit")
+        }
 
-        fastq = obj['Key'] if isinstance(obj, dict) else obj.key
-        tmp_path = os.path.join(tmpdir, os.path.basename(fastq))
-        
-        # 1. Download the file to the temp directory & configure paths 
-        utils._download_file(config, bucket, fastq, tmp_path)
 
-        prefix = os.path.splitext(tmp_path)[0]
-        base = os.path.basename(prefix)
-        fout = base + ".edit"
+    @staticmethod
+    def _filter_fastq_numpy(chunk_obj, config, bucket, remote_path, minlen, truncqual, maxns, maxee, maxee_rate, compression=None):
+        """
+        Filter a chunk in-process with qual_filter, with the same outputs as _filter_fastq.
+
+        The chunk is streamed from storage (no local copy) and the reads that pass are 
+        streamed into the upload(s), counted as they are written, so no vsearch process 
+        or re-count is needed.
+        """
+        chunk_id = utils._get_chunk_name(chunk_obj)
+        mate = chunk_obj.get("mate") if isinstance(chunk_obj, dict) else None
+        stats = zstd_utils.CompressionStats()
+
+        # 1. Stream and filter the chunk (and its mate, in paired mode) into the uploads
+        filter_path = os.path.join(remote_path, chunk_id + ".edit")
+        stream = utils._open_chunk_stream(config, bucket, chunk_obj)
+        stream_r2 = utils._open_chunk_stream(config, bucket, mate) if mate else None
+        with pipe_utils.StreamingUpload(config, bucket, filter_path, compression=compression, stats=stats) as out, \
+             (pipe_utils.StreamingUpload(config, bucket, utils._get_mate_path(filter_path), compression=compression, stats=stats)
+              if mate else nullcontext()) as out_r2:
+            _, filtered_records = qual_filter.filter_fastq_stream(stream, out, minlen, truncqual, maxns, maxee, maxee_rate,
+                                                                  stream_r2=stream_r2, out_r2=out_r2)
+        return {
+            "chunk": chunk_id,
+            "filtered_size": filtered_records,
+            **stats.as_dict("edit")
+        }
 
-        # 2. Filter using vsearch
-        cmd = [
+
+    @staticmethod
+    def _filter_cmd(fin, fout, minlen, truncqual, maxns, maxee, maxee_rate):
+        """Build the vsearch -fastx_filter command (fin/fout may be '-' for stdin/stdout)."""
+        return [
             "vsearch",
-            "-fastx_filter", tmp_path,
+            "-fastx_filter", fin,
             "-fastqout", fout,
             "-fastq_minlen", str(minlen),
             "-fastq_truncqual", str(truncqual),
@@ -71,25 +118,70 @@ class FASTQFilter(Module):
             "-threads", "1"
         ]
 
+
+    @staticmethod
+    @packable
+    def _filter_fastq(chunk_obj, config, bucket, remote_path, minlen, truncqual, maxns, maxee, maxee_rate, tmpdir=None, compression=None, engine="vsearch"):
+        if engine == "numpy":
+            return FASTQFilter._filter_fastq_numpy(chunk_obj, config, bucket, remote_path, minlen, truncqual, 
+                                                   maxns, maxee, maxee_rate, compression=compression)
+        if not (isinstance(chunk_obj, dict) and chunk_obj.get("mate")):
+            return FASTQFilter._filter_fastq_piped(chunk_obj, config, bucket, remote_path, minlen, truncqual, 
+                                                   maxns, maxee, maxee_rate, compression=compression)
+
+        # paired reads: vsearch needs both mates as files, and writes two outputs
+        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
+        os.chdir(tmpdir)
+
+        chunk_id = utils._get_chunk_name(chunk_obj)
+        tmp_path = os.path.join(tmpdir, chunk_id + ".fastq")
+        
+        # 1. Download the chunk (or its byte range, for virtual chunks) to the temp directory & configure paths 
+        utils._download_chunk(config, bucket, chunk_obj, tmp_path)
+
+        prefix = os.path.splitext(tmp_path)[0]
+        base = os.path.basename(prefix)
+        fout = base + ".edit"
+
+        # in paired mode, also fetch R2; vsearch discards a pair if either mate fails
+        mate = chunk_obj.get("mate") if isinstance(chunk_obj, dict) else None
+        if mate:
+            tmp_path_r2 = utils._get_mate_path(tmp_path)
+            fout_r2 = utils._get_mate_path(fout)
+            utils._download_chunk(config, bucket, mate, tmp_path_r2)
+
+        # 2. Filter using vsearch
+        cmd = FASTQFilter._filter_cmd(tmp_path, fout, minlen, truncqual, maxns, maxee, maxee_rate)
+        if mate:
+            cmd.extend(["-reverse", tmp_path_r2, "-fastqout_rev", fout_r2])
+
         proc = sp.Popen(cmd, stderr=sp.STDOUT, stdout=sp.PIPE, close_fds=True)
         res = proc.communicate()[0].decode("utf-8")
         print(res)
+        if proc.returncode:
+            raise RuntimeError(f"{' '.join(proc.args[:2])} failed on {chunk_id} with exit code {proc.returncode}.")
 
         # 3. Delete temp files and upload result to bucket 
         os.remove(tmp_path)
 
+        stats = zstd_utils.CompressionStats()
         filter_path = os.path.join(remote_path, os.path.basename(fout))
-        utils._upload_file(config, bucket, filter_path, fout)
+        utils._upload_file(config, bucket, filter_path, fout, compression=compression, stats=stats)
+        if mate:
+            os.remove(tmp_path_r2)
+            utils._upload_file(config, bucket, utils._get_mate_path(filter_path), fout_r2, 
+                               compression=compression, stats=stats)
+            os.remove(fout_r2)
 
         # 4. Get the count of filtered FASTQ records
         filtered_records = seq.count_fastq_records(file_path=fout)
 
         # 5. Clean up and return results 
-        chunk_id = os.path.basename(os.path.splitext(fastq)[0])
         os.remove(fout)
         return {
             "chunk": chunk_id,
             #"filter_path": filter_path,
-            "filtered_size": filtered_records
+            "filtered_size": filtered_records,
+            **stats.as_dict("edit")
         }
 
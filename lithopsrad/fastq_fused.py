@@ -0,0 +1,278 @@
+import os
+import tempfile
+import subprocess as sp
+from contextlib import nullcontext
+
+from lithopsrad.module import Module, packable
+from lithopsrad.fastq_filter import FASTQFilter
+from lithopsrad.fastq_derep import FASTQDerep
+from lithopsrad.cluster_map import ClusterMap
+import lithopsrad.sequence as seq
+import lithopsrad.utils as utils
+import lithopsrad.zstd_utils as zstd_utils
+import lithopsrad.pipe_utils as pipe_utils
+import lithopsrad.qual_filter as qual_filter
+from lithopsrad.derep_engine import Dereplicator
+
+
+class FASTQFused(Module):
+    """
+    Runs FASTQFilter and FASTQDerep (and optionally ClusterMap within samples) as a
+    single stage, with one invocation per chunk and the vsearch steps piped together,
+    so that the intermediate .edit/.derep objects never go through the bucket.
+    """
+    def __init__(self, lithops_config, runtime_config):
+        super().__init__(lithops_config, runtime_config)
+        self.setup()
+
+
+    def setup(self):
+        # 'derep' fuses filter -> (pair ->) derep (-> mask), 'cluster' also runs linclust
+        self.stages = self.runtime_config["fused"]["stages"]
+        if self.stages not in ("derep", "cluster"):
+            raise ValueError(f"Unknown fused stages '{self.stages}'. Expected 'derep' or 'cluster'.")
+        # upload the .edit (and .derep) intermediates too, for debugging
+        self.keep_intermediates = self.runtime_config["fused"]["keep_intermediates"]
+
+        # the fused modules read their own params and paths
+        self.filter = FASTQFilter(self.lithops_config, self.runtime_config)
+        self.derep = FASTQDerep(self.lithops_config, self.runtime_config)
+        self.cluster = ClusterMap(self.lithops_config, self.runtime_config, mode="clust_within") if self.stages == "cluster" else None
+
+        # Remote paths
+        self.input_path = self.filter.input_path
+        self.output_path = self.cluster.output_path if self.cluster else self.derep.output_path
+        self.cleanup_paths = [self.filter.output_path, self.derep.output_path]
+
+        # define map function
+        self._func = FASTQFused._fused_fastq
+
+
+    def _get_iterdata(self, obj):
+        data = super()._get_iterdata(obj)
+        data.update({
+            "filter_args": {
+                "minlen": self.filter.minlen,
+                "truncqual": self.filter.truncqual,
+                "maxns": self.filter.maxns,
+                "maxee": self.filter.maxee,
+                "maxee_rate": self.filter.maxee_rate,
+                "engine": self.filter.engine
+            },
+            "derep_args": {
+                "maxuniquesize": self.derep.maxuniquesize,
+                "minuniquesize": self.derep.minuniquesize,
+                "strand": self.derep.strand,
+                "qmask": self.derep.qmask,
+                "pair_mode": self.derep.pair_mode,
+                "output_format": self.derep.output_format,
+                "qual_path": self.derep.qual_path,
+                "engine": self.derep.engine,
+                "max_uniques": self.derep.max_uniques
+            },
+            "cluster_args": {
+                "cov": self.cluster.cov,
+                "identity": self.cluster.id,
+                "cov_mode": self.cluster.cov_mode,
+                "mask": self.cluster.mask,
+                "mask_lower_case": self.cluster.mask_lower_case,
+                "threads": self.cluster.threads
+            } if self.cluster else None,
+            "edit_path": self.filter.output_path if self.keep_intermediates else None,
+            "derep_path": self.derep.output_path if self.keep_intermediates or not self.cluster else None
+        })
+        return data
+
+
+    @staticmethod
+    def _run_engines(tmp_path, tmp_path_r2, fedit, fout, label, filter_args, filter_engine, derep_args, tmpdir):
+        """
+        Filter and dereplicate (and mask) a chunk when an in-process engine is selected for either
+        step (FASTQFilter 'numpy', FASTQDerep 'python'), going through the local .edit file(s).
+
+        Args:
+        - tmp_path (str): Local R1 chunk.
+        - tmp_path_r2 (str): Local R2 chunk, or None for single-end reads.
+        - fedit (str): Local filter output (its mate path is used for R2).
+        - fout (str): Local derep output.
+        - label (str): Label prefix of the uniques.
+        - filter_args (dict): FASTQFilter params, without the engine.
+        - filter_engine (str): 'vsearch' or 'numpy'.
+        - derep_args (dict): FASTQDerep params.
+        - tmpdir (str): Local dir for the dereplicator's spills.
+
+        Returns:
+        - int: Number of reads (or pairs) kept by the filter.
+        """
+        fedit_r2 = utils._get_mate_path(fedit)
+        qmask = derep_args["qmask"]
+
+        # 1. Filter into the local .edit file(s)
+        if filter_engine == "numpy":
+            with open(tmp_path, "rb") as fin, open(fedit, "wb") as out, \
+                 (open(tmp_path_r2, "rb") if tmp_path_r2 else nullcontext()) as fin_r2, \
+                 (open(fedit_r2, "wb") if tmp_path_r2 else nullcontext()) as out_r2:
+                _, filtered_records = qual_filter.filter_fastq_stream(fin, out, stream_r2=fin_r2, out_r2=out_r2, **filter_args)
+        else:
+            cmd = FASTQFilter._filter_cmd(tmp_path, fedit, **filter_args)
+            if tmp_path_r2:
+                cmd.extend(["-reverse", tmp_path_r2, "-fastqout_rev", fedit_r2])
+            pipe_utils.run_piped([cmd])
+            filtered_records = seq.count_fastq_records(file_path=fedit)
+
+        # 2. Dereplicate the (joined/merged) reads, then mask
+        pair_cmd = FASTQDerep._pair_cmd(fedit, fedit_r2, "-", derep_args["pair_mode"]) if tmp_path_r2 else None
+        if derep_args.get("engine", "vsearch") == "python":
+            derep = Dereplicator(strand=derep_args["strand"], max_uniques=derep_args["max_uniques"], tmpdir=tmpdir)
+            if pair_cmd:
+                proc = sp.Popen(pair_cmd, stdout=sp.PIPE, close_fds=True)
+                derep.add_fastq(proc.stdout)
+                proc.stdout.close()
+                if proc.wait():
+                    raise RuntimeError(f"{' '.join(proc.args[:2])} failed on {fedit} with exit code {proc.returncode}.")
+            else:
+                with open(fedit, "rb") as fin:
+                    derep.add_fastq(fin)
+            write = lambda out: derep.write(out, label, derep_args["minuniquesize"], derep_args["maxuniquesize"])
+            if qmask:
+                pipe_utils.run_piped([FASTQDerep._mask_cmd("-", fout)], stdin=write)
+            else:
+                with open(fout, "wb") as out:
+                    write(out)
+        else:
+            cmds = [FASTQDerep._uniques_cmd("-", "-" if qmask else fout, label, derep_args["maxuniquesize"],
+                                            derep_args["minuniquesize"], derep_args["strand"])]
+            if qmask:
+                cmds.append(FASTQDerep._mask_cmd("-", fout))
+            if pair_cmd:
+                pipe_utils.run_piped([pair_cmd] + cmds)
+            else:
+                with open(fedit, "rb") as fin:
+                    pipe_utils.run_piped(cmds, stdin=fin)
+        return filtered_records
+
+
+    @staticmethod
+    @packable
+    def _fused_fastq(chunk_obj, config, bucket, remote_path, filter_args, derep_args, cluster_args=None,
+                     edit_path=None, derep_path=None, tmpdir=None, compression=None):
+        """
+        Filter, dereplicate (and mask) a chunk, and optionally cluster it, in one invocation.
+
+        Single-end, the filter output is relayed straight into vsearch -fastx_uniques (counting
+        the filtered reads on the way), and the uniques into -fastx_mask. Paired, the filter
+        writes R1/R2 locally and the join/merge output is piped into the uniques instead.
+        With the in-process engines, see _run_engines.
+
+        Args:
+        - filter_args (dict): FASTQFilter params (minlen, truncqual, maxns, maxee, maxee_rate, engine).
+        - derep_args (dict): FASTQDerep params (maxuniquesize, minuniquesize, strand, qmask, pair_mode, 
+                             output_format, qual_path, engine, max_uniques).
+        - cluster_args (dict, optional): ClusterMap params; if set, the dereplicated reads are
+                                         clustered and the hits/centroids uploaded to remote_path.
+        - edit_path (str, optional): Remote dir to also upload the filtered reads to.
+        - derep_path (str, optional): Remote dir to upload the dereplicated reads to.
+
+        Returns:
+        - dict: The chunk with its filtered_size and derep_size, plus the ClusterMap results if clustered.
+        """
+        tmpdir = tmpdir or os.path.realpath(tempfile.gettempdir())
+        os.chdir(tmpdir)
+
+        chunk_id = utils._get_chunk_name(chunk_obj)
+        tmp_path = os.path.join(tmpdir, chunk_id + ".fastq")
+        fedit = chunk_id + ".edit"
+        fout = chunk_id + ".derep"
+        label = chunk_id.split(".")[0] + "_d"
+        qmask = derep_args["qmask"]
+        stats = zstd_utils.CompressionStats()
+        filter_args = dict(filter_args)
+        filter_engine = filter_args.pop("engine", "vsearch")
+        derep_engine = derep_args.get("engine", "vsearch")
+
+        # 1. Download the chunk (and its mate in paired mode)
+        utils._download_chunk(config, bucket, chunk_obj, tmp_path)
+        mate = chunk_obj.get("mate") if isinstance(chunk_obj, dict) else None
+        if mate:
+            tmp_path_r2 = utils._get_mate_path(tmp_path)
+            utils._download_chunk(config, bucket, mate, tmp_path_r2)
+
+        # 2. Run filter -> (pair ->) uniques (-> mask)
+        if filter_engine != "vsearch" or derep_engine != "vsearch":
+            filtered_records = FASTQFused._run_engines(tmp_path, tmp_path_r2 if mate else None, fedit, fout, label,
+                                                       filter_args, filter_engine, derep_args, tmpdir)
+        else:
+            uniques_cmd = FASTQDerep._uniques_cmd("-", "-" if qmask else fout, label, derep_args["maxuniquesize"],
+                                                  derep_args["minuniquesize"], derep_args["strand"])
+            if mate:
+                # the filter has two outputs, so it writes them locally
+                cmd = FASTQFilter._filter_cmd(tmp_path, fedit, **filter_args)
+                cmd.extend(["-reverse", tmp_path_r2, "-fastqout_rev", utils._get_mate_path(fedit)])
+                proc = sp.Popen(cmd, stderr=sp.STDOUT, stdout=sp.PIPE, close_fds=True)
+                print(proc.communicate()[0].decode("utf-8"))
+                if proc.returncode:
+                    raise RuntimeError(f"{proc.args[1]} failed on {chunk_id} with exit code {proc.returncode}.")
+                filtered_records = seq.count_fastq_records(file_path=fedit)
+
+                first = sp.Popen(FASTQDerep._pair_cmd(fedit, utils._get_mate_path(fedit), "-", derep_args["pair_mode"]),
+                                 stdout=sp.PIPE, close_fds=True)
+                procs = [first, sp.Popen(uniques_cmd, stdin=first.stdout, stdout=sp.PIPE if qmask else None, close_fds=True)]
+                first.stdout.close()
+            else:
+                first = sp.Popen(FASTQFilter._filter_cmd(tmp_path, "-", **filter_args), stdout=sp.PIPE, close_fds=True)
+                procs = [first, sp.Popen(uniques_cmd, stdin=sp.PIPE, stdout=sp.PIPE if qmask else None, close_fds=True)]
+            if qmask:
+                procs.append(sp.Popen(FASTQDerep._mask_cmd("-", fout), stdin=procs[-1].stdout, close_fds=True))
+                procs[1].stdout.close()
+            if not mate:
+                copy = open(fedit, "wb") if edit_path else None
+                try:
+                    filtered_records = utils._relay_stream(first.stdout, procs[1].stdin, copy) // 4
+                finally:
+                    if copy:
+                        copy.close()
+            for proc in procs:
+                if proc.wait():
+                    raise RuntimeError(f"{proc.args[1]} failed on {chunk_id} with exit code {proc.returncode}.")
+        os.remove(tmp_path)
+        derep_size = seq.count_fastq_records(file_path=fout)
+
+        # FASTA dereps (see FASTQDerep._open_output): convert, keeping the quality summaries
+        if derep_args.get("output_format") == "fasta":
+            fqual = chunk_id + ".qual"
+            with open(fout, "rb") as fin, open(fout + ".fasta", "wb") as out, open(fqual, "wb") as quals:
+                writer = pipe_utils.FastaWriter(out, quals if derep_args.get("qual_path") else None)
+                utils._relay_stream(fin, writer, block_size=1 << 20)
+            os.replace(fout + ".fasta", fout)
+            if derep_args.get("qual_path"):
+                utils._upload_file(config, bucket, os.path.join(derep_args["qual_path"], fqual), fqual, 
+                                   compression=compression, stats=stats)
+            os.remove(fqual)
+
+        # 3. Upload the dereplicated reads and any intermediates
+        if edit_path:
+            utils._upload_file(config, bucket, os.path.join(edit_path, fedit), fedit, compression=compression, stats=stats)
+            if mate:
+                utils._upload_file(config, bucket, os.path.join(edit_path, utils._get_mate_path(fedit)), utils._get_mate_path(fedit),
+                                   compression=compression, stats=stats)
+        if mate:
+            os.remove(tmp_path_r2)
+            os.remove(utils._get_mate_path(fedit))
+        if os.path.exists(fedit):
+            os.remove(fedit)
+        if derep_path:
+            utils._upload_file(config, bucket, os.path.join(derep_path, fout), fout, compression=compression, stats=stats)
+
+        result = {
+            "chunk": chunk_id,
+            "filtered_size": filtered_records,
+            "derep_size": derep_size,
+            **stats.as_dict("fused")
+        }
+
+        # 4. Cluster the dereplicated reads
+        if cluster_args:
+            result.update(ClusterMap._cluster_file(os.path.join(tmpdir, fout), config, bucket, remote_path,
+                                                   tmpdir=tmpdir, compression=compression, **cluster_args))
+        os.remove(fout)
+        return result
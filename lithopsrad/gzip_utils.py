@@ -0,0 +1,217 @@
+import os
+import sys
+import gzip
+import zlib
+import struct
+from array import array
+from bisect import bisect_right
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _read_exact(stream, n):
+    """Read exactly n bytes from a stream (fewer only at end of stream)."""
+    chunks = []
+    while n > 0:
+        data = stream.read(n)
+        if not data:
+            break
+        chunks.append(data)
+        n -= len(data)
+    return b"".join(chunks)
+
+
+def _get_bsize(extra):
+    """
+    Parse the BSIZE value from the extra field of a BGZF block header.
+
+    Args:
+    - extra (bytes): The gzip FEXTRA payload.
+
+    Returns:
+    - int: Total block size minus one, or None if there is no 'BC' subfield.
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = extra[pos], extra[pos + 1], struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+        if si1 == 66 and si2 == 67 and slen == 2:
+            return struct.unpack("<H", extra[pos + 4:pos + 6])[0]
+        pos += 4 + slen
+    return None
+
+
+def is_bgzf_header(header):
+    """
+    Check whether the first bytes of a file are a BGZF block header.
+
+    Args:
+    - header (bytes): At least the first 18 bytes of the file.
+
+    Returns:
+    - bool: True if the header is gzip with a BGZF 'BC' extra subfield.
+    """
+    if len(header) < 18 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+        return False
+    xlen = struct.unpack("<H", header[10:12])[0]
+    return _get_bsize(header[12:12 + xlen]) is not None
+
+
+def iter_bgzf_blocks(stream):
+    """
+    Iterate over the raw blocks of a BGZF stream without decompressing them.
+
+    Args:
+    - stream: Binary stream positioned at the start of a block.
+
+    Yields:
+    - bytes: Next complete (compressed) block.
+
+    Raises:
+    - ValueError: If the stream is not valid BGZF.
+    """
+    while True:
+        header = _read_exact(stream, 12)
+        if not header:
+            return
+        if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+            raise ValueError("Stream does not appear to be BGZF (missing gzip FEXTRA header).")
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = _read_exact(stream, xlen)
+        bsize = _get_bsize(extra)
+        if bsize is None:
+            raise ValueError("Stream does not appear to be BGZF (missing BC subfield).")
+        yield header + extra + _read_exact(stream, bsize + 1 - 12 - xlen)
+
+
+def decompress_bgzf_block(block):
+    """Decompress a single raw BGZF block."""
+    xlen = struct.unpack("<H", block[10:12])[0]
+    return zlib.decompress(block[12 + xlen:-8], -15)
+
+
+class BGZFReader:
+    """
+    Streaming reader for BGZF data which records the block table as it goes.
+
+    After (partially) reading, coffsets[i] and ustarts[i] give the compressed and
+    uncompressed offsets of block i, which block_range() uses to translate an
+    uncompressed byte range into the compressed blocks that contain it.
+    """
+    def __init__(self, stream):
+        self._blocks = iter_bgzf_blocks(stream)
+        self._buffer = b""
+        self.coffsets = array('q')
+        self.ustarts = array('q')
+        self.csize = 0
+        self.usize = 0
+
+
+    def _next_block(self):
+        block = next(self._blocks, None)
+        if block is None:
+            return None
+        data = decompress_bgzf_block(block)
+        self.coffsets.append(self.csize)
+        self.ustarts.append(self.usize)
+        self.csize += len(block)
+        self.usize += len(data)
+        return data
+
+
+    def read(self, n=-1):
+        while n < 0 or len(self._buffer) < n:
+            data = self._next_block()
+            if data is None:
+                break
+            self._buffer += data
+        if n < 0:
+            n = len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+
+    def block_range(self, start, end):
+        """
+        Translate an uncompressed byte range into a compressed one.
+
+        Args:
+        - start (int): Uncompressed start offset.
+        - end (int): Uncompressed end offset (exclusive).
+
+        Returns:
+        - dict: 'start'/'end' compressed byte range covering whole blocks, and
+                'offset'/'length' of the requested data within the decompressed range.
+        """
+        first = bisect_right(self.ustarts, start) - 1
+        last = bisect_right(self.ustarts, end - 1) - 1
+        cend = self.coffsets[last + 1] if last + 1 < len(self.coffsets) else self.csize
+        return {
+            "start": self.coffsets[first],
+            "end": cend,
+            "offset": start - self.ustarts[first],
+            "length": end - start
+        }
+
+
+class GzipDecompressor:
+    """
+    Incremental decompressor for (possibly multi-member, e.g. BGZF) gzip data.
+    """
+    def __init__(self):
+        self._decomp = zlib.decompressobj(31)
+
+
+    def decompress(self, data):
+        out = []
+        while data:
+            out.append(self._decomp.decompress(data))
+            # start a new member on concatenated gzip files
+            if not self._decomp.eof:
+                break
+            data = self._decomp.unused_data
+            self._decomp = zlib.decompressobj(31)
+        return b"".join(out)
+
+
+class GzipStreamReader:
+    """
+    Streaming reader for (possibly multi-member) gzip data from a non-seekable stream.
+    """
+    def __init__(self, stream, block_size=1 << 20):
+        self._stream = stream
+        self._block_size = block_size
+        self._decomp = GzipDecompressor()
+        self._buffer = b""
+        self._eof = False
+
+
+    def _fill(self):
+        data = self._stream.read(self._block_size)
+        if not data:
+            self._eof = True
+            return
+        self._buffer += self._decomp.decompress(data)
+
+
+    def read(self, n=-1):
+        while not self._eof and (n < 0 or len(self._buffer) < n):
+            self._fill()
+        if n < 0:
+            n = len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+
+def decompress_range(data, offset, length):
+    """
+    Decompress a run of whole BGZF blocks and return the requested slice.
+
+    Args:
+    - data (bytes): Compressed bytes covering whole blocks.
+    - offset (int): Uncompressed offset of the slice within the blocks.
+    - length (int): Uncompressed length of the slice.
+
+    Returns:
+    - bytes: The uncompressed slice.
+    """
+    return gzip.decompress(data)[offset:offset + length]
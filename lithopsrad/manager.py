@@ -10,8 +10,64 @@ import traceback
 from lithopsrad.fastq_chunker import FASTQChunker
 from lithopsrad.fastq_filter import FASTQFilter
 from lithopsrad.fastq_derep import FASTQDerep
+from lithopsrad.fastq_fused import FASTQFused
+from lithopsrad.derep_reduce import DerepReduce
 from lithopsrad.cluster_map import ClusterMap
 from lithopsrad.cluster_merge import ClusterMerge
+import lithopsrad.utils as utils
+
+# defaults for optional runtime args, keyed by config section
+DEFAULT_ARGS = {
+    "global": {
+        "nthreads": 1,
+        "upload_part_size": 64 * 1024 * 1024,
+        "upload_threads": 8,
+        "compression": None,
+        "hits_format": "text",
+        "cleanup": False
+    },
+    "remote_paths": {
+        "tmpdir": None,
+        "fastq_uniques": "fastq_uniques",
+        "derep_quals": "derep_quals"
+    },
+    "input": {
+        "chunk_mode": "copy",
+        "adaptive_chunks": False,
+        "target_runtime": 60,
+        "worker_throughput": 8 * 1024 * 1024,
+        "worker_memory": None,
+        "max_sample_chunks": 64,
+        "pack_samples": True
+    },
+    "edit": {
+        "engine": "vsearch"
+    },
+    "derep": {
+        "pair_mode": "join",
+        "engine": "vsearch",
+        "max_uniques": 1000000,
+        "output_format": "fastq",
+        "qual_summary": False
+    },
+    "derep_reduce": {
+        "enabled": False,
+        "shards": 1
+    },
+    "clust_merge": {
+        "deferred_hits": False,
+        "max_fan_in": 8,
+        "max_group_clusters": 2000000,
+        "catalog_path": None,
+        "incremental": False,
+        "shards": 1,
+        "minimizer_k": 15
+    },
+    "fused": {
+        "stages": None,
+        "keep_intermediates": False
+    }
+}
 
 def step_handler(step_name):
     def decorator(func):
@@ -25,6 +81,7 @@ def step_handler(step_name):
 
                 # Store the result in the results dictionary.
                 self.results[step_name] = module.result
+                self.modules[step_name] = module
 
                 # Return the module instance.
                 return module
@@ -42,19 +99,31 @@ class PipelineManager:
         self.config_file = config_file
         self.lithops_config, self.runtime_config = self.get_params_from_json()
         self.results = {}  # This will store the results of each module.
+        self.modules = {}  # and the modules themselves, for cleanup()
 
 
     def run(self):
         """
         Execute the pipeline.
         """
-        # fastq processing 
+        # fastq processing; filter and derep (and optionally the within-sample 
+        # clustering) can run fused into a single stage 
+        fused = self.runtime_config["fused"]["stages"]
         self.run_fastq_chunker()
-        self.run_fastq_filter()
-        self.run_fastq_derep()
-
-        # within-sample clustering 
-        self.run_clust_within()
+        if fused:
+            self.run_fastq_fused()
+        else:
+            self.run_fastq_filter()
+            self.run_fastq_derep()
+
+        # within-sample clustering, optionally after dereplicating samples across chunks 
+        # (not available when clustering is fused into the chunk workers) 
+        if fused != "cluster":
+            if self.runtime_config["derep_reduce"]["enabled"]:
+                self.run_derep_reduce()
+            self.run_clust_within()
+        elif self.runtime_config["derep_reduce"]["enabled"]:
+            print("Skipping DerepReduce (not available with fused stages 'cluster'); size limits apply per chunk")
         self.run_clustmerge_within()
 
         # among-sample cluster merge
@@ -64,8 +133,14 @@ class PipelineManager:
         # calling 
         # locus/catalog filter 
 
-        # TODO: Implement cleanup() methods in relevant steps to remove intermediate files from bucket 
+        # remove intermediate files from bucket 
+        if self.runtime_config["global"]["cleanup"]:
+            self.cleanup()
+
 
+        # storage clients created by the driver (see utils._get_storage)
+        stats = utils.storage_stats()
+        print(f"Storage clients: {stats['clients']} created in {stats['setup_time']:.2f}s, for {stats['requests']} requests")
 
         sample_summary, chunk_summary = self.summarize_results()
         print(chunk_summary)
@@ -92,6 +167,18 @@ class PipelineManager:
         module.validate()
         return module
     
+    @step_handler("FASTQFused")
+    def run_fastq_fused(self):
+        module = FASTQFused(self.lithops_config, self.runtime_config)
+        module.validate()
+        return module
+
+    @step_handler("DerepReduce")
+    def run_derep_reduce(self):
+        module = DerepReduce(self.lithops_config, self.runtime_config)
+        module.validate()
+        return module
+
     @step_handler("ClusterMapWithin")
     def run_clust_within(self):
         module = ClusterMap(self.lithops_config, self.runtime_config, mode="clust_within")
@@ -100,17 +187,38 @@ class PipelineManager:
 
     @step_handler("ClusterMergeWithin")
     def run_clustmerge_within(self):
-        module = ClusterMerge(self.lithops_config, self.runtime_config, mode="clust_within")
+        # cluster counts of the chunks, for planning the merges 
+        step = "FASTQFused" if self.runtime_config["fused"]["stages"] == "cluster" else "ClusterMapWithin"
+        counts = self._get_result_column(step, "chunk", "clusters")
+        module = ClusterMerge(self.lithops_config, self.runtime_config, mode="clust_within", cluster_counts=counts)
         module.validate()
         return module
     
     @step_handler("ClusterMergeAcross")
     def run_clustmerge_across(self):
-        module = ClusterMerge(self.lithops_config, self.runtime_config, mode="clust_across")
+        counts = self._get_result_column("ClusterMergeWithin", "sample", "clusters_merged")
+        module = ClusterMerge(self.lithops_config, self.runtime_config, mode="clust_across", cluster_counts=counts)
         module.validate()
         return module
 
 
+    def _get_result_column(self, step, key, column):
+        """Return a column of a step's results as a dict by key, or None if not available."""
+        result = self.results.get(step)
+        if result is None or key not in result.columns or column not in result.columns:
+            return None
+        result = result.dropna(subset=[column])
+        return dict(zip(result[key], result[column].astype(int)))
+
+
+    def cleanup(self):
+        """
+        Remove the intermediate outputs of the steps run (see Module.cleanup) from the bucket.
+        """
+        removed = sum(module.cleanup() for module in self.modules.values())
+        print(f"Removed {removed} intermediate files")
+
+
     def summarize_results(self):
         """
         Merges results into sample_summary and chunk_summary dataframes.
@@ -170,9 +278,10 @@ class PipelineManager:
         Set default parameters if not present in the config.
         """
         # set defaults
-        if "tmpdir" not in args["remote_paths"]:
-            args["remote_paths"]["tmpdir"] = None
-        if "nthreads" not in args["global"]:
-            args["global"]["nthreads"] = 1
+        for section, defaults in DEFAULT_ARGS.items():
+            args.setdefault(section, {})
+            for key, value in defaults.items():
+                if key not in args[section]:
+                    args[section][key] = value
         return args
 
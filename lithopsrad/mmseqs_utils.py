@@ -5,10 +5,327 @@ import tempfile
 import subprocess as sp
 import io
 import re
+import csv
+import json
+
+import numpy as np
+import pandas as pd
 
 import lithopsrad.sequence as seq
 
 
+class ClusterTable:
+    """
+    Compact (CSR) form of a hits table: centroid i has depth depths[i] and members
+    members[offsets[i]:offsets[i + 1]]. IDs are stored without their ';size=' tag.
+
+    Attributes:
+    - names (np.ndarray[object]): Centroid IDs.
+    - depths (np.ndarray[int64]): Depth of each centroid.
+    - offsets (np.ndarray[int64]): Start of the members of each centroid (len(names) + 1 entries).
+    - members (np.ndarray[object]): Member IDs, grouped by centroid.
+    """
+    def __init__(self, names, depths, offsets, members):
+        self.names = names
+        self.depths = depths
+        self.offsets = offsets
+        self.members = members
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def counts(self):
+        """Number of members of each centroid."""
+        return np.diff(self.offsets)
+
+
+    def items(self):
+        """Iterate over (centroid, list of members), like the dict form of a hits table."""
+        for i, name in enumerate(self.names):
+            yield name, self.members[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+    def append_singletons(self, names, depths):
+        """Add centroids without members (e.g. ones missing from the mmseqs TSV)."""
+        self.names = np.concatenate([self.names, np.asarray(names, dtype=object)])
+        self.depths = np.concatenate([self.depths, np.asarray(depths, dtype=np.int64)])
+        self.offsets = np.concatenate([self.offsets, np.full(len(names), self.offsets[-1], dtype=np.int64)])
+
+
+# magic bytes of binary hits tables (see write_hits_binary)
+HITS_MAGIC = b"LRHITS\x01\n"
+HITS_ALIGN = 64
+
+
+class HitsTable:
+    """
+    Hits table over interned IDs: centroid strings[centroids[i]] has members
+    strings[members[offsets[i]:offsets[i + 1]]]. The integer arrays may be memory-mapped
+    (see read_hits_binary).
+
+    Attributes:
+    - strings (np.ndarray[object]): String table of centroid and member IDs.
+    - centroids (np.ndarray[int64]): Centroid of each row, as an index into strings.
+    - offsets (np.ndarray[int64]): Start of the members of each row (len(centroids) + 1 entries).
+    - members (np.ndarray[int64]): Members, as indices into strings, grouped by row.
+    """
+    def __init__(self, strings, centroids, offsets, members):
+        self.strings = strings
+        self.centroids = centroids
+        self.offsets = offsets
+        self.members = members
+
+
+    def __len__(self):
+        return len(self.centroids)
+
+
+    def counts(self):
+        """Number of members of each centroid."""
+        return np.diff(self.offsets)
+
+
+    def items(self):
+        """Iterate over (centroid, list of members), like the dict form of a hits table."""
+        for i, centroid in enumerate(self.centroids):
+            yield self.strings[centroid], self.strings[self.members[self.offsets[i]:self.offsets[i + 1]]].tolist()
+
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+    def edges(self):
+        """Return the (centroid, member) pairs of the table as two index arrays."""
+        return np.repeat(np.asarray(self.centroids), self.counts()), np.asarray(self.members)
+
+
+    @staticmethod
+    def from_pairs(strings, centroids, edge_centroids, edge_members):
+        """
+        Build a table from centroid (row) indices and (centroid, member) pairs over a string table.
+
+        Args:
+        - strings (np.ndarray[object]): String table.
+        - centroids (np.ndarray[int64]): Row centroids, unique, in output order.
+        - edge_centroids (np.ndarray[int64]): Centroid of each pair (must be one of centroids).
+        - edge_members (np.ndarray[int64]): Member of each pair.
+        """
+        rows = np.full(len(strings), -1, dtype=np.int64)
+        rows[centroids] = np.arange(len(centroids))
+        edge_rows = rows[edge_centroids]
+        order = np.argsort(edge_rows, kind="stable")
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_rows, minlength=len(centroids)), out=offsets[1:])
+        return HitsTable(strings, np.asarray(centroids, dtype=np.int64), offsets,
+                         np.asarray(edge_members, dtype=np.int64)[order])
+
+
+class DisjointSet:
+    """
+    Union-find over integer IDs 0..n-1, with path compression.
+
+    Used to merge hits tables as forests: each member links to the centroid it was
+    clustered into, so a merge only adds links for the centroids it absorbs, and the
+    full membership of each cluster is its root's set (see resolve_hits).
+    """
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+
+
+    def find(self, ids):
+        """Return the roots of ids, pointing each of them directly at its root."""
+        ids = np.asarray(ids, dtype=np.int64)
+        roots = ids
+        while True:
+            parents = self.parent[roots]
+            if np.array_equal(parents, roots):
+                break
+            roots = parents
+        self.parent[ids] = roots
+        return roots
+
+
+    def union(self, keep, absorbed):
+        """
+        Merge the set of each absorbed[i] into that of keep[i], linking root under root.
+
+        All pairs are linked at once, so as in a clustering or a stored forest, each set
+        may only be absorbed once per call.
+        """
+        keep_roots, absorbed_roots = self.find(keep), self.find(absorbed)
+        merge = keep_roots != absorbed_roots
+        self.parent[absorbed_roots[merge]] = keep_roots[merge]
+
+
+    def roots(self):
+        """Return the root of every ID, compressing all paths at once (by pointer jumping)."""
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        self.parent = parent
+        return parent
+
+
+    def is_root(self):
+        return self.parent == np.arange(len(self.parent))
+
+
+def as_hits_table(hits):
+    """Convert a hits table given as a dict of lists, ClusterTable or HitsTable to a HitsTable."""
+    if isinstance(hits, HitsTable):
+        return hits
+    if isinstance(hits, ClusterTable):
+        names, counts, members = hits.names, hits.counts(), hits.members
+    else:
+        names = np.array(list(hits.keys()), dtype=object)
+        counts = np.fromiter((len(v) for v in hits.values()), dtype=np.int64, count=len(hits))
+        members = np.array([m for v in hits.values() for m in v], dtype=object)
+    codes, strings = pd.factorize(np.concatenate([names, members]).astype(object))
+    centroids, member_codes = codes[:len(names)], codes[len(names):]
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return HitsTable(np.asarray(strings, dtype=object), centroids.astype(np.int64), offsets, member_codes.astype(np.int64))
+
+
+def is_binary_hits(infile):
+    """Return whether a local hits file is in the binary format, from its magic bytes."""
+    with open(infile, "rb") as fh:
+        return fh.read(len(HITS_MAGIC)) == HITS_MAGIC
+
+
+def _hits_data_start(header_len):
+    start = len(HITS_MAGIC) + 8 + header_len
+    return (start + HITS_ALIGN - 1) // HITS_ALIGN * HITS_ALIGN
+
+
+def write_hits_binary(hits, outfile):
+    """
+    Write a hits table in the binary format: the magic bytes, the length of a JSON header
+    (string count and, per array, its dtype, length and offset from the start of the data),
+    then the newline-joined string table and the centroid, offset and member arrays, each
+    aligned to HITS_ALIGN bytes. IDs are int32 unless the string table needs int64.
+
+    Args:
+        hits(Dict[str, List[str]], ClusterTable or HitsTable): The hits table.
+        outfile(str): Name for the output hits file.
+    """
+    table = as_hits_table(hits)
+    id_dtype = "<i4" if len(table.strings) < 2 ** 31 else "<i8"
+    arrays = {
+        "strings": np.frombuffer("\n".join(table.strings).encode("utf-8"), dtype=np.uint8),
+        "centroids": np.asarray(table.centroids, dtype=id_dtype),
+        "offsets": np.asarray(table.offsets, dtype="<i8"),
+        "members": np.asarray(table.members, dtype=id_dtype)
+    }
+    layout = {}
+    pos = 0
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, len(array), pos]
+        pos += (array.nbytes + HITS_ALIGN - 1) // HITS_ALIGN * HITS_ALIGN
+    header = json.dumps({"nstrings": len(table.strings), "arrays": layout}).encode("utf-8")
+    start = _hits_data_start(len(header))
+    with open(outfile, "wb") as ofh:
+        ofh.write(HITS_MAGIC + len(header).to_bytes(8, "little") + header)
+        for name, array in arrays.items():
+            ofh.write(b"\0" * (start + layout[name][2] - ofh.tell()))
+            ofh.write(array.tobytes())
+
+
+def read_hits_binary(infile, mmap=True):
+    """
+    Read a binary hits table (see write_hits_binary).
+
+    Args:
+        infile(str): Local hits file.
+        mmap(bool): Memory-map the integer arrays rather than reading them. Defaults to True.
+    Returns:
+        HitsTable: The hits table.
+    Raises:
+        ValueError: If the file is not a binary hits table.
+    """
+    with open(infile, "rb") as fh:
+        if fh.read(len(HITS_MAGIC)) != HITS_MAGIC:
+            raise ValueError(f"{infile} is not a binary hits table.")
+        header_len = int.from_bytes(fh.read(8), "little")
+        header = json.loads(fh.read(header_len))
+    start = _hits_data_start(header_len)
+    arrays = {}
+    for name, (dtype, length, offset) in header["arrays"].items():
+        if not length:
+            arrays[name] = np.empty(0, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(infile, dtype=dtype, mode="r", offset=start + offset, shape=(length,))
+        else:
+            arrays[name] = np.fromfile(infile, dtype=dtype, count=length, offset=start + offset)
+    strings = arrays["strings"].tobytes().decode("utf-8").split("\n") if header["nstrings"] else []
+    return HitsTable(np.array(strings, dtype=object), arrays["centroids"], arrays["offsets"], arrays["members"])
+
+
+def load_hits(infile, mmap=True):
+    """Read a local hits file in either format (sniffed from its magic bytes) as a HitsTable."""
+    if is_binary_hits(infile):
+        return read_hits_binary(infile, mmap=mmap)
+    return as_hits_table(read_hits(infile))
+
+
+def read_mmseqs_clusters(tmp_hits, count_members=False):
+    """
+    Read an mmseqs '_cluster.tsv' (centroid \t member, both 'ID;size=N') into a ClusterTable.
+
+    The ';size=' tags are split off in bulk by rewriting them as extra columns before parsing
+    with the pandas C engine. A centroid's depth is its own size plus the sizes of its members,
+    or plus its number of members if count_members is set.
+
+    Args:
+    - tmp_hits (str): Path to the mmseqs cluster TSV.
+    - count_members (bool, optional): Count members instead of summing their sizes. Defaults to False.
+
+    Returns:
+    - ClusterTable: Centroids in order of first appearance, with their depths and members.
+    """
+    with open(tmp_hits, "rb") as fh:
+        data = fh.read().replace(b";size=", b"\t")
+    if not data.strip():
+        return ClusterTable(np.array([], dtype=object), np.array([], dtype=np.int64),
+                            np.zeros(1, dtype=np.int64), np.array([], dtype=object))
+    # read IDs verbatim: no NA parsing (e.g. "NA", "null") and no quote handling
+    df = pd.read_csv(io.BytesIO(data), sep="\t", header=None, engine="c",
+                     keep_default_na=False, na_filter=False, quoting=csv.QUOTE_NONE,
+                     names=["centroid", "centroid_size", "member", "member_size"],
+                     dtype={"centroid": object, "centroid_size": np.int64, "member": object, "member_size": np.int64})
+
+    # 1. Index centroids (in order of first appearance)
+    codes, names = pd.factorize(df["centroid"])
+    depths = np.zeros(len(names), dtype=np.int64)
+    depths[codes] = df["centroid_size"].to_numpy()
+
+    # 2. Add up members (rows other than the centroid's self-match)
+    is_member = df["centroid"].to_numpy() != df["member"].to_numpy()
+    member_codes = codes[is_member]
+    if count_members:
+        depths += np.bincount(member_codes, minlength=len(names))
+    else:
+        depths += np.bincount(member_codes, weights=df["member_size"].to_numpy()[is_member],
+                              minlength=len(names)).astype(np.int64)
+
+    # 3. Group members by centroid
+    order = np.argsort(member_codes, kind="stable")
+    members = df["member"].to_numpy()[is_member][order]
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(member_codes, minlength=len(names)), out=offsets[1:])
+    return ClusterTable(np.asarray(names, dtype=object), depths, offsets, members)
+
+
 def get_cluster_info(fasta_file):
     """Get number of clusters and average depth from fasta file.
     
@@ -66,48 +383,85 @@ def get_size_from_key(key):
 #     return(joined_hits)
 
 
+
 def make_merged_hits_table(left_hits, right_hits, infile):
-    # get hit dicts for left, right, and joined outputs
-    left_members = read_hits(left_hits)
-    right_members = read_hits(right_hits)
-    intermediate_hits = read_hits(infile)
+    """
+    Merge the hits tables of two clustered inputs through the hits of clustering their centroids.
 
-    joined_hits = {}
-    seen_centroids = set()
+    Tables are forests: each row lists the IDs directly linked to a centroid, so members of
+    members belong to its cluster too. The left and right forests are loaded into a DisjointSet
+    over a common string table, and each centroid absorbed in the intermediate (infile)
+    clustering is linked under the one that absorbed it; left and right centroids not involved
+    stay roots. Only the links are kept, the clusters are materialized once by resolve_hits at
+    the end of ClusterMerge.
 
-    # grab constituents for each centroid involved in a hit
-    for int_hit, centroids in intermediate_hits.items():
-        seen_centroids.add(int_hit)
-        seen_centroids.update(centroids)
+    Args:
+        left_hits, right_hits, infile: Hits tables, as local files (either format) or tables.
+    Returns:
+        HitsTable: The merged forest, with a row per root centroid or node with links.
+    """
+    return merge_hits_tables([left_hits, right_hits], infile)
 
-        for c in centroids:
-            joined_hits.setdefault(int_hit, set()).update(left_members.get(c, []))
-            joined_hits.setdefault(int_hit, set()).update(right_members.get(c, []))
 
-        joined_hits.setdefault(int_hit, set()).update(left_members.get(int_hit, []))
-        joined_hits.setdefault(int_hit, set()).update(right_members.get(int_hit, []))
-        joined_hits[int_hit].update(centroids)
+def merge_hits_tables(inputs, infile):
+    """Merge the hits tables of any number of clustered inputs (see make_merged_hits_table)."""
+    return _forest_to_table(*_union_tables(list(inputs) + [infile]))
 
-    # Add missing keys from left_members and right_members to joined_hits
-    for key, value in left_members.items():
-        if key not in seen_centroids:
-            joined_hits.setdefault(key, set()).update(value)
 
-    for key, value in right_members.items():
-        if key not in seen_centroids:
-            joined_hits.setdefault(key, set()).update(value)
+def _union_tables(tables):
+    """
+    Load hits tables (forests, or per-round edge lists, in merge order) into one DisjointSet
+    over a common string table.
+
+    Returns:
+        tuple(np.ndarray, DisjointSet, np.ndarray): The string table, the forest, and which IDs are centroids.
+    """
+    tables = [load_hits(t) if isinstance(t, str) else as_hits_table(t) for t in tables]
+    codes, strings = pd.factorize(np.concatenate([t.strings for t in tables] + [np.array([], dtype=object)]).astype(object))
+    forest = DisjointSet(len(strings))
+    is_centroid = np.zeros(len(strings), dtype=bool)
+    start = 0
+    for table in tables:
+        ids = codes[start:start + len(table.strings)]
+        start += len(table.strings)
+        forest.union(*(ids[a] for a in table.edges()))
+        is_centroid[ids[np.asarray(table.centroids)]] = True
+    return np.asarray(strings, dtype=object), forest, is_centroid
+
+
+def _forest_to_table(strings, forest, is_centroid):
+    """Store a DisjointSet as a hits table of direct links (see make_merged_hits_table)."""
+    children = np.flatnonzero(~forest.is_root())
+    parents = forest.parent[children]
+    rows = pd.unique(np.concatenate([np.flatnonzero(is_centroid & forest.is_root()), parents]))
+    return HitsTable.from_pairs(strings, rows, parents, children)
+
+
+def resolve_hits(*tables):
+    """
+    Materialize the clusters of hits forests (see make_merged_hits_table), or of the leaf
+    hits tables and per-round edge lists of a deferred ClusterMerge, given in merge order:
+    one row per root centroid, listing every ID linked to it directly or through other members.
 
-    # Convert sets back to lists
-    for key in joined_hits:
-        joined_hits[key] = list(joined_hits[key])
+    Args:
+        tables: Hits tables, as local files (either format) or tables.
+    Returns:
+        HitsTable: The resolved hits table.
+    """
+    strings, forest, is_centroid = _union_tables(tables)
+    roots = forest.roots()
 
-    return joined_hits
+    # a single linear pass: group every non-root ID under its root
+    is_root = forest.is_root()
+    rows = np.flatnonzero(is_centroid & is_root)
+    members = np.flatnonzero(~is_root)
+    return HitsTable.from_pairs(strings, rows, roots[members], members)
 
 
 def read_hits(infile):
     """
     Read hits table to a dict
-    format: key \t member1,member2..memberN
+    format: key \t member1,member2..memberN (or the binary format, see write_hits_binary)
     Args:
         infile(str): .temp.h file (hits file written by write_hits)
     Returns:
@@ -119,21 +473,24 @@ def read_hits(infile):
     hits = {}
     
     try:
-        with open(infile, "r") as ifh:
-            for line in ifh:
-                line = line.strip()
+        if is_binary_hits(infile):
+            hits = read_hits_binary(infile).to_dict()
+        else:
+            with open(infile, "r") as ifh:
+                for line in ifh:
+                    line = line.strip()
 
-                # Skip empty lines
-                if not line:
-                    continue
+                    # Skip empty lines
+                    if not line:
+                        continue
 
-                split_line = line.split()
+                    split_line = line.split()
 
-                # Handle only one element or empty second element in the line
-                if len(split_line) == 1 or not split_line[1]:
-                    hits[split_line[0]] = []
-                else:
-                    hits[split_line[0]] = split_line[1].split(",")
+                    # Handle only one element or empty second element in the line
+                    if len(split_line) == 1 or not split_line[1]:
+                        hits[split_line[0]] = []
+                    else:
+                        hits[split_line[0]] = split_line[1].split(",")
     except (IOError, FileNotFoundError):
         sys.exit(f"Could not open hits file {infile}")
     finally:
@@ -141,64 +498,63 @@ def read_hits(infile):
 
 
 def parse_mmseqs(tmp_hits, tmp_centroids, count_members=False):
-    hits = dict()
-    depths = dict()
-    centroids = {}
-
-    for record in read_mmseq_hits(tmp_hits):
-        hit_spl = record[0].split(";size=")
-        q_spl = record[1].split(";size=")
+    """
+    Parse mmseqs easy-linclust outputs into a hits table and centroids with updated depths.
 
-        if hit_spl[0] not in depths:
-            depths[hit_spl[0]] = int(hit_spl[1])
+    Args:
+    - tmp_hits (str): Path to the '_cluster.tsv' output.
+    - tmp_centroids (str): Path to the '_rep_seq.fasta' output.
+    - count_members (bool, optional): See read_mmseqs_clusters. Defaults to False.
 
-        if hit_spl[0] == q_spl[0]:
-            hits[hit_spl[0]] = list()
-        else:
-            # update hits record for centroid
-            if hit_spl[0] not in hits:
-                hits[hit_spl[0]] = list()
-            hits[hit_spl[0]].append(q_spl[0])
-            
-            # update depth for centroid based on the chosen option
-            if count_members:
-                depths[hit_spl[0]] += 1
-            else:
-                depths[hit_spl[0]] += int(q_spl[1])
+    Returns:
+    - tuple(ClusterTable, dict): The hits table (every centroid included), and the centroid 
+                                 sequences keyed by 'ID;size=<depth>' headers.
+    """
+    hits = read_mmseqs_clusters(tmp_hits, count_members)
+    depths = dict(zip(hits.names.tolist(), hits.depths.tolist()))
 
     # adjust fasta headers with new depths
+    centroids = {}
+    missing = {}
     for header, sequence in seq.read_fasta(tmp_centroids):
         h_spl = header.split(";size=")
         if h_spl[0] in depths:
             header = str(h_spl[0]) + ";size=" + str(depths[h_spl[0]])
-        else:
-            depths[h_spl[0]] = int(h_spl[1])
-
+        elif h_spl[0] not in missing:
+            # Ensure every centroid is represented in the hits table
+            missing[h_spl[0]] = int(h_spl[1])
         centroids[header] = sequence
-
-        # Ensure every centroid is represented in the hits table
-        if h_spl[0] not in hits:
-            hits[h_spl[0]] = []
+    if missing:
+        hits.append_singletons(list(missing), list(missing.values()))
 
     return hits, centroids
 
 
 
-def write_hits(hits, outfile):
+def write_hits(hits, outfile, binary=False):
     """Write hits dictionary to file
     format: key \t member1,member2..memberN)
 
     Args:
-        hits(Dict[str, List[str]]): Where key[str] is the derep ID for a centroid and List[str] are members
+        hits(Dict[str, List[str]] or ClusterTable): Where key[str] is the derep ID for a centroid and List[str] are members
         outfile(str): Name for output hits file (usually .temp.h)
+        binary(bool): Write the binary format (see write_hits_binary) rather than text. Defaults to False.
     Returns:
         None
     Raises:
         OSError: Unable to write to specified file
     """
+    if binary:
+        return write_hits_binary(hits, outfile)
     try:
         with open(outfile, "w") as ofh:
-            # Sort hits dictionary by the length of their value lists in descending order
+            # Sort hits by their number of members in descending order
+            if isinstance(hits, (ClusterTable, HitsTable)):
+                table = as_hits_table(hits)
+                for i in np.argsort(-table.counts(), kind="stable"):
+                    members = table.strings[table.members[table.offsets[i]:table.offsets[i + 1]]]
+                    ofh.write(str(table.strings[table.centroids[i]]) + "\t" + ",".join(members) + "\n")
+                return
             sorted_hits = sorted(hits.items(), key=lambda x: len(x[1]), reverse=True)
             
             for key, value in sorted_hits:
@@ -1,10 +1,12 @@
 import os 
 import sys 
 import time 
+import functools
 import pandas as pd 
 from lithops import FunctionExecutor
 
 import lithopsrad.utils as utils
+import lithopsrad.zstd_utils as zstd_utils
 
 
 def time_it(func):
@@ -17,6 +19,21 @@ def time_it(func):
         return result
     return wrapper
 
+
+def packable(func):
+    """
+    Let a chunk worker take a pack of chunks (see FASTQChunker._plan_packs), in which 
+    case it is run on each chunk in turn and returns a list with one result per chunk.
+    Only modules with a packable worker get packed chunks (see Module.list_input_chunks).
+    """
+    @functools.wraps(func)
+    def wrapper(chunk_obj, *args, **kwargs):
+        if isinstance(chunk_obj, dict) and "pack" in chunk_obj:
+            return [func(chunk, *args, **kwargs) for chunk in chunk_obj["pack"]]
+        return func(chunk_obj, *args, **kwargs)
+    wrapper.packable = True
+    return wrapper
+
 class Module:
     def __init__(self, lithops_config, runtime_config):
         # globally required attributes 
@@ -25,6 +42,13 @@ class Module:
         self.bucket = self.runtime_config["global"]["bucket"]
         self.tmpdir = self.runtime_config["remote_paths"]["tmpdir"]
         self.nthreads = self.runtime_config["global"]["nthreads"]
+        self.upload_part_size = self.runtime_config["global"]["upload_part_size"]
+        self.upload_threads = self.runtime_config["global"]["upload_threads"]
+
+        # zstd level for intermediate objects written by workers, None to leave them uncompressed
+        self.compression = self.runtime_config["global"]["compression"]
+        if self.compression is not None:
+            zstd_utils._require_zstandard()
 
         # placeholders, should be defined in submodules 
         self.runtime = -1
@@ -34,6 +58,9 @@ class Module:
         self._func = None
         self._reduce_func = None
 
+        # remote prefixes of intermediate outputs, removed by cleanup()
+        self.cleanup_paths = []
+
 
     def validate(self):
         # Check if the bucket in which the chunks reside exists and is accessible.
@@ -55,7 +82,7 @@ class Module:
             raise NotImplementedError("Function to run not set for this module.")
 
         # get chunks to process 
-        chunks = self.list_remote_files(self.input_path)
+        chunks = self.list_input_chunks(self.input_path)
 
         # create iterdata 
         iterdata = [self._get_iterdata(chunk) for chunk in chunks]
@@ -64,17 +91,24 @@ class Module:
         with FunctionExecutor(config=self.lithops_config) as fexec:
             fexec.map(self._func, iterdata)
             results = fexec.get_result()
-            self._results = results
+            # packed invocations return a list with one result per chunk
+            self._results = [r for res in results for r in (res if isinstance(res, list) else [res])]
 
 
     def _get_iterdata(self, obj):
-        cloud_path = utils._get_cloudobject(self.lithops_config, self.bucket, obj)
+        # virtual chunks are passed through as-is (see list_input_chunks). Note the key is 
+        # not 'obj', which lithops would treat as an object to partition
+        if isinstance(obj, dict):
+            cloud_path = obj
+        else:
+            cloud_path = utils._get_cloudobject(self.lithops_config, self.bucket, obj)
         data = {
-            "obj": cloud_path,
+            "chunk_obj": cloud_path,
             "config": self.lithops_config,
             "bucket": self.bucket,
             "remote_path": self.output_path,
-            "tmpdir": self.tmpdir
+            "tmpdir": self.tmpdir,
+            "compression": self.compression
         }
         return data
 
@@ -120,6 +154,118 @@ class Module:
         return utils._list_remote_files(self.lithops_config, self.bucket, prefix)
 
 
+    def list_input_chunks(self, prefix=None):
+        """
+        Lists the chunks under a prefix, using the chunk manifests written by FASTQChunker 
+        where present. Manifests of 'virtual' chunks are expanded into byte-range chunk 
+        descriptors; chunks listed in a manifest carry their checksum ('md5').
+
+        In paired mode the R2 objects (see utils.MATE_EXT) are not returned on their 
+        own but attached to their R1 chunk under a 'mate' key. Chunks packed together by 
+        FASTQChunker (see utils.PACKS_EXT) are returned as a single {'pack': [...]} dict, 
+        if the module's worker is packable. Later stages keep the chunk names (e.g. 
+        '0_sample1.edit'), so they use the plan written with the chunks.
+
+        Args:
+        - prefix (str, optional): Key prefix to list. Defaults to the module input path.
+
+        Returns:
+        - list: Object keys (str) for regular chunks, and dicts with 'Key' and optional 
+                'chunk', 'range', 'md5' and 'mate' entries for manifest or paired chunks.
+        """
+        prefix = prefix or self.input_path
+        keys = self.list_remote_files(prefix)
+
+        # chunks listed in manifests
+        chunks = []
+        listed = set()
+        for key in keys:
+            if not key.endswith(utils.MANIFEST_EXT):
+                continue
+            manifest = utils._read_json(self.lithops_config, self.bucket, key)
+            for chunk in manifest["chunks"]:
+                descriptor = self._get_manifest_chunk(manifest["key"], chunk)
+                if "mate" in chunk:
+                    descriptor["mate"] = self._get_manifest_chunk(manifest["key_r2"], chunk["mate"])
+                    listed.add(descriptor["mate"]["Key"])
+                listed.add(descriptor["Key"])
+                chunks.append(descriptor)
+
+        # any other objects
+        mates = set(key for key in keys if utils._is_mate(key))
+        for key in keys:
+            if key in listed or key in mates or key.endswith((utils.MANIFEST_EXT, utils.PACKS_EXT)):
+                continue
+            elif utils._get_mate_path(key) in mates:
+                chunks.append({"Key": key, "mate": {"Key": utils._get_mate_path(key)}})
+            else:
+                chunks.append(key)
+
+        # chunks of small samples packed into a single invocation
+        if getattr(self._func, "packable", False):
+            plans = [key for key in keys if key.endswith(utils.PACKS_EXT)] or self.list_remote_files(self._get_packs_path())
+            packs = [pack for key in plans for pack in utils._read_json(self.lithops_config, self.bucket, key)["packs"]]
+            if packs:
+                chunks = self._pack_chunks(chunks, packs)
+        return chunks
+
+
+    def _get_packs_path(self):
+        """Return the key of the chunk packing plan written by FASTQChunker (see _write_packs)."""
+        remote_paths = self.runtime_config["remote_paths"]
+        return os.path.join(utils.fix_dir_name(remote_paths["run_path"]), utils.fix_dir_name(remote_paths["fastq_chunks"]),
+                            "chunks" + utils.PACKS_EXT)
+
+
+    @staticmethod
+    def _pack_chunks(chunks, packs):
+        """
+        Group chunk descriptors into packs.
+
+        Args:
+        - chunks (list): Chunks as returned by list_input_chunks.
+        - packs (list[list[str]]): Chunk names to run together.
+
+        Returns:
+        - list: Chunks not in any pack, followed by one {'pack': [...]} dict per pack.
+        """
+        pack_of = {name: i for i, pack in enumerate(packs) for name in pack}
+        grouped = [[] for _ in packs]
+        unpacked = []
+        for chunk in chunks:
+            descriptor = chunk if isinstance(chunk, dict) else {"Key": chunk}
+            name = utils._get_chunk_name(descriptor)
+            if name in pack_of:
+                grouped[pack_of[name]].append(descriptor)
+            else:
+                unpacked.append(chunk)
+        return unpacked + [{"pack": pack} for pack in grouped if pack]
+
+
+    @staticmethod
+    def _get_manifest_chunk(key, chunk):
+        """
+        Build a chunk descriptor from a manifest chunk entry. Entries of copied chunks 
+        have their own 'key', entries of virtual chunks a byte range within the manifest key.
+        """
+        descriptor = {
+            "Key": chunk.get("key", key),
+            "chunk": chunk["chunk"]
+        }
+        if "start" in chunk:
+            descriptor["range"] = [chunk["start"], chunk["end"]]
+        # compressed (BGZF) chunks also need the slice within their blocks
+        if "offset" in chunk:
+            descriptor.update({
+                "compression": "bgzf",
+                "offset": chunk["offset"],
+                "length": chunk["length"]
+            })
+        if "md5" in chunk:
+            descriptor["md5"] = chunk["md5"]
+        return descriptor
+
+
     def check_remote_files(self, prefix, subset=3):
         """
         Check if a subset of remote files under a given prefix is reachable.
@@ -157,7 +303,37 @@ class Module:
             return utils._get_cloudobject(self.lithops_config, self.bucket, remote_path)
 
         # Upload the file
-        return utils._upload_file(self.lithops_config, self.bucket, remote_path, local_path)
+        return utils._upload_file(self.lithops_config, self.bucket, remote_path, local_path, 
+                                  part_size=self.upload_part_size, max_workers=self.upload_threads)
+
+
+    def upload_files(self, uploads, overwrite=True, callback=None):
+        """
+        Upload several local files concurrently (see utils._upload_files).
+
+        Args:
+        - uploads (list[tuple]): (remote_path, local_path) pairs.
+        - overwrite (bool, optional): If True, overwrite files that exist in remote storage. Defaults to True.
+        - callback (callable, optional): Called as callback(local_path, data) with every block read.
+
+        Returns:
+        - list[CloudObject]: The remote objects, in the same order as uploads.
+        """
+        pending = []
+        for remote_path, local_path in uploads:
+            if utils._remote_file_exists(self.lithops_config, self.bucket, remote_path):
+                if not overwrite:
+                    print(f"File {local_path} exists. Skipping.")
+                    continue
+                print(f"File {local_path} exists. Overwriting... ")
+            pending.append((remote_path, local_path))
+
+        if pending:
+            print(f"Uploading {len(pending)} files... ", flush=True)
+            utils._upload_files(self.lithops_config, self.bucket, pending, 
+                                part_size=self.upload_part_size, max_workers=self.upload_threads,
+                                callback=callback)
+        return [utils._get_cloudobject(self.lithops_config, self.bucket, remote_path) for remote_path, _ in uploads]
 
 
     def download_file(self, remote_path, local_path, overwrite=True):
@@ -227,6 +403,33 @@ class Module:
             return False
 
 
+    def delete_files(self, remote_paths):
+        """
+        Delete several files from the specified bucket, in batches (see utils._delete_files).
+
+        Args:
+        - remote_paths (list[str]): The paths in the remote storage to delete.
+
+        Returns:
+        - bool: True if deletion is successful, False otherwise.
+        """
+        return utils._delete_files(self.lithops_config, self.bucket, remote_paths)
+
+
+    def cleanup(self):
+        """
+        Remove the intermediate outputs of the module (everything under cleanup_paths) from the bucket.
+
+        Returns:
+        - int: Number of files deleted.
+        """
+        keys = [key for prefix in self.cleanup_paths for key in self.list_remote_files(prefix)]
+        if keys:
+            print(f"Removing {len(keys)} intermediate files from {', '.join(self.cleanup_paths)}... ", end='', flush=True)
+            print("Done." if self.delete_files(keys) else "Failed.")
+        return len(keys)
+
+
     def rename_file(self, old_remote_path, new_remote_path):
         """
         Rename (or move) a file within the same bucket using lithops storage.
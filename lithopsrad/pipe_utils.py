@@ -0,0 +1,241 @@
+import os
+import sys
+import time
+import threading
+import subprocess as sp
+
+import lithopsrad.utils as utils
+import lithopsrad.zstd_utils as zstd_utils
+import lithopsrad.qual_filter as qual_filter
+
+
+class StreamingUpload:
+    """
+    Writable stream that uploads everything written to it as a single object.
+
+    Data is buffered up to part_size; small outputs are sent with a single put, larger
+    ones as a multipart upload (where the backend supports it, see utils._get_multipart_client),
+    so the output never has to be staged on local disk. If compression (a zstd level) is
+    given, the data is compressed on the fly (see utils._put_compressed).
+
+    Use as a context manager: the upload is completed on exit, or aborted on an exception.
+    """
+    def __init__(self, config, bucket, remote_path, part_size=utils.DEFAULT_PART_SIZE, compression=None, stats=None):
+        self.config = config
+        self.bucket = bucket
+        self.remote_path = remote_path
+        self.part_size = part_size
+        self.stats = stats
+        self._storage = utils._get_storage(config)
+        self._client = utils._get_multipart_client(self._storage)
+        self._compressor = zstd_utils.compressor(compression) if compression is not None else None
+        self._extra_args = {"ContentType": zstd_utils.ZSTD_CONTENT_TYPE} if compression is not None else {}
+        self._buffer = []
+        self._buffered = 0
+        self._upload_id = None
+        self._parts = []
+
+
+    def write(self, data):
+        size = len(data)
+        if self._compressor is not None:
+            start = time.time()
+            data = self._compressor.compress(data)
+            if self.stats is not None:
+                self.stats.update(size, len(data), time.time() - start)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._client is not None and self._buffered >= self.part_size:
+            self._upload_part()
+        return size
+
+
+    def _upload_part(self):
+        data = b"".join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        if self._upload_id is None:
+            self._upload_id = self._client.create_multipart_upload(Bucket=self.bucket, Key=self.remote_path,
+                                                                   **self._extra_args)["UploadId"]
+        resp = self._client.upload_part(Bucket=self.bucket, Key=self.remote_path, UploadId=self._upload_id,
+                                        PartNumber=len(self._parts) + 1, Body=data)
+        self._parts.append({"PartNumber": len(self._parts) + 1, "ETag": resp["ETag"]})
+
+
+    def close(self):
+        """
+        Finish the upload.
+
+        Returns:
+        - CloudObject: The uploaded object.
+        """
+        if self._compressor is not None:
+            start = time.time()
+            data = self._compressor.flush()
+            if self.stats is not None:
+                self.stats.update(0, len(data), time.time() - start)
+            self._buffer.append(data)
+            self._compressor = None
+        if self._upload_id is None and self._extra_args and hasattr(self._client, "put_object"):
+            self._client.put_object(Bucket=self.bucket, Key=self.remote_path, Body=b"".join(self._buffer),
+                                    **self._extra_args)
+        elif self._upload_id is None:
+            self._storage.put_object(self.bucket, self.remote_path, b"".join(self._buffer))
+        else:
+            if self._buffer:
+                self._upload_part()
+            self._client.complete_multipart_upload(Bucket=self.bucket, Key=self.remote_path, UploadId=self._upload_id,
+                                                   MultipartUpload={"Parts": self._parts})
+        return utils._get_cloudobject(self.config, self.bucket, self.remote_path)
+
+
+    def abort(self):
+        """Abort the upload, discarding anything already sent."""
+        if self._upload_id is not None:
+            try:
+                self._client.abort_multipart_upload(Bucket=self.bucket, Key=self.remote_path, UploadId=self._upload_id)
+            except Exception:
+                pass
+        self._buffer = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class FastaWriter:
+    """
+    Writable stream that converts the FASTQ written to it into single-line FASTA.
+
+    The quality strings are dropped; if qual_out is given, a compact summary of each one
+    is written to it instead, as 'label\tlength\tmean_quality\texpected_errors' lines
+    (label being the header up to its first ';', see qual_filter.summarize_quality).
+
+    Call close() once everything is written; it does not close the wrapped streams.
+    """
+    def __init__(self, out, qual_out=None):
+        self.out = out
+        self.qual_out = qual_out
+        self.records = 0
+        self._lines = []
+        self._tail = b""
+
+
+    def write(self, data):
+        lines = (self._tail + data).split(b"\n")
+        self._tail = lines.pop()
+        self._lines.extend(lines)
+        n = len(self._lines) - len(self._lines) % 4
+        if n:
+            self._write_records(self._lines[:n])
+            del self._lines[:n]
+        return len(data)
+
+
+    def _write_records(self, lines):
+        fasta = []
+        summaries = []
+        for i in range(0, len(lines), 4):
+            header, sequence, quality = lines[i][1:], lines[i + 1], lines[i + 3]
+            fasta.append(b">%s\n%s\n" % (header, sequence))
+            if self.qual_out is not None:
+                mean_qual, errors = qual_filter.summarize_quality(quality)
+                summaries.append(b"%s\t%d\t%.2f\t%.4f\n" % (header.split(b";")[0], len(sequence), mean_qual, errors))
+        self.records += len(fasta)
+        self.out.write(b"".join(fasta))
+        if summaries:
+            self.qual_out.write(b"".join(summaries))
+
+
+    def close(self):
+        """
+        Write the remaining records.
+
+        Raises:
+        - ValueError: If the FASTQ written ends with an incomplete record.
+        """
+        lines = self._lines + ([self._tail] if self._tail else [])
+        lines = [line for line in lines if line.strip()]
+        if len(lines) % 4:
+            raise ValueError("Incomplete FASTQ record at the end of the stream.")
+        if lines:
+            self._write_records(lines)
+        self._lines, self._tail = [], b""
+
+
+def run_piped(cmds, stdin=None, stdout=None, block_size=1 << 20):
+    """
+    Run commands as a shell-style pipeline (cmds[0] | cmds[1] | ...), without temp files.
+
+    The stdin stream (e.g. utils._open_chunk_stream) is fed to the first command from a
+    thread (or, if stdin is a callable, it is called there to write the input itself), and the output of the last command is copied to stdout (e.g. a StreamingUpload),
+    counting lines on the way. Tool logs (stderr) go to the worker's stderr.
+
+    Args:
+    - cmds (list[list[str]]): Commands, reading from '-'/stdin and writing to '-'/stdout as needed.
+    - stdin (optional): Binary stream with a read(n) method to feed to the first command, or a
+      callable taking the command's input pipe and writing to it (e.g. Dereplicator.write).
+    - stdout (optional): Binary stream with a write(data) method for the output of the last command.
+    - block_size (int, optional): Bytes per read. Defaults to 1 MiB.
+
+    Returns:
+    - int: Number of lines written to stdout.
+
+    Raises:
+    - RuntimeError: If any of the commands fails.
+    """
+    procs = []
+    for i, cmd in enumerate(cmds):
+        last = i == len(cmds) - 1
+        if procs:
+            proc_stdin = procs[-1].stdout
+        else:
+            proc_stdin = sp.PIPE if stdin is not None else sp.DEVNULL
+        proc = sp.Popen(cmd, stdin=proc_stdin, stdout=sp.PIPE if not last or stdout is not None else None, close_fds=True)
+        if procs:
+            # only the next process should hold the pipe, so it sees EOF/SIGPIPE
+            procs[-1].stdout.close()
+        procs.append(proc)
+
+    # feed the input from a thread, keeping any error (e.g. a checksum mismatch) to re-raise
+    errors = []
+    def feed():
+        try:
+            if callable(stdin):
+                try:
+                    stdin(procs[0].stdin)
+                finally:
+                    procs[0].stdin.close()
+            else:
+                utils._relay_stream(stdin, procs[0].stdin, block_size=block_size)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            errors.append(e)
+    feeder = None
+    if stdin is not None:
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+    lines = 0
+    if stdout is not None:
+        for block in iter(lambda: procs[-1].stdout.read(block_size), b""):
+            lines += block.count(b"\n")
+            stdout.write(block)
+        procs[-1].stdout.close()
+
+    if feeder is not None:
+        feeder.join()
+    for proc in procs:
+        if proc.wait():
+            raise RuntimeError(f"{' '.join(proc.args[:2])} failed with exit code {proc.returncode}.")
+    if errors:
+        raise errors[0]
+    return lines
@@ -0,0 +1,130 @@
+import os
+import sys
+from itertools import islice
+
+import numpy as np
+
+import lithopsrad.sequence as seq
+
+# Phred+33 quality character -> probability of a base call error
+PHRED_OFFSET = 33
+ERROR_PROBS = 10.0 ** (-np.clip(np.arange(256) - PHRED_OFFSET, 0, None) / 10.0)
+
+N_BASES = np.frombuffer(b"Nn", dtype=np.uint8)
+
+
+def _split_record(record):
+    """Split a raw FASTQ record (see seq.iter_fastq_records) into header, sequence and quality lines."""
+    header, sequence, _, quality = record.split(b"\n", 4)[:4]
+    return header, sequence, quality
+
+
+def filter_batch(records, minlen, truncqual, maxns, maxee, maxee_rate):
+    """
+    Apply vsearch -fastx_filter quality filtering to a batch of FASTQ records.
+
+    As in vsearch, reads are first truncated at the first base with a quality of
+    truncqual or lower, then discarded if the truncated read is shorter than minlen,
+    has more than maxns Ns, or more than maxee expected errors (or maxee_rate per base).
+    The expected errors are the sum of the error probabilities of the bases; all checks
+    are done on the whole batch at once with per-read cumulative sums.
+
+    Args:
+    - records (list[bytes]): Raw 4-line FASTQ records.
+    - minlen (int): Minimum length after truncation.
+    - truncqual (int): Truncate at the first base with this quality or lower.
+    - maxns (int): Maximum number of Ns.
+    - maxee (float): Maximum expected errors.
+    - maxee_rate (float): Maximum expected errors per base.
+
+    Returns:
+    - list: The truncated record (bytes) for reads that pass, None for reads that don't.
+    """
+    if not records:
+        return []
+    fields = [_split_record(r) for r in records]
+    lens = np.fromiter((len(f[1]) for f in fields), dtype=np.int64, count=len(fields))
+    starts = np.concatenate(([0], np.cumsum(lens)))
+    quals = np.frombuffer(b"".join(f[2] for f in fields), dtype=np.uint8)
+    bases = np.frombuffer(b"".join(f[1] for f in fields), dtype=np.uint8)
+    if len(quals) != len(bases):
+        raise ValueError("Sequence and quality lengths differ in FASTQ batch.")
+
+    # 1. Truncate at the first low-quality base: position within the read of each
+    # base, and the first low one per read (its length if there is none)
+    pos = np.arange(len(quals)) - np.repeat(starts[:-1], lens)
+    low = np.where(quals <= truncqual + PHRED_OFFSET, pos, np.iinfo(np.int64).max)
+    trunc = lens.copy()
+    nonempty = lens > 0
+    if len(low):
+        trunc[nonempty] = np.minimum(lens[nonempty], np.minimum.reduceat(low, starts[:-1][nonempty]))
+    kept = pos < np.repeat(trunc, lens)
+
+    # 2. Expected errors and Ns of the truncated reads, from cumulative sums
+    ee_sum = np.concatenate(([0.0], np.cumsum(np.where(kept, ERROR_PROBS[quals], 0.0))))
+    ee = ee_sum[starts[1:]] - ee_sum[starts[:-1]]
+    n_sum = np.concatenate(([0], np.cumsum(kept & np.isin(bases, N_BASES))))
+    ns = n_sum[starts[1:]] - n_sum[starts[:-1]]
+
+    # 3. Discard
+    passed = (trunc >= minlen) & (ns <= maxns) & (ee <= maxee) & (ee <= maxee_rate * trunc)
+    return [header + b"\n" + sequence[:n] + b"\n+\n" + quality[:n] + b"\n" if ok else None
+            for (header, sequence, quality), n, ok in zip(fields, trunc.tolist(), passed.tolist())]
+
+
+def filter_fastq_stream(stream, out, minlen, truncqual, maxns, maxee, maxee_rate,
+                        stream_r2=None, out_r2=None, batch_size=10000):
+    """
+    Filter a FASTQ byte stream into an output stream (see filter_batch), in batches.
+
+    In paired mode (stream_r2 given) a pair is only kept if both mates pass, as with
+    vsearch -reverse/-fastqout_rev.
+
+    Args:
+    - stream: R1 stream with a read(n) method returning bytes.
+    - out: Binary stream to write the R1 reads that pass to.
+    - stream_r2 (optional): R2 stream.
+    - out_r2 (optional): Binary stream to write the R2 reads that pass to.
+    - batch_size (int, optional): Records per batch. Defaults to 10000.
+
+    Returns:
+    - tuple(int, int): Number of reads (or pairs) read and kept.
+    """
+    params = (minlen, truncqual, maxns, maxee, maxee_rate)
+    if stream_r2 is None:
+        records = ((r, None) for r in seq.iter_fastq_records(stream) if r.strip())
+    else:
+        records = ((r1, r2) for r1, r2 in seq.iter_fastq_pairs(stream, stream_r2) if r1.strip())
+
+    total = passed = 0
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        total += len(batch)
+        r1 = filter_batch([r for r, _ in batch], *params)
+        r2 = filter_batch([r for _, r in batch], *params) if stream_r2 is not None else r1
+        for read, mate in zip(r1, r2):
+            if read is None or mate is None:
+                continue
+            passed += 1
+            out.write(read)
+            if stream_r2 is not None:
+                out_r2.write(mate)
+    return total, passed
+
+
+def summarize_quality(quality):
+    """
+    Summarize a quality string as its mean Phred score and expected number of errors.
+
+    Args:
+    - quality (bytes): Phred+33 quality string.
+
+    Returns:
+    - tuple(float, float): Mean quality and expected errors (0.0, 0.0 if empty).
+    """
+    if not quality:
+        return 0.0, 0.0
+    quals = np.frombuffer(quality, dtype=np.uint8)
+    return float(quals.mean()) - PHRED_OFFSET, float(ERROR_PROBS[quals].sum())
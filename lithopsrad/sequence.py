@@ -2,6 +2,13 @@ import os
 import sys
 import re
 import io
+import gzip
+import zlib
+import heapq
+import itertools
+from itertools import zip_longest
+
+import lithopsrad.gzip_utils as gzip_utils
 
 def extract_size(header):
     """
@@ -42,22 +49,130 @@ def read_fasta(fas):
                 #start loading a new one
                 if contig:
                     yield([contig,seq]) #yield
-                    contig = None #reset contig and seq
-                    seq = ""
-                else:
-                    contig = (line.replace(">",""))
-                    seq = ""
+                contig = (line.replace(">",""))
+                seq = ""
             else:
                 seq += line
         #yield last sequence, if it has both a header and sequence
         if contig and seq:
             yield([contig,seq])
 
-def check_fastq(file_path):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-        if len(lines) % 4 != 0:
-            raise ValueError(f"File {file_path} doesn't appear to be a valid FASTQ file.")
+def open_fastq(file_path, mode="r"):
+    """
+    Open a plain or gzip/BGZF compressed FASTQ file, detected by its magic bytes.
+    """
+    with open(file_path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if compressed:
+        return gzip.open(file_path, mode if "b" in mode else "rt")
+    return open(file_path, mode)
+
+
+class FASTQValidator:
+    """
+    Incremental, constant-memory FASTQ structure checker and record counter.
+
+    Bytes are fed in arbitrary blocks with update() and the check is completed with
+    finish(), so validation can piggyback on any pass that already reads the file 
+    (e.g. the upload). Checks that every record has an '@' header and a '+' separator
+    line, and that sequence and quality lengths are equal. Trailing blank lines are 
+    allowed. Gzip/BGZF input is decompressed on the fly.
+
+    Raises:
+    - ValueError: On the first malformed record.
+    """
+    def __init__(self, name="FASTQ"):
+        self.name = name
+        self.records = 0
+        self._carry = []
+        self._tail = b""
+        self._blank = False
+        self._decomp = None
+        self.nbytes = 0
+
+
+    def update(self, data):
+        if not self.nbytes:
+            if data[:2] == b'\x1f\x8b':
+                self._decomp = gzip_utils.GzipDecompressor()
+        self.nbytes += len(data)
+        if self._decomp is not None:
+            data = self._decomp.decompress(data)
+        lines = (self._tail + data).split(b"\n")
+        self._tail = lines.pop()
+        self._check_lines(lines)
+
+
+    def finish(self):
+        """
+        Complete the check.
+
+        Returns:
+        - int: Number of records.
+        """
+        if self._tail:
+            self._check_lines([self._tail])
+            self._tail = b""
+        if self._carry:
+            self._error(f"truncated record at end of file (record {self.records + 1})")
+        return self.records
+
+
+    def _error(self, reason):
+        raise ValueError(f"File {self.name} doesn't appear to be a valid FASTQ file: {reason}.")
+
+
+    def _check_lines(self, lines):
+        # blank lines are only allowed at the end of the file
+        blank = False
+        while lines and not lines[-1].strip():
+            lines.pop()
+            blank = True
+        if lines and (self._blank or not all(lines)):
+            self._error(f"blank line within the file (near record {self.records + 1})")
+        self._blank = self._blank or blank
+
+        # check only whole records, carrying incomplete ones over to the next block
+        lines = self._carry + lines
+        n = len(lines) - len(lines) % 4
+        self._carry = lines[n:]
+        headers, seqs, seps, quals = lines[0:n:4], lines[1:n:4], lines[2:n:4], lines[3:n:4]
+        if not all(h.startswith(b"@") for h in headers):
+            i = next(i for i, h in enumerate(headers) if not h.startswith(b"@"))
+            self._error(f"record {self.records + i + 1} does not start with '@'")
+        if not all(p.startswith(b"+") for p in seps):
+            i = next(i for i, p in enumerate(seps) if not p.startswith(b"+"))
+            self._error(f"record {self.records + i + 1} is missing its '+' line")
+        if list(map(len, seqs)) != list(map(len, quals)):
+            i = next(i for i, (a, b) in enumerate(zip(seqs, quals)) if len(a) != len(b))
+            self._error(f"record {self.records + i + 1} has sequence and quality of different lengths")
+        self.records += n // 4
+
+
+def check_fastq(file_path, block_size=1 << 20, max_bytes=None):
+    """
+    Validate a (plain, gzip or BGZF) FASTQ file in a single streaming pass.
+
+    Args:
+    - file_path (str): Path to the file.
+    - block_size (int, optional): Bytes to read per call. Defaults to 1 MiB.
+    - max_bytes (int, optional): Only check (roughly) the first max_bytes of the file.
+
+    Returns:
+    - int: Number of records (checked).
+
+    Raises:
+    - ValueError: If the file is not valid FASTQ.
+    """
+    validator = FASTQValidator(file_path)
+    nbytes = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            validator.update(block)
+            nbytes += len(block)
+            if max_bytes is not None and nbytes >= max_bytes:
+                return validator.records
+    return validator.finish()
 
 
 def count_fastq_from_stream(file_data):
@@ -68,13 +183,127 @@ def count_fastq_from_stream(file_data):
 
 def count_fastq_records(file_stream=None, file_path=None):
     if file_path is not None:
-        with open(file_path, "r") as file:
-            file_stream = file.read()
-            return(count_fastq_from_stream(file_stream))
+        # stream the file rather than reading it into memory 
+        with open_fastq(file_path, "rb") as file:
+            return sum(1 for line in file if not line.isspace()) // 4
     else:
         return(count_fastq_from_stream(file_stream))
 
 
+def iter_lines(stream, block_size=1 << 20):
+    """
+    Iterate over the lines of a binary stream, reading fixed-size blocks.
+
+    Args:
+    - stream: Any object with a read(n) method returning bytes.
+    - block_size (int, optional): Bytes to read per call. Defaults to 1 MiB.
+
+    Yields:
+    - bytes: Next line, including its trailing newline (if present).
+    """
+    tail = b""
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if tail:
+        yield tail
+
+
+def iter_fastq_records(stream, block_size=1 << 20):
+    """
+    Iterate over the raw records of a FASTQ byte stream.
+
+    Args:
+    - stream: Any object with a read(n) method returning bytes.
+    - block_size (int, optional): Bytes to read per call. Defaults to 1 MiB.
+
+    Yields:
+    - bytes: The four lines of the next record, newlines included, so that
+             summing the lengths of the yielded records gives byte offsets.
+    """
+    record = []
+    for line in iter_lines(stream, block_size):
+        record.append(line)
+        if len(record) == 4:
+            yield b"".join(record)
+            record = []
+    if record:
+        yield b"".join(record)
+
+
+def iter_fastx_records(stream, block_size=1 << 20):
+    """
+    Iterate over the records of a FASTQ or single-line FASTA byte stream (such as
+    the FASTA dereps written by pipe_utils.FastaWriter), detected from the first line.
+
+    Args:
+    - stream: Any object with a read(n) method returning bytes.
+    - block_size (int, optional): Bytes to read per call. Defaults to 1 MiB.
+
+    Yields:
+    - tuple(bytes, bytes, bytes): Header (without '@' or '>'), sequence and quality 
+                                  (b"" for FASTA) of the next record.
+    """
+    lines = (line.rstrip(b"\n") for line in iter_lines(stream, block_size) if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return
+    nlines = 2 if first.startswith(b">") else 4
+    for header in itertools.chain([first], lines):
+        record = [header] + list(itertools.islice(lines, nlines - 1))
+        if len(record) < nlines:
+            raise ValueError(f"Incomplete record at the end of the stream: '{header.decode('utf-8')}'.")
+        yield header[1:], record[1], record[3] if nlines == 4 else b""
+
+
+def get_read_name(header):
+    """
+    Return the read name from a FASTQ header, without the '@', any comment and 
+    any /1 or /2 mate suffix, so that the names of the two mates of a pair match.
+    """
+    if isinstance(header, bytes):
+        header = header.decode("utf-8")
+    name = header.lstrip("@").split(None, 1)[0] if header.strip() else ""
+    if name.endswith("/1") or name.endswith("/2"):
+        name = name[:-2]
+    return name
+
+
+def iter_fastq_pairs(r1_stream, r2_stream, block_size=1 << 20):
+    """
+    Iterate over the records of two mate FASTQ byte streams in lockstep.
+
+    This doubles as a pair-consistency check, as it is done in the same pass
+    that reads the records anyway.
+
+    Args:
+    - r1_stream: R1 stream with a read(n) method returning bytes.
+    - r2_stream: R2 stream with a read(n) method returning bytes.
+    - block_size (int, optional): Bytes to read per call. Defaults to 1 MiB.
+
+    Yields:
+    - tuple(bytes, bytes): Next R1 and R2 records (see iter_fastq_records).
+
+    Raises:
+    - ValueError: If the read names of a pair differ, or one file has more records.
+    """
+    r1_records = iter_fastq_records(r1_stream, block_size)
+    r2_records = iter_fastq_records(r2_stream, block_size)
+    for i, (r1, r2) in enumerate(zip_longest(r1_records, r2_records)):
+        if r1 is None or r2 is None:
+            raise ValueError(f"R1 and R2 have different numbers of records (mismatch at record {i}).")
+        r1_name = get_read_name(r1[:r1.find(b"\n")])
+        r2_name = get_read_name(r2[:r2.find(b"\n")])
+        if r1_name != r2_name:
+            raise ValueError(f"R1 and R2 are out of sync at record {i}: '{r1_name}' vs '{r2_name}'.")
+        yield r1, r2
+
+
 def get_kmers_neighbor(seq, k):
     for i in range(0, len(seq)-(k-1)):
         yield (seq[i:i+k-1], seq[i+1:i+k])
@@ -85,6 +314,32 @@ def get_kmers(seq, k):
         yield (seq[i:i+k-1])
 
 
+def minimizer_shards(sequence, k, shards, n=2):
+    """
+    Shards of the smallest canonical k-mers of a sequence.
+
+    K-mers are taken as the smaller of themselves and their reverse complement, and hashed 
+    with crc32 (stable across workers); similar sequences, e.g. the alleles of a locus, 
+    mostly share their smallest k-mer and so their first shard.
+
+    Args:
+    - sequence (str): The sequence.
+    - k (int): K-mer length.
+    - shards (int): Number of shards.
+    - n (int, optional): Number of k-mers to return the shards of. Defaults to 2.
+
+    Returns:
+    - list[int]: Shards of the up to n smallest distinct k-mer hashes, smallest first.
+    """
+    sequence = sequence.upper()
+    rc = revcomp(sequence)
+    length = len(sequence)
+    hashes = {zlib.crc32(min(sequence[i:i+k], rc[length-i-k:length-i]).encode()) for i in range(length-k+1)}
+    if not hashes:
+        hashes = {zlib.crc32(min(sequence, rc).encode())}
+    return [h % shards for h in heapq.nsmallest(n, hashes)]
+
+
 #Function to split character to IUPAC codes, assuing diploidy
 def get_iupac_caseless(char):
     lower = False
@@ -155,7 +410,7 @@ def get_revcomp_caseless(char):
 #Function to reverse complement a sequence, with case preserved
 def revcomp(seq):
     comp = []
-    for i in (get_revComp_caseless(j) for j in seq):
+    for i in (get_revcomp_caseless(j) for j in seq):
         comp.append(i)
     return("".join(comp[::-1]))
 
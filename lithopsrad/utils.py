@@ -1,10 +1,81 @@
 
+import io
 import os 
+import json
+import time
+import hashlib
+import threading
+from itertools import count
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from lithops.storage import Storage
 from lithops.storage.utils import CloudObject
 
+import lithopsrad.gzip_utils as gzip_utils
+import lithopsrad.sequence as seq
+import lithopsrad.zstd_utils as zstd_utils
+
+# suffix of the chunk manifests written by FASTQChunker in 'virtual' mode
+MANIFEST_EXT = ".manifest.json"
+
+# suffix of the chunk packing plan written by FASTQChunker with adaptive_chunks
+PACKS_EXT = ".packs.json"
+
+# tag inserted before the extension of R2 objects in paired mode, e.g. 0_sample1.R2.edit
+MATE_EXT = ".R2"
+
+# default part size for multipart uploads (S3 requires at least 5 MiB)
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+
+# largest object (and part) S3 copies in a single request; larger objects are copied in parts
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+
+# most keys deleted per request (the S3 DeleteObjects limit)
+DELETE_BATCH_SIZE = 1000
+
+# per-process cache of Storage clients, keyed by config (see _get_storage)
+_STORAGE_CACHE = {}
+_STORAGE_LOCK = threading.Lock()
+_STORAGE_STATS = {"clients": 0, "setup_time": 0.0, "requests": 0}
+
+
+def _get_storage(config):
+    """
+    Return the lithops Storage for a config, creating it on first use.
+
+    Storages are cached per process, keyed by the config contents, so credential resolution 
+    and connection setup happen once per config (and per warm worker, across invocations) 
+    rather than once per call; the cached Storage and its backend client (and so its 
+    connection pool) are shared by all threads. See storage_stats().
+
+    Args:
+    - config (dict): Lithops configuration.
+
+    Returns:
+    - Storage: The (shared) lithops Storage.
+    """
+    key = json.dumps(config, sort_keys=True, default=str)
+    with _STORAGE_LOCK:
+        _STORAGE_STATS["requests"] += 1
+        storage = _STORAGE_CACHE.get(key)
+        if storage is None:
+            start = time.time()
+            storage = Storage(config=config)
+            _STORAGE_STATS["setup_time"] += time.time() - start
+            _STORAGE_STATS["clients"] += 1
+            _STORAGE_CACHE[key] = storage
+    return storage
+
+
+def storage_stats():
+    """
+    Return the Storage client stats of this process: the number of clients created, the 
+    time spent creating them (s) and the number of times one was requested (see _get_storage).
+    """
+    with _STORAGE_LOCK:
+        return dict(_STORAGE_STATS)
+
 
 def touch_file(filename):
     """
@@ -33,6 +104,59 @@ def _get_path(obj):
     #return os.path.splitext(path)[0]
 
 
+def _get_byte_range(obj):
+    """
+    Return the (start, end) byte range of a virtual chunk, or None for whole objects.
+    """
+    if isinstance(obj, dict) and obj.get('range') is not None:
+        return tuple(obj['range'])
+    return None
+
+
+def _get_chunk_name(obj):
+    """
+    Return the chunk id for a chunk object, e.g. '3_sample1' for '.../3_sample1.fastq'.
+
+    Virtual chunks (see FASTQChunker) carry their id explicitly, since their key
+    points at the full uploaded FASTQ.
+    """
+    if isinstance(obj, dict) and 'chunk' in obj:
+        return obj['chunk']
+    return os.path.basename(os.path.splitext(_get_path(obj))[0])
+
+
+def _is_mate(path):
+    """Check whether a key is the R2 mate of a paired chunk (see MATE_EXT)."""
+    return os.path.splitext(path)[0].endswith(MATE_EXT)
+
+
+def _get_mate_path(path):
+    """
+    Return the R2 mate key for an R1 key, e.g. '0_sample1.edit' -> '0_sample1.R2.edit'.
+    """
+    root, ext = os.path.splitext(path)
+    return root + MATE_EXT + ext
+
+
+def _strip_mate(path):
+    """Inverse of _get_mate_path."""
+    root, ext = os.path.splitext(path)
+    return root[:-len(MATE_EXT)] + ext
+
+
+def _checksum(data):
+    """Return the checksum (MD5 hex digest) used for chunk integrity checks."""
+    return hashlib.md5(data).hexdigest()
+
+
+def _range_header(byte_range):
+    """Format a (start, end) byte range, end exclusive, as HTTP Range get args."""
+    if byte_range is None:
+        return {}
+    start, end = byte_range
+    return {'Range': f'bytes={start}-{end - 1}'}
+
+
 def _check_remote_files(config, bucket, prefix, subset=None):
     """
     Check if a subset of remote files under a given prefix is reachable using the Lithops Storage API.
@@ -49,7 +173,7 @@ def _check_remote_files(config, bucket, prefix, subset=None):
     Raises:
     - ValueError: If any of the subset files is not accessible.
     """
-    storage = Storage(config=config)
+    storage = _get_storage(config)
     files = storage.list_objects(bucket, prefix)
     
     # Get a subset of files
@@ -81,7 +205,7 @@ def check_bucket(config, bucket):
     - ValueError: If the bucket does not exist.
     - PermissionError: If the bucket is not readable.
     """
-    storage = Storage(config=config)
+    storage = _get_storage(config)
     
     try:
         # This is a lightweight operation to check if the bucket is accessible.
@@ -96,6 +220,21 @@ def is_gzip(file_path):
         return file_start == b'\x1f\x8b'
 
 
+def is_bgzf(file_path):
+    with open(file_path, 'rb') as f:
+        return gzip_utils.is_bgzf_header(f.read(18))
+
+
+def _get_sample_name(path):
+    """
+    Return the sample name for a FASTQ path, e.g. 'sample1' for '.../sample1.fastq.gz'.
+    """
+    base = os.path.basename(path)
+    if base.endswith(".gz"):
+        base = base[:-3]
+    return os.path.splitext(base)[0]
+
+
 def check_file(file_path):
     """
     Checks if the given file exists, is readable, and conforms to FASTQ format.
@@ -117,7 +256,7 @@ def check_file(file_path):
 
 
 def _list_remote_files(config, bucket, prefix=None):
-    storage = Storage(config=config)        
+    storage = _get_storage(config)
     return storage.list_keys(bucket, prefix=prefix)
 
 
@@ -139,7 +278,7 @@ def _delete_file(config, bucket, remote_path):
     - bool: True if deletion is successful, False otherwise.
     """
     try:
-        storage = Storage(config=config)
+        storage = _get_storage(config)
         storage.delete_object(bucket, remote_path)
         return True
     except Exception as e:
@@ -147,9 +286,39 @@ def _delete_file(config, bucket, remote_path):
         return False
 
 
+def _delete_files(config, bucket, remote_paths):
+    """
+    Delete several files from the specified bucket, in batches of DELETE_BATCH_SIZE keys 
+    per request where the backend supports it (lithops Storage.delete_objects).
+    
+    Args:
+    - config (dict): Lithops configuration.
+    - bucket (str): The storage bucket name.
+    - remote_paths (list[str]): The paths in the remote storage to delete.
+    
+    Returns:
+    - bool: True if deletion is successful, False otherwise.
+    """
+    remote_paths = list(remote_paths)
+    try:
+        storage = _get_storage(config)
+        for i in range(0, len(remote_paths), DELETE_BATCH_SIZE):
+            batch = remote_paths[i:i + DELETE_BATCH_SIZE]
+            if hasattr(storage, "delete_objects"):
+                storage.delete_objects(bucket, batch)
+            else:
+                for remote_path in batch:
+                    storage.delete_object(bucket, remote_path)
+        return True
+    except Exception as e:
+        print(f"Error deleting {len(remote_paths)} files from {bucket}: {e}")
+        return False
+
+
 def _rename_file(config, bucket, old_remote_path, new_remote_path):
     """
-    Rename (or move) a file within the same bucket using lithops storage.
+    Rename (or move) a file within the same bucket using lithops storage: a copy (server-side 
+    where possible, see _copy_file) followed by a delete.
     
     Args:
     - config (dict): Lithops configuration.
@@ -161,19 +330,57 @@ def _rename_file(config, bucket, old_remote_path, new_remote_path):
     - bool: True if rename is successful, False otherwise.
     """
     try:
-        storage = Storage(config=config)
-        data = storage.get_object(bucket, old_remote_path)
-        storage.put_object(bucket, new_remote_path, data)
-        storage.delete_object(bucket, old_remote_path)
+        _copy_file(config, bucket, old_remote_path, new_remote_path)
+        _get_storage(config).delete_object(bucket, old_remote_path)
         return True
     except Exception as e:
         print(f"Error renaming {old_remote_path} to {new_remote_path} in {bucket}: {e}")
         return False
 
 
+def _copy_file(config, bucket, src_remote_path, dst_remote_path):
+    """
+    Copy a file within the same bucket using lithops storage.
+
+    Where the backend client supports it (S3-style copy_object), the copy is done server-side, 
+    in parts of up to MAX_COPY_SIZE for larger objects, so the data never goes through this 
+    process; otherwise the object is downloaded and uploaded again.
+    
+    Args:
+    - config (dict): Lithops configuration.
+    - bucket (str): The storage bucket name.
+    - src_remote_path (str): The path to copy from.
+    - dst_remote_path (str): The path to copy to.
+    """
+    storage = _get_storage(config)
+    client = _get_multipart_client(storage)
+    if client is None or not hasattr(client, "copy_object"):
+        storage.put_object(bucket, dst_remote_path, storage.get_object(bucket, src_remote_path))
+        return
+
+    source = {"Bucket": bucket, "Key": src_remote_path}
+    size = int(storage.head_object(bucket, src_remote_path).get("content-length", 0))
+    if size <= MAX_COPY_SIZE:
+        client.copy_object(Bucket=bucket, Key=dst_remote_path, CopySource=source)
+        return
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=dst_remote_path)["UploadId"]
+    try:
+        parts = []
+        for number, start in enumerate(range(0, size, MAX_COPY_SIZE), 1):
+            end = min(start + MAX_COPY_SIZE, size) - 1
+            resp = client.upload_part_copy(Bucket=bucket, Key=dst_remote_path, UploadId=upload_id, PartNumber=number,
+                                           CopySource=source, CopySourceRange=f"bytes={start}-{end}")
+            parts.append({"PartNumber": number, "ETag": resp["CopyPartResult"]["ETag"]})
+        client.complete_multipart_upload(Bucket=bucket, Key=dst_remote_path, UploadId=upload_id,
+                                         MultipartUpload={"Parts": parts})
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=dst_remote_path, UploadId=upload_id)
+        raise
+
+
 def _remote_file_exists(config, bucket, remote_path):
     """Check if the file exists in the specified bucket using lithops storage."""
-    storage = Storage(config=config)
+    storage = _get_storage(config)
     try:
         storage.head_object(bucket, remote_path)
         return True
@@ -193,52 +400,491 @@ def _get_cloudobject(config, bucket, remote_path):
     Returns:
     - CloudObject: The constructed cloud object.
     """
-    backend = Storage(config=config).backend
+    backend = _get_storage(config).backend
     return CloudObject(backend, bucket, remote_path)
 
 
-def _upload_file_from_stream(config, bucket, remote_path, stream):
-    """Upload a file stream to the specified bucket using lithops storage."""
-    storage = Storage(config=config)
-    storage.put_object(bucket, f'{remote_path}', stream)
+def _put_compressed(storage, bucket, remote_path, data, compression, stats=None):
+    """
+    Compress data with zstd at the given level and upload it. Keys are kept as they are 
+    (names are parsed downstream); compressed objects are recognised by their magic bytes 
+    (see zstd_utils.is_zstd), and tagged with a zstd content type where the backend allows.
+    """
+    data = data.encode('UTF-8') if isinstance(data, str) else data
+    data = stats.compress(data, compression) if stats is not None else zstd_utils.compress(data, compression)
+    client = _get_multipart_client(storage)
+    if client is not None and hasattr(client, "put_object"):
+        client.put_object(Bucket=bucket, Key=remote_path, Body=data, ContentType=zstd_utils.ZSTD_CONTENT_TYPE)
+    else:
+        storage.put_object(bucket, remote_path, data)
+
+
+def _decompress(data, stats=None):
+    """Decompress data if it is zstd compressed (see _put_compressed), otherwise return it as-is."""
+    if not zstd_utils.is_zstd(data):
+        return data
+    return stats.decompress(data) if stats is not None else zstd_utils.decompress(data)
+
+
+def _upload_file_from_stream(config, bucket, remote_path, stream, compression=None, stats=None):
+    """
+    Upload a file stream to the specified bucket using lithops storage.
+
+    If compression (a zstd level) is given, the data is compressed first (see _put_compressed).
+    """
+    storage = _get_storage(config)
+    if compression is not None:
+        data = stream.read() if hasattr(stream, "read") else stream
+        _put_compressed(storage, bucket, remote_path, data, compression, stats)
+    else:
+        storage.put_object(bucket, f'{remote_path}', stream)
     return _get_cloudobject(config, bucket, remote_path)
 
 
-def _upload_file(config, bucket, remote_path, local_path):
-    """Upload a file to the specified bucket using lithops storage."""
-    storage = Storage(config=config)
+def _upload_file(config, bucket, remote_path, local_path, part_size=None, max_workers=1, compression=None, stats=None):
+    """
+    Upload a file to the specified bucket using lithops storage.
+
+    If part_size is given, files larger than part_size are sent as a multipart upload
+    with max_workers parts in flight (see _upload_files). If compression (a zstd level)
+    is given, the file is compressed and sent in a single put instead.
+    """
+    if compression is not None:
+        with open(local_path, 'rb') as fl:
+            _put_compressed(_get_storage(config), bucket, remote_path, fl.read(), compression, stats)
+        return _get_cloudobject(config, bucket, remote_path)
+    if part_size is not None:
+        return _upload_files(config, bucket, [(remote_path, local_path)], part_size, max_workers)[0]
+    storage = _get_storage(config)
     key = os.path.basename(local_path)
     with open(f'{local_path}', 'rb') as fl:
         storage.put_object(bucket, f'{remote_path}', fl)
     return _get_cloudobject(config, bucket, remote_path)
 
 
-def _download_file(config, bucket, remote_path, local_path):
-    """Download a file from the specified bucket using lithops storage."""
-    storage = Storage(config=config)
-    fobj = storage.get_object(bucket, remote_path)
+class TransferProgress:
+    """
+    Thread-safe byte counter that periodically prints transfer progress and throughput.
+    """
+    def __init__(self, total_bytes=None, label="Uploaded", interval=5.0):
+        self.total_bytes = total_bytes
+        self.label = label
+        self.interval = interval
+        self.bytes = 0
+        self.start = time.time()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+
+    def update(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+            now = time.time()
+            if now - self._last_report >= self.interval:
+                self._last_report = now
+                print(self, flush=True)
+
+
+    def summary(self):
+        """Return the bytes transferred, elapsed seconds and throughput (MB/s)."""
+        elapsed = time.time() - self.start
+        return {
+            "bytes": self.bytes,
+            "seconds": elapsed,
+            "mb_per_s": self.bytes / 1e6 / elapsed if elapsed > 0 else 0.0
+        }
+
+
+    def __str__(self):
+        stats = self.summary()
+        total = f"/{self.total_bytes / 1e6:.1f}" if self.total_bytes else ""
+        return f"{self.label} {stats['bytes'] / 1e6:.1f}{total} MB in {stats['seconds']:.1f}s ({stats['mb_per_s']:.1f} MB/s)"
+
+
+class _CallbackReader:
+    """
+    File wrapper that passes every block read to a callback.
+
+    Seeks and tells are forwarded, so the wrapper can be used as a re-readable upload body:
+    only bytes past the furthest offset already read are passed on, so a retry that rewinds
+    the stream does not repeat them (reads are assumed to be sequential after a rewind).
+    """
+    def __init__(self, fileobj, callback):
+        self._fileobj = fileobj
+        self._callback = callback
+        self._pos = 0
+        self._reported = 0
+
+
+    def read(self, n=-1):
+        data = self._fileobj.read(n)
+        start, self._pos = self._pos, self._pos + len(data)
+        if self._pos > self._reported:
+            self._callback(data[max(0, self._reported - start):])
+            self._reported = self._pos
+        return data
+
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._pos = self._fileobj.seek(offset, whence)
+        return self._pos
+
+
+    def tell(self):
+        return self._pos
+
+
+    def __len__(self):
+        return os.fstat(self._fileobj.fileno()).st_size - self._pos
+
+
+class _PeekReader:
+    """File wrapper that reads the first bytes ahead (as .head), to sniff the format of a stream."""
+    def __init__(self, fileobj, size=4):
+        self._fileobj = fileobj
+        self.head = b""
+        while len(self.head) < size:
+            data = fileobj.read(size - len(self.head))
+            if not data:
+                break
+            self.head += data
+        self._pending = self.head
+
+
+    def read(self, n=-1):
+        if not self._pending:
+            return self._fileobj.read(n)
+        if n is None or n < 0:
+            data, self._pending = self._pending + self._fileobj.read(), b""
+            return data
+        data, self._pending = self._pending[:n], self._pending[n:]
+        return data
+
+
+def _get_multipart_client(storage):
+    """Return the backend client if it supports S3-style multipart uploads, otherwise None."""
+    try:
+        client = storage.get_client()
+    except Exception:
+        return None
+    return client if hasattr(client, "create_multipart_upload") else None
+
+
+def _upload_files(config, bucket, uploads, part_size=DEFAULT_PART_SIZE, max_workers=8, progress=None, callback=None):
+    """
+    Upload several local files concurrently, splitting large files into multipart parts.
+
+    Files are read sequentially one part at a time, while parts (and whole small files) 
+    are uploaded from a shared thread pool, so at most 2 * max_workers parts are held 
+    in memory. Backends without multipart support fall back to a single put_object per 
+    file, still concurrent across files.
+
+    Args:
+    - config (dict): Lithops configuration.
+    - bucket (str): The storage bucket name.
+    - uploads (list[tuple]): (remote_path, local_path) pairs.
+    - part_size (int, optional): Multipart part size in bytes. Defaults to DEFAULT_PART_SIZE.
+    - max_workers (int, optional): Number of concurrent uploads. Defaults to 8.
+    - progress (TransferProgress, optional): Progress reporter to update.
+    - callback (callable, optional): Called as callback(local_path, data) with every block
+      read, in file order, so e.g. validation can share the single read of each file.
+
+    Returns:
+    - list[CloudObject]: The uploaded objects, in the same order as uploads.
+    """
+    storage = _get_storage(config)
+    client = _get_multipart_client(storage)
+    progress = progress or TransferProgress(sum(os.path.getsize(local) for _, local in uploads))
+    slots = threading.BoundedSemaphore(2 * max_workers)
+
+    def put_file(remote_path, local_path):
+        with open(local_path, 'rb') as fl:
+            if callback is not None:
+                fl = _CallbackReader(fl, lambda data: callback(local_path, data))
+            storage.put_object(bucket, remote_path, fl)
+        progress.update(os.path.getsize(local_path))
+
+    def put_data(remote_path, data):
+        try:
+            storage.put_object(bucket, remote_path, data)
+        finally:
+            slots.release()
+        progress.update(len(data))
+
+    def put_part(remote_path, upload_id, part_number, data):
+        try:
+            resp = client.upload_part(Bucket=bucket, Key=remote_path, UploadId=upload_id, 
+                                      PartNumber=part_number, Body=data)
+        finally:
+            slots.release()
+        progress.update(len(data))
+        return {"PartNumber": part_number, "ETag": resp["ETag"]}
+
+    def read_part(fl, local_path):
+        slots.acquire()
+        data = fl.read(part_size)
+        if not data:
+            slots.release()
+        elif callback is not None:
+            callback(local_path, data)
+        return data
+
+    multiparts = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = []
+            for remote_path, local_path in uploads:
+                size = os.path.getsize(local_path)
+                if size <= part_size:
+                    with open(local_path, 'rb') as fl:
+                        data = read_part(fl, local_path) or b""
+                    if not data:
+                        slots.acquire()
+                    futures.append(pool.submit(put_data, remote_path, data))
+                    continue
+                if client is None:
+                    futures.append(pool.submit(put_file, remote_path, local_path))
+                    continue
+
+                upload_id = client.create_multipart_upload(Bucket=bucket, Key=remote_path)["UploadId"]
+                parts = []
+                multiparts.append((remote_path, upload_id, parts))
+                with open(local_path, 'rb') as fl:
+                    for part_number in count(1):
+                        data = read_part(fl, local_path)
+                        if not data:
+                            break
+                        parts.append(pool.submit(put_part, remote_path, upload_id, part_number, data))
+
+            for future in futures:
+                future.result()
+            for remote_path, upload_id, parts in multiparts:
+                client.complete_multipart_upload(Bucket=bucket, Key=remote_path, UploadId=upload_id,
+                                                 MultipartUpload={"Parts": [f.result() for f in parts]})
+    except Exception:
+        for remote_path, upload_id, _ in multiparts:
+            try:
+                client.abort_multipart_upload(Bucket=bucket, Key=remote_path, UploadId=upload_id)
+            except Exception:
+                pass
+        raise
+
+    print(progress, flush=True)
+    return [_get_cloudobject(config, bucket, remote_path) for remote_path, _ in uploads]
+
+
+def _download_file(config, bucket, remote_path, local_path, byte_range=None, checksum=None, stats=None):
+    """
+    Download a file from the specified bucket using lithops storage.
+
+    If byte_range (start, end) is given, only that slice of the object is fetched
+    with a ranged GET. If checksum is given, the data is verified against it.
+    Compressed objects (see _put_compressed) are written decompressed.
+    """
+    storage = _get_storage(config)
+    fobj = storage.get_object(bucket, remote_path, extra_get_args=_range_header(byte_range))
+    if byte_range is None:
+        fobj = _decompress(fobj, stats)
+    _verify_checksum(fobj, checksum, remote_path)
     with open(local_path, "wb") as f:  # note the change from 'w' to 'wb' as we're writing bytes
         f.write(fobj)
 
 
-def _stream_file(config, bucket, remote_path):
+def _download_files(config, bucket, remote_paths, local_path, stats=None):
+    """
+    Download several files from the specified bucket, concatenated into a single local 
+    file (decompressed, see _download_file), without writing each one to disk first.
+    """
+    storage = _get_storage(config)
+    with open(local_path, "wb") as f:
+        for remote_path in remote_paths:
+            f.write(_decompress(storage.get_object(bucket, remote_path), stats))
+
+
+def _verify_checksum(data, checksum, remote_path):
+    """
+    Raises:
+    - ValueError: If checksum is given and doesn't match the data.
+    """
+    if checksum is not None and _checksum(data) != checksum:
+        raise ValueError(f"Checksum mismatch for {remote_path}: data does not match its chunk manifest.")
+
+
+def _download_chunk(config, bucket, obj, local_path):
+    """
+    Download a chunk object to a local (uncompressed) file.
+
+    Handles whole-object chunks, plain byte-range virtual chunks, and BGZF virtual 
+    chunks, for which only the chunk's own blocks are fetched and decompressed. 
+    Chunks listed in a manifest are verified against their checksum.
+
+    Args:
+    - config (dict): Lithops configuration.
+    - bucket (str): The storage bucket name.
+    - obj: Chunk key, CloudObject, or virtual chunk dict (see Module.list_input_chunks).
+    - local_path (str): The local path to write the chunk to.
+    """
+    remote_path = _get_path(obj)
+    byte_range = _get_byte_range(obj)
+    checksum = obj.get("md5") if isinstance(obj, dict) else None
+    if isinstance(obj, dict) and obj.get("compression") == "bgzf":
+        storage = _get_storage(config)
+        data = storage.get_object(bucket, remote_path, extra_get_args=_range_header(byte_range))
+        data = gzip_utils.decompress_range(data, obj["offset"], obj["length"])
+        _verify_checksum(data, checksum, remote_path)
+        with open(local_path, "wb") as f:
+            f.write(data)
+    else:
+        _download_file(config, bucket, remote_path, local_path, byte_range=byte_range, checksum=checksum)
+
+
+class _VerifyingReader:
+    """File wrapper that checks the md5 of the data read once the stream is exhausted."""
+    def __init__(self, fileobj, checksum, remote_path):
+        self._fileobj = fileobj
+        self._checksum = checksum
+        self._remote_path = remote_path
+        self._hasher = hashlib.md5()
+
+
+    def read(self, n=-1):
+        data = self._fileobj.read(n)
+        if data:
+            self._hasher.update(data)
+        elif n != 0 and self._hasher.hexdigest() != self._checksum:
+            raise ValueError(f"Checksum mismatch for {self._remote_path}: data does not match its chunk manifest.")
+        return data
+
+
+def _open_chunk_stream(config, bucket, obj):
+    """
+    Open a chunk object as an uncompressed binary stream (see _download_chunk).
+
+    Chunks listed in a manifest are verified against their checksum once the stream
+    has been read to the end. BGZF virtual chunks are only a few blocks, so these are 
+    fetched and decompressed in one go.
+
+    Returns:
+    - A file-like object with a read(n) method.
+
+    Raises:
+    - ValueError: On reading the end of the stream, if the data doesn't match its checksum.
+    """
+    remote_path = _get_path(obj)
+    byte_range = _get_byte_range(obj)
+    checksum = obj.get("md5") if isinstance(obj, dict) else None
+    if isinstance(obj, dict) and obj.get("compression") == "bgzf":
+        storage = _get_storage(config)
+        data = storage.get_object(bucket, remote_path, extra_get_args=_range_header(byte_range))
+        stream = io.BytesIO(gzip_utils.decompress_range(data, obj["offset"], obj["length"]))
+    elif byte_range is None:
+        stream = _open_fastq_stream(config, bucket, remote_path)
+    else:
+        stream = _open_stream(config, bucket, remote_path, byte_range=byte_range)
+    return _VerifyingReader(stream, checksum, remote_path) if checksum else stream
+
+
+def _open_stream(config, bucket, remote_path, byte_range=None):
+    """
+    Open a remote object (or a byte range of it) as a binary stream.
+
+    Args:
+    - config (dict): Lithops configuration.
+    - bucket (str): The storage bucket name.
+    - remote_path (str): The path in the remote storage.
+    - byte_range (tuple, optional): (start, end) byte range, end exclusive.
+
+    Returns:
+    - A file-like object with a read(n) method.
+    """
+    storage = _get_storage(config)
+    return storage.get_object(bucket, remote_path, stream=True, extra_get_args=_range_header(byte_range))
+
+
+def _open_fastq_stream(config, bucket, remote_path, hasher=None):
+    """
+    Open a remote FASTQ as an uncompressed binary stream.
+
+    Compression is detected from the object's first bytes: BGZF objects are returned as
+    a gzip_utils.BGZFReader (which also records the block table), plain gzip as a 
+    gzip_utils.GzipStreamReader, zstd (see _put_compressed) as a streaming zstd reader,
+    anything else as the raw object stream.
+
+    If a hashlib hasher is given, it is updated with the raw (compressed) bytes as they are read.
+    """
+    storage = _get_storage(config)
+    header = storage.get_object(bucket, remote_path, extra_get_args=_range_header((0, 18)))
+    stream = _open_stream(config, bucket, remote_path)
+    if hasher is not None:
+        stream = _CallbackReader(stream, hasher.update)
+    if gzip_utils.is_bgzf_header(header):
+        return gzip_utils.BGZFReader(stream)
+    if header[:2] == gzip_utils.GZIP_MAGIC:
+        return gzip_utils.GzipStreamReader(stream)
+    if zstd_utils.is_zstd(header):
+        return zstd_utils.open_stream(stream)
+    return stream
+
+
+def _relay_stream(src, dst, copy=None, block_size=1 << 20):
+    """
+    Copy a stream into the input pipe of a subprocess (or another stream), counting lines.
+
+    Args:
+    - src: Binary stream to read from.
+    - dst: Binary stream to write to; closed at the end so a subprocess sees EOF.
+    - copy (file, optional): Binary file also written with the data (e.g. to keep an intermediate).
+    - block_size (int, optional): Bytes per read. Defaults to 1 MiB.
+
+    Returns:
+    - int: Number of lines relayed.
+    """
+    lines = 0
+    try:
+        for block in iter(lambda: src.read(block_size), b""):
+            lines += block.count(b"\n")
+            dst.write(block)
+            if copy:
+                copy.write(block)
+    finally:
+        dst.close()
+    return lines
+
+
+def _upload_json(config, bucket, remote_path, data):
+    """Serialize data as JSON and upload it to the specified bucket."""
+    return _upload_file_from_stream(config, bucket, remote_path, json.dumps(data))
+
+
+def _read_json(config, bucket, remote_path):
+    """Download and parse a JSON object from the specified bucket."""
+    storage = _get_storage(config)
+    return json.loads(storage.get_object(bucket, remote_path).decode('UTF-8'))
+
+
+def _stream_file(config, bucket, remote_path, block_size=1 << 20):
     """
     Generator function to iterate over file from remote storage
     
+    The object is read as a stream, in blocks (and decompressed on the fly if it is zstd 
+    compressed, see _put_compressed), so it is never held in memory as a whole.
+
     Args:
     - config (dict): Lithops configuration.
     - bucket (str): The storage bucket name.
     - remote_path (str): The path in the remote storage to stream the file from.
+    - block_size (int, optional): Bytes per read. Defaults to 1 MiB.
     
     Yields:
     - str: Next line from the file.
     """
-    storage = Storage(config=config)
-    fobj = storage.get_object(bucket, remote_path)
+    stream = _PeekReader(_open_stream(config, bucket, remote_path))
+    if zstd_utils.is_zstd(stream.head):
+        stream = zstd_utils.open_stream(stream)
     
     # Stream the file line by line
-    for line in fobj.decode('UTF-8').splitlines():
-        line = line.strip()
+    for line in seq.iter_lines(stream, block_size=block_size):
+        line = line.decode('UTF-8').strip()
         if line:  # Ensure the line is not empty
             yield line
 
@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+
+# zstandard is optional, only needed when intermediates are compressed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# content type recorded for compressed objects (see utils._upload_file)
+ZSTD_CONTENT_TYPE = "application/zstd"
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError("The 'zstandard' package is required for compressed intermediates. "
+                          "Install it or set global.compression to null.")
+
+
+def is_zstd(header):
+    """Check whether the first bytes of a file/object are a zstd frame header."""
+    return header[:4] == ZSTD_MAGIC
+
+
+def compress(data, level=3):
+    """
+    Compress bytes to a single zstd frame.
+
+    Args:
+    - data (bytes): Data to compress.
+    - level (int, optional): zstd compression level. Defaults to 3.
+
+    Returns:
+    - bytes: The compressed frame.
+    """
+    _require_zstandard()
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def decompress(data):
+    """Decompress zstd data (also if the frame doesn't record its content size)."""
+    _require_zstandard()
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def compressor(level=3):
+    """Return an incremental zstd compressor (with compress(data) and flush() methods)."""
+    _require_zstandard()
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def open_stream(stream):
+    """
+    Wrap a binary stream of zstd data into a stream of the decompressed data.
+
+    Returns:
+    - A file-like object with a read(n) method.
+    """
+    _require_zstandard()
+    return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+
+
+class CompressionStats:
+    """
+    Byte and time counters for the compressed transfers of a worker, to report
+    the compression ratio and time spent (de)compressing per stage.
+    """
+    def __init__(self):
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+
+    def update(self, raw_bytes, compressed_bytes, seconds):
+        self.raw_bytes += raw_bytes
+        self.compressed_bytes += compressed_bytes
+        self.seconds += seconds
+
+
+    def compress(self, data, level=3):
+        """Compress data (see compress), recording sizes and time."""
+        start = time.time()
+        out = compress(data, level)
+        self.update(len(data), len(out), time.time() - start)
+        return out
+
+
+    def decompress(self, data):
+        """Decompress data (see decompress), recording sizes and time."""
+        start = time.time()
+        out = decompress(data)
+        self.update(len(out), len(data), time.time() - start)
+        return out
+
+
+    def as_dict(self, prefix):
+        """
+        Format as result columns, e.g. {'edit_zratio': 4.1, 'edit_ztime': 0.2} for prefix 'edit'.
+        Empty if nothing was compressed.
+        """
+        if not self.compressed_bytes:
+            return {}
+        return {
+            f"{prefix}_zratio": self.raw_bytes / self.compressed_bytes,
+            f"{prefix}_ztime": self.seconds
+        }
@@ -0,0 +1,115 @@
+import io
+import random
+import shutil
+import subprocess as sp
+
+import pytest
+
+from lithopsrad.derep_engine import Dereplicator, revcomp_bytes
+from lithopsrad.fastq_derep import FASTQDerep
+
+requires_vsearch = pytest.mark.skipif(shutil.which("vsearch") is None, reason="vsearch not installed")
+
+# sequences (with ties in abundance, a lowercase copy and reverse complements) in read order
+SEQUENCES = [
+    "ACGTACGTTTGACCA", "GGGCCCAAATTTACG", "ACGTACGTTTGACCA", "TTTTTCCCCCGGGGG",
+    "acgtacgtttgacca", "GGGCCCAAATTTACG", "CGTAAATTTGGGCCC", "ACGTNCGTTTGACCA",
+    revcomp_bytes(b"TTTTTCCCCCGGGGG").decode(), "AAAAAAAAAAAAAAA", "TTTTTTTTTTTTTTT",
+    "TTTTTTTTTTTTTTT", "ACGTNCGTTTGACCA", "CATCATCATCATCAT",
+]
+
+
+def _write(derep, minuniquesize=1, maxuniquesize=None):
+    out = io.BytesIO()
+    derep.write(out, "s_d", minuniquesize, maxuniquesize)
+    return out.getvalue()
+
+
+def _random_reads(n=500, seed=1):
+    rng = random.Random(seed)
+    templates = ["".join(rng.choice("ACGT") for _ in range(12)) for _ in range(60)]
+    reads = []
+    for _ in range(n):
+        sequence = rng.choice(templates)
+        if rng.random() < 0.3:
+            sequence = revcomp_bytes(sequence.encode()).decode()
+        if rng.random() < 0.1:
+            sequence = sequence.lower()
+        reads.append((sequence.encode(), "".join(rng.choice("#+5I") for _ in sequence).encode()))
+    return reads
+
+
+@pytest.mark.parametrize("strand", ["plus", "both"])
+@pytest.mark.parametrize("max_uniques", [2, 7])
+def test_spilled_output_matches_in_memory(tmp_path, strand, max_uniques):
+    expected, spilled = Dereplicator(strand=strand), Dereplicator(strand=strand, max_uniques=max_uniques, tmpdir=str(tmp_path))
+    for sequence, quality in _random_reads():
+        expected.add(sequence, quality)
+        spilled.add(sequence, quality)
+    assert spilled._runs
+    assert _write(spilled, 2) == _write(expected, 2)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_strand_both_merges_reverse_complements():
+    reads = [(b"ACGTT", b"IIIII"), (b"AACGT", b"#####"), (b"acgtt", b"+++++"), (b"GGGAA", b"IIIII")]
+    both, plus = Dereplicator(strand="both"), Dereplicator(strand="plus")
+    for sequence, quality in reads:
+        both.add(sequence, quality)
+        plus.add(sequence, quality)
+    # the first read seen is kept for each unique, with its quality
+    assert list(both.iter_uniques()) == [(b"ACGTT", b"IIIII", 3), (b"GGGAA", b"IIIII", 1)]
+    assert list(plus.iter_uniques()) == [(b"ACGTT", b"IIIII", 2), (b"AACGT", b"#####", 1), (b"GGGAA", b"IIIII", 1)]
+
+
+def test_size_limits():
+    derep = Dereplicator()
+    for sequence, size in [(b"AAAA", 1), (b"CCCC", 3), (b"GGGG", 2)]:
+        derep.add(sequence, b"", size=size)
+    # the uniques are relabelled in order after filtering; FASTA when there is no quality
+    assert _write(derep, minuniquesize=2) == b">s_d1;size=3\nCCCC\n>s_d2;size=2\nGGGG\n"
+    derep = Dereplicator()
+    for sequence, size in [(b"AAAA", 1), (b"CCCC", 3), (b"GGGG", 2)]:
+        derep.add(sequence, b"IIII", size=size)
+    assert _write(derep, maxuniquesize=2) == b"@s_d1;size=2\nGGGG\n+\nIIII\n@s_d2;size=1\nAAAA\n+\nIIII\n"
+
+
+def _fastq():
+    return "".join(f"@r{i}\n{s}\n+\n{'I' * len(s)}\n" for i, s in enumerate(SEQUENCES)).encode()
+
+
+def _parse(data):
+    # vsearch may derive the qualities of a unique from all of its reads, while the engine keeps
+    # those of the first read seen (see Dereplicator), so only labels and sequences are compared
+    lines = data.decode().splitlines()
+    return [(lines[i][1:], lines[i + 1].upper()) for i in range(0, len(lines), 4)]
+
+
+def _vsearch(tmp_path, strand, minuniquesize):
+    fin = tmp_path / "in.fastq"
+    fout = tmp_path / "out.fastq"
+    fin.write_bytes(_fastq())
+    cmd = FASTQDerep._uniques_cmd(str(fin), str(fout), "s_d", 1000000, minuniquesize, strand)
+    sp.run(cmd, check=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+    return _parse(fout.read_bytes())
+
+
+def _engine(tmp_path, strand, minuniquesize, max_uniques=1000000):
+    derep = Dereplicator(strand=strand, max_uniques=max_uniques, tmpdir=str(tmp_path))
+    derep.add_fastq(io.BytesIO(_fastq()))
+    out = io.BytesIO()
+    derep.write(out, "s_d", minuniquesize, 1000000)
+    return _parse(out.getvalue())
+
+
+@requires_vsearch
+@pytest.mark.parametrize("strand", ["plus", "both"])
+@pytest.mark.parametrize("minuniquesize", [1, 2])
+def test_write_matches_vsearch(tmp_path, strand, minuniquesize):
+    assert _engine(tmp_path, strand, minuniquesize) == _vsearch(tmp_path, strand, minuniquesize)
+
+
+@requires_vsearch
+@pytest.mark.parametrize("strand", ["plus", "both"])
+def test_spilled_write_matches_vsearch(tmp_path, strand):
+    assert _engine(tmp_path, strand, 1, max_uniques=2) == _vsearch(tmp_path, strand, 1)
@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+import lithopsrad.mmseqs_utils as mmseqs_utils
+
+
+def _baseline_merge(left_members, right_members, intermediate_hits):
+    """make_merged_hits_table as it was before the union-find merge, over dicts."""
+    joined_hits = {}
+    seen_centroids = set()
+    for int_hit, centroids in intermediate_hits.items():
+        seen_centroids.add(int_hit)
+        seen_centroids.update(centroids)
+        for c in centroids:
+            joined_hits.setdefault(int_hit, set()).update(left_members.get(c, []))
+            joined_hits.setdefault(int_hit, set()).update(right_members.get(c, []))
+        joined_hits.setdefault(int_hit, set()).update(left_members.get(int_hit, []))
+        joined_hits.setdefault(int_hit, set()).update(right_members.get(int_hit, []))
+        joined_hits[int_hit].update(centroids)
+    for members in (left_members, right_members):
+        for key, value in members.items():
+            if key not in seen_centroids:
+                joined_hits.setdefault(key, set()).update(value)
+    return {key: list(value) for key, value in joined_hits.items()}
+
+
+def _random_clustering(rng, ids):
+    """Cluster ids at random, as mmseqs would: every centroid has a row, members exclude it."""
+    ids = list(ids)
+    rng.shuffle(ids)
+    hits = {}
+    while ids:
+        group = ids[:rng.randint(1, 4)]
+        ids = ids[len(group):]
+        hits[group[0]] = group[1:]
+    return hits
+
+
+def _as_sets(hits):
+    return {key: set(members) for key, members in hits.items()}
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_merge_matches_baseline(seed):
+    rng = random.Random(seed)
+    leaves = [_random_clustering(rng, [f"s{i}_{j}" for j in range(rng.randint(1, 8))]) for i in range(rng.randint(2, 6))]
+
+    # merge random pairs until one table is left, with the baseline (dicts of resolved
+    # clusters) and the forests side by side
+    baseline = list(leaves)
+    forests = list(leaves)
+    rounds = []
+    while len(baseline) > 1:
+        i, j = sorted(rng.sample(range(len(baseline)), 2), reverse=True)
+        left, right = baseline.pop(i), baseline.pop(j)
+        left_forest, right_forest = forests.pop(i), forests.pop(j)
+        intermediate = _random_clustering(rng, list(left) + list(right))
+        rounds.append(intermediate)
+        baseline.append(_baseline_merge(left, right, intermediate))
+        forests.append(mmseqs_utils.merge_hits_tables([left_forest, right_forest], intermediate))
+
+    expected = _as_sets(baseline[0])
+    assert _as_sets(mmseqs_utils.resolve_hits(forests[0]).to_dict()) == expected
+    # deferred mode: the leaf tables and every round's hits, in merge order
+    assert _as_sets(mmseqs_utils.resolve_hits(*leaves, *rounds).to_dict()) == expected
+
+
+def test_disjoint_set():
+    forest = mmseqs_utils.DisjointSet(6)
+    forest.union([0, 2], [1, 3])
+    forest.union([4], [0])
+    assert forest.find([1, 3, 5]).tolist() == [4, 2, 5]
+    assert forest.roots().tolist() == [4, 4, 2, 2, 4, 5]
+    assert forest.is_root().tolist() == [False, False, True, False, True, True]
+
+
+HITS = {"c1;size=3": ["m1", "m2"], "c2": [], "c3": ["m3"], "NA": ["null"]}
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_binary_round_trip(tmp_path, mmap):
+    path = str(tmp_path / "hits.bin")
+    mmseqs_utils.write_hits_binary(HITS, path)
+    assert mmseqs_utils.is_binary_hits(path)
+    table = mmseqs_utils.read_hits_binary(path, mmap=mmap)
+    assert table.to_dict() == HITS
+    assert mmseqs_utils.load_hits(path, mmap=mmap).to_dict() == HITS
+    assert mmseqs_utils.read_hits(path) == HITS
+
+
+def test_binary_round_trip_empty(tmp_path):
+    path = str(tmp_path / "hits.bin")
+    mmseqs_utils.write_hits_binary({}, path)
+    assert mmseqs_utils.read_hits_binary(path).to_dict() == {}
+
+
+def test_text_and_binary_match(tmp_path):
+    text, binary = str(tmp_path / "hits.txt"), str(tmp_path / "hits.bin")
+    mmseqs_utils.write_hits(HITS, text)
+    mmseqs_utils.write_hits(mmseqs_utils.as_hits_table(HITS), binary, binary=True)
+    assert not mmseqs_utils.is_binary_hits(text)
+    assert mmseqs_utils.load_hits(text).to_dict() == mmseqs_utils.load_hits(binary).to_dict() == HITS
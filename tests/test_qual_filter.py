@@ -0,0 +1,142 @@
+import io
+import shutil
+import subprocess as sp
+
+import pytest
+
+import lithopsrad.qual_filter as qual_filter
+from lithopsrad.fastq_filter import FASTQFilter
+
+requires_vsearch = pytest.mark.skipif(shutil.which("vsearch") is None, reason="vsearch not installed")
+
+# Default filter parameters, each test relaxes all but the one it covers
+DEFAULTS = dict(minlen=1, truncqual=0, maxns=100, maxee=100.0, maxee_rate=100.0)
+
+# (id, sequence, quality) fixtures hitting the edges of each parameter
+READS = [
+    ("long", "ACGTACGTACGTACGTACGT", "IIIIIIIIIIIIIIIIIIII"),
+    ("short", "ACGTAC", "IIIIII"),
+    ("exact10", "ACGTACGTAC", "IIIIIIIIII"),
+    ("lowtail", "ACGTACGTACGTACGTACGT", "IIIIIIIIIIII++++++++"),
+    ("lowmid", "ACGTACGTACGTACGTACGT", "IIIIIII#IIIIIIIIIIII"),
+    ("onen", "ACGTNCGTACGTACGTACGT", "IIII#IIIIIIIIIIIIIII"),
+    ("twon", "ACGTNCGTANGTACGTACGT", "IIIIIIIIIIIIIIIIIIII"),
+    ("lown", "NNNNACGTACGTACGTACGT", "IIIIIIIIIIIIIIIIIIII"),
+    ("noisy", "ACGTACGTACGTACGTACGT", "5555555555555555555"+"5"),
+    ("mixed", "ACGTACGTACGTACGTACGT", "II55II55II55II55II55"),
+    ("bad", "ACGTACGTACGTACGTACGT", "++++++++++++++++++++"),
+]
+
+
+def _fastq(reads):
+    return "".join(f"@{name}\n{s}\n+\n{q}\n" for name, s, q in reads).encode()
+
+
+def _parse(data):
+    lines = data.decode().splitlines()
+    return [(lines[i][1:].split()[0], lines[i + 1]) for i in range(0, len(lines), 4)]
+
+
+def _vsearch(tmp_path, reads, params, mates=None):
+    fin = tmp_path / "in.fastq"
+    fout = tmp_path / "out.fastq"
+    fin.write_bytes(_fastq(reads))
+    cmd = FASTQFilter._filter_cmd(str(fin), str(fout), **params)
+    if mates is not None:
+        (tmp_path / "in.R2.fastq").write_bytes(_fastq(mates))
+        cmd += ["-reverse", str(tmp_path / "in.R2.fastq"), "-fastqout_rev", str(tmp_path / "out.R2.fastq")]
+    sp.run(cmd, check=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+    out = [_parse(fout.read_bytes())]
+    if mates is not None:
+        out.append(_parse((tmp_path / "out.R2.fastq").read_bytes()))
+    return out
+
+
+def _numpy(reads, params, mates=None):
+    out, out_r2 = io.BytesIO(), io.BytesIO()
+    stream_r2 = io.BytesIO(_fastq(mates)) if mates is not None else None
+    qual_filter.filter_fastq_stream(io.BytesIO(_fastq(reads)), out, stream_r2=stream_r2,
+                                    out_r2=out_r2 if mates is not None else None, batch_size=4, **params)
+    result = [_parse(out.getvalue())]
+    if mates is not None:
+        result.append(_parse(out_r2.getvalue()))
+    return result
+
+
+def _record(name, sequence, quality):
+    return f"@{name}\n{sequence}\n+\n{quality}\n".encode()
+
+
+def test_filter_batch_truncates_at_truncqual():
+    # '#' is Q2: the read is cut before the first base at or below truncqual
+    records = [_record("a", "ACGTACGT", "IIIIIIII"), _record("b", "ACGTACGT", "IIII#III")]
+    assert qual_filter.filter_batch(records, 1, 2, 0, 10.0, 1.0) == [records[0], _record("b", "ACGT", "IIII")]
+    assert qual_filter.filter_batch(records, 1, 1, 0, 10.0, 1.0) == records
+    assert qual_filter.filter_batch(records, 5, 2, 0, 10.0, 1.0) == [records[0], None]
+
+
+def test_filter_batch_maxee_boundaries():
+    # '+' is Q10, an error probability of 0.1: two bases have exactly 0.2 expected errors
+    records = [_record("a", "AC", "++")]
+    assert qual_filter.filter_batch(records, 1, 0, 0, 0.2, 1.0) == records
+    assert qual_filter.filter_batch(records, 1, 0, 0, 0.19, 1.0) == [None]
+    # maxee_rate is per base of the (truncated) read: 0.2 / 2 = 0.1
+    assert qual_filter.filter_batch(records, 1, 0, 0, 10.0, 0.1) == records
+    assert qual_filter.filter_batch(records, 1, 0, 0, 10.0, 0.09) == [None]
+
+
+def test_filter_batch_ignores_ns_after_truncation():
+    records = [_record("a", "ACGTNNAC", "IIII#III")]
+    assert qual_filter.filter_batch(records, 1, 2, 0, 10.0, 1.0) == [_record("a", "ACGT", "IIII")]
+    assert qual_filter.filter_batch(records, 1, 1, 0, 10.0, 1.0) == [None]
+    assert qual_filter.filter_batch(records, 1, 1, 2, 10.0, 1.0) == records
+
+
+def test_filter_batch_zero_length_reads():
+    records = [_record("a", "ACGT", "IIII"), _record("z", "", ""), _record("b", "ACGT", "II#I")]
+    assert qual_filter.filter_batch(records, 1, 2, 0, 10.0, 1.0) == [records[0], None, _record("b", "AC", "II")]
+    assert qual_filter.filter_batch(records, 0, 2, 0, 10.0, 1.0) == [records[0], records[1], _record("b", "AC", "II")]
+    assert qual_filter.filter_batch([], 1, 2, 0, 10.0, 1.0) == []
+
+
+def test_filter_fastq_stream_pairs_need_both_mates():
+    r1 = [_record("a", "ACGT", "IIII"), _record("b", "ACGT", "IIII"), _record("c", "AC", "II"), _record("d", "ACGT", "IIII")]
+    r2 = [_record("a", "TTTT", "IIII"), _record("b", "TT", "II"), _record("c", "TTTT", "IIII"), _record("d", "TTTT", "IIII")]
+    out, out_r2 = io.BytesIO(), io.BytesIO()
+    counts = qual_filter.filter_fastq_stream(io.BytesIO(b"".join(r1)), out, 4, 2, 0, 1.0, 1.0,
+                                             stream_r2=io.BytesIO(b"".join(r2)), out_r2=out_r2, batch_size=3)
+    assert counts == (4, 2)
+    assert out.getvalue() == r1[0] + r1[3]
+    assert out_r2.getvalue() == r2[0] + r2[3]
+
+
+@requires_vsearch
+@pytest.mark.parametrize("param,value", [
+    ("minlen", 10),
+    ("truncqual", 10),
+    ("maxns", 1),
+    ("maxee", 1.0),
+    ("maxee_rate", 0.01),
+])
+def test_matches_vsearch(tmp_path, param, value):
+    params = dict(DEFAULTS, **{param: value})
+    expected = _vsearch(tmp_path, READS, params)
+    assert _numpy(READS, params) == expected
+    # the fixtures must actually exercise the parameter
+    assert 0 < len(expected[0]) < len(READS)
+
+
+@requires_vsearch
+def test_matches_vsearch_combined(tmp_path):
+    params = dict(minlen=10, truncqual=10, maxns=1, maxee=1.0, maxee_rate=0.05)
+    assert _numpy(READS, params) == _vsearch(tmp_path, READS, params)
+
+
+@requires_vsearch
+def test_matches_vsearch_paired(tmp_path):
+    # mates are the reads in reverse order, so a pair is dropped if either mate fails
+    mates = [(name, s, q) for (name, _, _), (_, s, q) in zip(READS, reversed(READS))]
+    params = dict(minlen=10, truncqual=10, maxns=1, maxee=1.0, maxee_rate=0.05)
+    expected = _vsearch(tmp_path, READS, params, mates=mates)
+    assert _numpy(READS, params, mates=mates) == expected
+    assert [name for name, _ in expected[0]] == [name for name, _ in expected[1]]